@@ -20,10 +20,12 @@ without significant importing (it's the same as Godot's tscn format).
 # ##### END GPL LICENSE BLOCK #####
 
 import bpy
-from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty
+from bpy.props import (
+    StringProperty, BoolProperty, FloatProperty, EnumProperty, IntProperty)
 from bpy_extras.io_utils import ExportHelper
 from .structures import ValidationError
 from . import export_godot
+from . import live_link
 
 bl_info = {  # pylint: disable=invalid-name
     "name": "Godot Engine Exporter",
@@ -47,7 +49,7 @@ class ExportGodot(bpy.types.Operator, ExportHelper):
     bl_options = {"PRESET"}
 
     filename_ext = ".escn"
-    filter_glob: StringProperty(default="*.escn", options={"HIDDEN"})
+    filter_glob: StringProperty(default="*.escn;*.scn", options={"HIDDEN"})
 
     # List of operator properties, the attributes will be assigned
     # to the class instance from the operator settings before calling
@@ -154,6 +156,101 @@ class ExportGodot(bpy.types.Operator, ExportHelper):
             )
         )
     )
+    animation_sampling: EnumProperty(
+        name="Animation Sampling",
+        description="Frames at which animation curves are sampled into "
+                    "keys",
+        default="FRAMES",
+        items=(
+            (
+                "FRAMES", "Every Frame",
+                "Sample the curves on every frame"
+            ),
+            (
+                "STRIDE", "Frame Stride",
+                "Sample the curves every 'Sample Stride' frames"
+            ),
+            (
+                "RATE", "Fixed Rate",
+                "Sample the curves at 'Sample Rate' keys per second, "
+                "independently of the scene frame rate"
+            ),
+            (
+                "ADAPTIVE", "Adaptive",
+                "Sample the curves every 'Sample Stride' frames, and "
+                "add frames in between where the curves deviate from "
+                "a straight line by more than 'Adaptive Tolerance'"
+            ),
+        )
+    )
+    animation_sample_stride: IntProperty(
+        name="Sample Stride",
+        description="Frames between two samples of the curves",
+        default=4,
+        min=1,
+    )
+    animation_sample_rate: FloatProperty(
+        name="Sample Rate",
+        description="Samples per second of the curves",
+        default=30.0,
+        min=0.1,
+    )
+    animation_adaptive_tolerance: FloatProperty(
+        name="Adaptive Tolerance",
+        description="Largest deviation of a curve from linear "
+                    "interpolation between two samples",
+        default=0.001,
+        min=0.0,
+    )
+    use_keyframe_exact_tracks: BoolProperty(
+        name="Keyframe Exact Tracks",
+        description="Transforms and values animated only with LINEAR or "
+                    "CONSTANT keyframes get keys on their keyframes instead "
+                    "of on every frame, when Godot interpolates them the "
+                    "same",
+        default=False,
+    )
+    use_track_optimization: BoolProperty(
+        name="Optimize Animation Tracks",
+        description="Remove animation tracks which do not change their "
+                    "node (it already has their constant value, or bones "
+                    "stay in rest pose), and keep a single key on the "
+                    "other constant tracks",
+        default=False,
+    )
+    use_keyframe_reduction: BoolProperty(
+        name="Reduce Keyframes",
+        description="Remove transform and value keys which the "
+                    "interpolation of the remaining keys reproduces within "
+                    "the tolerances below",
+        default=False,
+    )
+    keyframe_location_tolerance: FloatProperty(
+        name="Location Tolerance",
+        description="Maximal location error of a removed transform key",
+        default=0.001,
+        min=0.0,
+    )
+    keyframe_rotation_tolerance: FloatProperty(
+        name="Rotation Tolerance",
+        description="Maximal rotation error of a removed transform key",
+        default=0.001745,
+        min=0.0,
+        subtype='ANGLE',
+    )
+    keyframe_scale_tolerance: FloatProperty(
+        name="Scale Tolerance",
+        description="Maximal scale error of a removed transform key",
+        default=0.001,
+        min=0.0,
+    )
+    keyframe_value_tolerance: FloatProperty(
+        name="Value Tolerance",
+        description="Maximal error of a removed key on a number or color "
+                    "channel of a value track",
+        default=0.001,
+        min=0.0,
+    )
     material_mode: EnumProperty(
         name="Material Mode",
         description="Configuration of how mesh surface Material being "
@@ -176,6 +273,14 @@ class ExportGodot(bpy.types.Operator, ExportHelper):
         )
 
     )
+    use_spatial_material_fast_path: BoolProperty(
+        name="Spatial Material Fast Path",
+        description="In Script Shader mode, export materials whose node "
+                    "tree is just a Principled BSDF with constant inputs or "
+                    "image textures as Spatial Material, which is cheaper "
+                    "to render in Godot",
+        default=True,
+    )
     material_search_paths: EnumProperty(
         name="Material Search Paths",
         description="Search for existing Godot materials with names that "
@@ -198,6 +303,209 @@ class ExportGodot(bpy.types.Operator, ExportHelper):
         )
     )
 
+    use_external_resources: BoolProperty(
+        name="External Resource Files",
+        description="Save meshes, animations and shaders larger than the "
+                    "threshold to .tres files next to the exported file. "
+                    "Files whose content did not change are not rewritten",
+        default=False,
+    )
+    external_resource_threshold: IntProperty(
+        name="External Resource Threshold",
+        description="Size in KiB above which a resource is saved to its "
+                    "own file",
+        default=64,
+        min=0,
+    )
+    use_incremental_export: BoolProperty(
+        name="Incremental Export",
+        description="Keep a manifest next to the exported escn, so that "
+                    "the next export only converts the objects changed "
+                    "since and patches them into the file. Adding, "
+                    "removing or reparenting objects, or changing the "
+                    "export settings, exports everything",
+        default=False,
+    )
+    export_split: EnumProperty(
+        name="Split",
+        description="Export the active scene to the file, or each scene or "
+                    "collection to its own file, named after the file and "
+                    "the scene or collection. Data used by several files "
+                    "is converted once",
+        default="NONE",
+        items=(
+            (
+                "NONE", "Active Scene",
+                "Export the active scene to the file"
+            ),
+            (
+                "SCENES", "Each Scene",
+                "Export each scene to its own file"
+            ),
+            (
+                "COLLECTIONS", "Each Collection",
+                "Export each top-level collection of the active scene to "
+                "its own file"
+            ),
+        ),
+    )
+    use_live_link: BoolProperty(
+        name="Live Link",
+        description="After this export, keep exporting the scene to the "
+                    "same file after each change, converting only the "
+                    "changed objects, until stopped from the export menu",
+        default=False,
+    )
+    use_collection_instances: BoolProperty(
+        name="Collection Instances as Scenes",
+        description="Export each instanced collection once as its own "
+                    "escn file next to the exported one, and collection "
+                    "instances as instances of that scene",
+        default=False,
+    )
+    use_shared_subtrees: BoolProperty(
+        name="Repeated Hierarchies as Scenes",
+        description="Export object hierarchies repeated in the scene "
+                    "(same meshes, materials, local transforms, physics and "
+                    "animations) once as their own escn file, and their "
+                    "copies as instances of that scene",
+        default=False,
+    )
+    use_instance_multimesh: BoolProperty(
+        name="Linked Duplicates as MultiMesh",
+        description="Export many linked duplicates of a mesh as one "
+                    "MultiMeshInstance. Only objects without parent, "
+                    "children, animation, physics or deformation are "
+                    "merged",
+        default=False,
+    )
+    instance_multimesh_threshold: IntProperty(
+        name="MultiMesh Threshold",
+        description="Minimal number of linked duplicates merged into a "
+                    "MultiMeshInstance",
+        default=32,
+        min=2,
+    )
+    multimesh_chunking: EnumProperty(
+        name="Particle Chunking",
+        description="Split particle systems into several MultiMeshInstance "
+                    "by location, so that Godot can cull the parts out of "
+                    "view",
+        default="NONE",
+        items=(
+            (
+                "NONE", "None",
+                "Export each particle system as one MultiMeshInstance"
+            ),
+            (
+                "GRID", "Grid",
+                "One MultiMeshInstance for each cell of a uniform grid"
+            ),
+            (
+                "OCTREE", "Octree",
+                "One MultiMeshInstance for each leaf of an octree, cells "
+                "are split until they hold few enough instances"
+            ),
+        )
+    )
+    multimesh_chunk_size: FloatProperty(
+        name="Chunk Size",
+        description="Size of the grid cells, or of the smallest octree "
+                    "cells, of chunked particle systems",
+        default=10.0,
+        min=0.001,
+    )
+    multimesh_chunk_max_instances: IntProperty(
+        name="Chunk Max Instances",
+        description="Octree cells holding more instances are split",
+        default=1024,
+        min=1,
+    )
+    multimesh_chunk_lod_distance: FloatProperty(
+        name="Chunk Visibility Distance",
+        description="Chunks farther from the camera are hidden "
+                    "(lod_max_distance), 0 shows them at any distance",
+        default=0.0,
+        min=0.0,
+    )
+    convex_hull_max_points: IntProperty(
+        name="Convex Hull Max Points",
+        description="Maximal number of points of a Convex Hull collision "
+                    "shape, hulls with more points are simplified. "
+                    "0 keeps all the hull points",
+        default=0,
+        min=0,
+    )
+    convex_hull_volume_error: FloatProperty(
+        name="Convex Hull Volume Error",
+        description="Volume ratio a simplified Convex Hull collision shape "
+                    "may lose, it stops adding points below the max points "
+                    "once the error is under this value",
+        default=0.01,
+        min=0.0,
+        max=1.0,
+    )
+    use_primitive_shape_fitting: BoolProperty(
+        name="Fit Primitive Collision Shapes",
+        description="Replace Convex Hull and Mesh collision shapes by a "
+                    "box, sphere, capsule or cylinder shape when one fits "
+                    "the mesh closely, they are much cheaper in Godot",
+        default=False,
+    )
+    primitive_fit_error: FloatProperty(
+        name="Primitive Fit Error",
+        description="Volume ratio of a fitted primitive shape which may "
+                    "lie outside of the mesh",
+        default=0.05,
+        min=0.0,
+        max=1.0,
+    )
+    mesh_shape_decomposition: EnumProperty(
+        name="Mesh Shape Decomposition",
+        description="Replace Mesh collision shapes with several convex "
+                    "hulls, Godot rigid bodies can not collide with "
+                    "concave shapes. A 'godot_convex_decomposition' "
+                    "custom property on an object overrides this",
+        default="NONE",
+        items=(
+            (
+                "NONE", "None",
+                "Export Mesh shapes as Concave Polygon Shape"
+            ),
+            (
+                "RIGID_BODIES", "Rigid Bodies",
+                "Decompose the Mesh shapes of active rigid bodies"
+            ),
+            (
+                "ALL", "All",
+                "Decompose all the Mesh shapes"
+            ),
+        )
+    )
+    decomposition_max_hulls: IntProperty(
+        name="Decomposition Max Hulls",
+        description="Maximal number of convex hulls a Mesh collision "
+                    "shape is decomposed into",
+        default=16,
+        min=1,
+    )
+    decomposition_max_hull_points: IntProperty(
+        name="Decomposition Max Hull Points",
+        description="Maximal number of points of each convex hull of a "
+                    "decomposition, 0 keeps all the hull points",
+        default=32,
+        min=0,
+    )
+    decomposition_concavity: FloatProperty(
+        name="Decomposition Concavity",
+        description="Parts of a decomposition are not split further once "
+                    "their surface is this close to their convex hull, "
+                    "relative to the size of the mesh",
+        default=0.02,
+        min=0.0,
+        max=1.0,
+    )
+
     @property
     def check_extension(self):
         """Checks if the file extension is valid. It appears we don't
@@ -217,28 +525,56 @@ class ExportGodot(bpy.types.Operator, ExportHelper):
                 "check_existing",
                 "filter_glob",
                 "xna_validate",
+                "use_live_link",
             ))
 
-            return export_godot.save(self, context, **keywords)
+            result = export_godot.save(self, context, **keywords)
+            if self.use_live_link and self.export_split != "NONE":
+                self.report({'WARNING'}, "The live link only exports the "
+                                         "active scene to a single file")
+            elif self.use_live_link:
+                live_link.start(self.filepath, keywords)
+            return result
         except ValidationError as error:
             self.report({'ERROR'}, str(error))
             return {'CANCELLED'}
 
 
+class StopGodotLiveLink(bpy.types.Operator):
+    """Stop exporting the scene after each change"""
+    bl_idname = "export_godot.stop_live_link"
+    bl_label = "Stop Godot Live Link"
+
+    @classmethod
+    def poll(cls, context):
+        """Only while a live link runs"""
+        return live_link.is_running()
+
+    def execute(self, context):
+        """Stop the live link"""
+        live_link.stop()
+        return {'FINISHED'}
+
+
 def menu_func(self, context):
     """Add to the menu"""
     self.layout.operator(ExportGodot.bl_idname, text="Godot Engine (.escn)")
+    if live_link.is_running():
+        self.layout.operator(StopGodotLiveLink.bl_idname)
 
 
 def register():
     """Add addon to blender"""
     bpy.utils.register_class(ExportGodot)
+    bpy.utils.register_class(StopGodotLiveLink)
     bpy.types.TOPBAR_MT_file_export.append(menu_func)
 
 
 def unregister():
     """Remove addon from blender"""
+    live_link.stop()
     bpy.utils.unregister_class(ExportGodot)
+    bpy.utils.unregister_class(StopGodotLiveLink)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func)
 
 
@@ -256,7 +592,10 @@ def export(filename, overrides=None):
         }
     )
 
-    Anything not overridden will use the default properties
+    Anything not overridden will use the default properties. With
+    'export_split' set to 'SCENES' or 'COLLECTIONS', each scene or top-level
+    collection is exported to its own file, named after filename and the
+    scene or collection
     """
 
     default_settings = dict()
@@ -270,6 +609,8 @@ def export(filename, overrides=None):
             default_settings[attr_name] = attr[1]['default']
     if overrides is not None:
         default_settings.update(overrides)
+    # the live link needs the user interface
+    default_settings.pop("use_live_link")
 
     class FakeOp:
         """Fake blender operator"""
@@ -0,0 +1,423 @@
+"""Batch export of many blend files with a pool of headless blender
+processes. Run it with any python 3:
+
+    python3 io_scene_godot/batch_export.py --output-dir exports \\
+        --root scenes 'scenes/**/*.blend'
+
+Blend files are given as glob patterns or listed in manifest files. Like
+`tests/export_test_scenes.py`, a `config.json` next to a blend file holds
+the export settings overriding the defaults for the blend files of its
+directory. Each worker is a `blender -b` process running this script, which
+exports the blend files it is sent one after the other. Every worker has
+its own queue of files, from a single directory when possible, and takes
+work from the end of the longest other queue once its own is empty. A
+worker which crashes or takes longer than the timeout is killed and its
+file is tried again. Timings, output sizes and failures are written to a
+JSON summary"""
+import os
+import sys
+import json
+import glob
+import time
+import queue
+import argparse
+import threading
+import traceback
+import subprocess
+import collections
+
+# prefix of the lines a worker sends to the batch process, other lines of
+# its output are blender and exporter messages
+RESULT_MARKER = "@@godot-batch@@ "
+
+# lines of worker output kept to explain a failure
+OUTPUT_TAIL = 40
+
+CONFIG_FILE_NAME = "config.json"
+
+
+def run_worker():
+    """Worker loop, inside blender: read jobs from stdin, one JSON object
+    per line, export them and print their result"""
+    # pylint: disable-msg=import-outside-toplevel
+    import bpy
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    import io_scene_godot
+
+    _send({'ready': True})
+    for line in sys.stdin:
+        job = json.loads(line)
+        started = time.perf_counter()
+        try:
+            bpy.ops.wm.open_mainfile(filepath=job['blend'])
+            loaded = time.perf_counter()
+            os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+            config = dict(job['config'])
+            if 'object_types' in config:
+                config['object_types'] = set(config['object_types'])
+            io_scene_godot.export(job['output'], config)
+            _send({
+                'status': 'ok',
+                'load_seconds': loaded - started,
+                'export_seconds': time.perf_counter() - loaded,
+                'size': os.path.getsize(job['output']),
+            })
+        except Exception:  # pylint: disable=broad-except
+            _send({'status': 'error', 'error': traceback.format_exc()})
+
+
+def _send(message):
+    sys.stdout.write(RESULT_MARKER + json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def find_blend_files(patterns, manifests):
+    """Absolute paths of the blend files matching the glob patterns or
+    listed in the manifests (one path per line, relative to the manifest,
+    '#' starting a comment)"""
+    paths = list()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            print("No blend file matches {}".format(pattern))
+        paths.extend(matches)
+    for manifest in manifests:
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding='utf-8') as manifest_file:
+            for line in manifest_file:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    paths.append(os.path.join(base_dir, line))
+    unique_paths = list()
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in unique_paths:
+            unique_paths.append(path)
+    return unique_paths
+
+
+def directory_config(directory, configs):
+    """Export settings of the config.json of a directory, cached in
+    configs"""
+    if directory not in configs:
+        config_path = os.path.join(directory, CONFIG_FILE_NAME)
+        if os.path.exists(config_path):
+            with open(config_path, encoding='utf-8') as config_file:
+                configs[directory] = json.load(config_file)
+        else:
+            configs[directory] = dict()
+    return configs[directory]
+
+
+def make_jobs(blend_paths, args):
+    """One job per blend file, with its output path and settings"""
+    root = os.path.abspath(args.root)
+    base_config = dict()
+    if args.config:
+        with open(args.config, encoding='utf-8') as config_file:
+            base_config = json.load(config_file)
+    configs = dict()
+    jobs = list()
+    for blend_path in blend_paths:
+        relative_path = os.path.relpath(blend_path, root)
+        if relative_path.startswith(os.pardir):
+            relative_path = os.path.basename(blend_path)
+        config = dict(base_config)
+        config.update(
+            directory_config(os.path.dirname(blend_path), configs))
+        jobs.append({
+            'blend': blend_path,
+            'output': os.path.join(
+                os.path.abspath(args.output_dir),
+                os.path.splitext(relative_path)[0] + args.extension),
+            'config': config,
+            'attempts': 0,
+        })
+    return jobs
+
+
+class WorkQueues:
+    """A queue of jobs per worker. Jobs are dealt in contiguous runs of the
+    sorted paths so that a worker keeps to the same directories, and an
+    idle worker steals from the end of the longest queue"""
+
+    def __init__(self, jobs, worker_count):
+        jobs = sorted(jobs, key=lambda job: job['blend'])
+        self.lock = threading.Lock()
+        self.queues = list()
+        run_length = -(-len(jobs) // worker_count)
+        for index in range(worker_count):
+            self.queues.append(collections.deque(
+                jobs[index * run_length:(index + 1) * run_length]))
+        self.steals = [0] * worker_count
+
+    def take(self, worker_index):
+        """The next job for a worker, None once all queues are empty"""
+        with self.lock:
+            own_queue = self.queues[worker_index]
+            if own_queue:
+                return own_queue.popleft()
+            longest = max(self.queues, key=len)
+            if not longest:
+                return None
+            self.steals[worker_index] += 1
+            return longest.pop()
+
+    def retry(self, worker_index, job):
+        """Queue a failed job again, at the end of the worker queue so that
+        another worker may take it"""
+        with self.lock:
+            self.queues[worker_index].append(job)
+
+
+class Worker:
+    """A blender process exporting the jobs it is sent"""
+
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        self.process = None
+        self.messages = None
+        self.output_tail = collections.deque(maxlen=OUTPUT_TAIL)
+        self.stats = {'worker': index, 'jobs': 0, 'restarts': 0,
+                      'startup_seconds': 0.0, 'busy_seconds': 0.0}
+
+    def start(self):
+        """Start blender and wait until it is ready for jobs"""
+        if self.process is not None:
+            self.stats['restarts'] += 1
+        started = time.perf_counter()
+        self.messages = queue.Queue()
+        # the process outlives this call, it is ended by stop()
+        # pylint: disable-msg=consider-using-with
+        self.process = subprocess.Popen(
+            [self.args.blender, '-b', '--factory-startup',
+             '--python', os.path.abspath(__file__), '--', '--worker'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        threading.Thread(target=self._read_output,
+                         args=(self.process, self.messages),
+                         daemon=True).start()
+        message = self._receive(self.args.timeout)
+        self.stats['startup_seconds'] += time.perf_counter() - started
+        if message is None or not message.get('ready'):
+            self.stop(kill=True)
+            raise RuntimeError("Blender failed to start:\n" +
+                               "".join(self.output_tail))
+
+    def _read_output(self, process, messages):
+        for line in process.stdout:
+            if line.startswith(RESULT_MARKER):
+                messages.put(json.loads(line[len(RESULT_MARKER):]))
+            else:
+                self.output_tail.append(line)
+        messages.put(None)
+
+    def _receive(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return {'status': 'timeout',
+                    'error': "No result after {} s".format(timeout)}
+
+    def run(self, job):
+        """Export a job, return its result message"""
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.output_tail.clear()
+        started = time.perf_counter()
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            pass  # the process died, which is reported below
+        result = self._receive(self.args.timeout)
+        if result is None:
+            result = {'status': 'crashed',
+                      'error': "Blender exited with code {}".format(
+                          self.process.wait())}
+        if result['status'] != 'ok':
+            result['output_tail'] = "".join(self.output_tail)
+        if result['status'] in ('crashed', 'timeout'):
+            self.stop(kill=True)
+        self.stats['jobs'] += 1
+        self.stats['busy_seconds'] += time.perf_counter() - started
+        return result
+
+    def stop(self, kill=False):
+        """Let the blender process exit, or kill it"""
+        if self.process is None or self.process.poll() is not None:
+            return
+        if not kill:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=self.args.timeout)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        self.process.kill()
+        self.process.wait()
+
+
+class BatchExport:
+    """Dispatch the jobs to the workers and gather their results"""
+
+    def __init__(self, jobs, args):
+        self.args = args
+        self.total = len(jobs)
+        self.worker_count = max(1, min(args.workers, len(jobs)))
+        self.jobs = jobs
+        self.queues = WorkQueues(jobs, self.worker_count)
+        self.workers = [Worker(index, args)
+                        for index in range(self.worker_count)]
+        self.results = list()
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Export everything, return the summary"""
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._work, args=(worker,))
+                   for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # a worker thread which died left its jobs without result
+        recorded = {entry['blend'] for entry in self.results}
+        for job in self.jobs:
+            if job['blend'] not in recorded:
+                self._record(job, {'status': 'not_exported',
+                                   'error': "No worker exported it"})
+        return self.summary(time.perf_counter() - started)
+
+    def _work(self, worker):
+        try:
+            while True:
+                job = self.queues.take(worker.index)
+                if job is None:
+                    return
+                job['attempts'] += 1
+                try:
+                    result = worker.run(job)
+                except (RuntimeError, OSError) as error:
+                    # OSError when blender can not be run at all
+                    result = {'status': 'crashed', 'error': str(error)}
+                if (result['status'] in ('crashed', 'timeout') and
+                        job['attempts'] <= self.args.retries):
+                    print("{} {}, retrying".format(
+                        result['status'], job['blend']))
+                    self.queues.retry(worker.index, job)
+                    continue
+                self._record(job, result)
+        finally:
+            worker.stop()
+
+    def _record(self, job, result):
+        entry = {
+            'blend': job['blend'],
+            'output': job['output'],
+            'attempts': job['attempts'],
+        }
+        entry.update(result)
+        with self.lock:
+            self.results.append(entry)
+            print("[{}/{}] {} {}{}".format(
+                len(self.results), self.total, result['status'],
+                job['blend'],
+                " ({:.2f} s)".format(result['export_seconds'])
+                if result['status'] == 'ok' else ""))
+            if result['status'] != 'ok':
+                print(result['error'])
+
+    def summary(self, duration):
+        """Timings, sizes and failures of the batch"""
+        exported = [entry for entry in self.results
+                    if entry['status'] == 'ok']
+        for worker, steals in zip(self.workers, self.queues.steals):
+            worker.stats['steals'] = steals
+        return {
+            'duration_seconds': duration,
+            'files': sorted(self.results, key=lambda entry: entry['blend']),
+            'exported': len(exported),
+            'failed': len(self.results) - len(exported),
+            'load_seconds': sum(entry['load_seconds']
+                                for entry in exported),
+            'export_seconds': sum(entry['export_seconds']
+                                  for entry in exported),
+            'output_bytes': sum(entry['size'] for entry in exported),
+            'workers': [worker.stats for worker in self.workers],
+        }
+
+
+def parse_args(argv):
+    """Command line of the batch process"""
+    parser = argparse.ArgumentParser(description=(
+        "Export blend files to Godot scenes with several blender "
+        "processes"))
+    parser.add_argument(
+        'patterns', nargs='*', metavar='PATTERN',
+        help="glob patterns of the blend files, '**' matching directories")
+    parser.add_argument(
+        '--manifest', action='append', default=[],
+        help="file listing blend files, one per line")
+    parser.add_argument(
+        '--output-dir', required=True,
+        help="directory of the exported files")
+    parser.add_argument(
+        '--root', default=os.curdir,
+        help="the exported files keep the paths of the blend files "
+             "relative to this directory")
+    parser.add_argument(
+        '--config',
+        help="JSON file of export settings, overridden by the "
+             "config.json next to the blend files")
+    parser.add_argument(
+        '--extension', default='.escn', choices=('.escn', '.scn'),
+        help="extension, and so format, of the exported files")
+    parser.add_argument(
+        '--blender', default=os.environ.get('BLENDER', 'blender'),
+        help="blender executable")
+    parser.add_argument(
+        '--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+        help="number of blender processes")
+    parser.add_argument(
+        '--timeout', type=float, default=600.0,
+        help="seconds after which an export is abandoned")
+    parser.add_argument(
+        '--retries', type=int, default=1,
+        help="times a file is tried again after a timeout or crash")
+    parser.add_argument(
+        '--summary', default='batch_export_summary.json',
+        help="JSON file receiving the timings and failures")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """Batch export from the command line, return the exit code"""
+    args = parse_args(argv)
+    blend_paths = find_blend_files(args.patterns, args.manifest)
+    if not blend_paths:
+        print("No blend file to export")
+        return 1
+    batch = BatchExport(make_jobs(blend_paths, args), args)
+    print("Exporting {} blend files with {} workers".format(
+        len(blend_paths), batch.worker_count))
+    summary = batch.run()
+    with open(args.summary, 'w', encoding='utf-8') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print("{} exported, {} failed in {:.1f} s, summary in {}".format(
+        summary['exported'], summary['failed'],
+        summary['duration_seconds'], args.summary))
+    if (summary['failed'] or
+            summary['exported'] + summary['failed'] != len(blend_paths)):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if '--' in sys.argv and '--worker' in sys.argv:
+        run_worker()
+    else:
+        sys.exit(main(sys.argv[1:]))
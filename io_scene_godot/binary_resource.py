@@ -0,0 +1,528 @@
+"""Writer of the binary resource format of Godot 3 (RSRC, the .scn and
+.res files), an alternative to the escn text which Godot loads without
+parsing decimal numbers. The file is written from variants (see
+variant.py), pool arrays are dumped as little endian buffers straight
+from their numpy arrays. A reader is provided to check the written files"""
+import collections
+import io
+import struct
+import numpy
+
+from .variant import (
+    GodotValue, ParsedEntry, entry_to_variants, parse_node_path)
+
+# resource format version, 3 is Godot 3.1 (node paths without property)
+FORMAT_VERSION = 3
+ENGINE_VERSION = (3, 1)
+
+VARIANT_NIL = 1
+VARIANT_BOOL = 2
+VARIANT_INT = 3
+VARIANT_REAL = 4
+VARIANT_STRING = 5
+VARIANT_NODE_PATH = 22
+VARIANT_OBJECT = 24
+VARIANT_DICTIONARY = 26
+VARIANT_ARRAY = 30
+VARIANT_INT64 = 40
+VARIANT_DOUBLE = 41
+
+OBJECT_EMPTY = 0
+OBJECT_INTERNAL_RESOURCE = 2
+OBJECT_EXTERNAL_RESOURCE_INDEX = 3
+
+# math types: name -> (variant code, number of reals)
+MATH_TYPES = {
+    'Vector2': (10, 2),
+    'Rect2': (11, 4),
+    'Vector3': (12, 3),
+    'Plane': (13, 4),
+    'Quat': (14, 4),
+    'AABB': (15, 6),
+    'Basis': (16, 9),
+    'Transform': (17, 12),
+    'Transform2D': (18, 6),
+    'Color': (20, 4),
+}
+
+# pool arrays: name -> (variant code, numpy dtype written, components)
+POOL_TYPES = {
+    'PoolByteArray': (31, '<u1', 1),
+    'PoolIntArray': (32, '<i4', 1),
+    'PoolRealArray': (33, '<f4', 1),
+    'PoolVector3Array': (35, '<f4', 3),
+    'PoolColorArray': (36, '<f4', 4),
+    'PoolVector2Array': (37, '<f4', 2),
+}
+VARIANT_STRING_ARRAY = 34
+
+# layout of the nodes of a PackedScene
+NO_PARENT_SAVED = 0x7FFFFFFF
+TYPE_INSTANCED = 0x7FFFFFFF
+PACKED_SCENE_VERSION = 2
+
+
+def _unicode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('<I', len(data) + 1) + data + b'\0'
+
+
+class BinaryResourceWriter:
+    """Serializes entries (ParsedEntry of a whole escn or tres file) into
+    the RSRC format"""
+    def __init__(self, entries):
+        entries = [entry_to_variants(entry) for entry in entries]
+        self.heading = entries[0]
+        self.external = [entry for entry in entries
+                         if entry.entry_type == 'ext_resource']
+        self.internal = [entry for entry in entries
+                         if entry.entry_type == 'sub_resource']
+        self.nodes = [entry for entry in entries
+                      if entry.entry_type == 'node']
+        self.main = [entry for entry in entries
+                     if entry.entry_type == 'resource']
+
+        self.external_index = {
+            entry.heading['id']: index
+            for index, entry in enumerate(self.external)
+        }
+        self.strings = list()
+        self.string_index = dict()
+
+    def string_id(self, text):
+        """Index of a string in the string table"""
+        if text not in self.string_index:
+            self.string_index[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_index[text]
+
+    def write_variant(self, out, value):
+        """Write a variant into the byte stream"""
+        # pylint: disable-msg=too-many-branches
+        if value is None:
+            out.write(struct.pack('<I', VARIANT_NIL))
+        elif isinstance(value, bool):
+            out.write(struct.pack('<II', VARIANT_BOOL, int(value)))
+        elif isinstance(value, int):
+            if -2 ** 31 <= value < 2 ** 31:
+                out.write(struct.pack('<Ii', VARIANT_INT, value))
+            else:
+                out.write(struct.pack('<Iq', VARIANT_INT64, value))
+        elif isinstance(value, float):
+            # as precise as the text, which has 6 significant digits
+            out.write(struct.pack('<If', VARIANT_REAL, value))
+        elif isinstance(value, str):
+            out.write(struct.pack('<I', VARIANT_STRING))
+            out.write(_unicode_string(value))
+        elif isinstance(value, list):
+            out.write(struct.pack('<II', VARIANT_ARRAY, len(value)))
+            for item in value:
+                self.write_variant(out, item)
+        elif isinstance(value, dict):
+            out.write(struct.pack('<II', VARIANT_DICTIONARY, len(value)))
+            for key, item in value.items():
+                self.write_variant(out, key)
+                self.write_variant(out, item)
+        elif isinstance(value, GodotValue):
+            self.write_godot_value(out, value)
+        else:
+            raise ValueError("Can not write {!r}".format(value))
+
+    def write_godot_value(self, out, value):
+        """Write a variant written as a constructor in the text"""
+        if value.name in MATH_TYPES:
+            code, count = MATH_TYPES[value.name]
+            out.write(struct.pack('<I{}f'.format(count), code, *value.args))
+        elif value.name in POOL_TYPES:
+            code, dtype, components = POOL_TYPES[value.name]
+            data = numpy.ascontiguousarray(value.args, dtype=dtype)
+            out.write(struct.pack('<II', code, len(data) // components))
+            out.write(data.tobytes())
+            # buffers are padded to 4 bytes
+            out.write(b'\0' * (-len(data) * data.itemsize % 4))
+        elif value.name == 'PoolStringArray':
+            out.write(struct.pack('<II', VARIANT_STRING_ARRAY,
+                                  len(value.args)))
+            for text in value.args:
+                out.write(_unicode_string(text))
+        elif value.name == 'NodePath':
+            names, subnames, is_absolute = parse_node_path(value.args[0])
+            out.write(struct.pack(
+                '<IHH', VARIANT_NODE_PATH, len(names),
+                len(subnames) | (0x8000 if is_absolute else 0)))
+            for name in names + subnames:
+                out.write(struct.pack('<I', self.string_id(name)))
+        elif value.name == 'SubResource':
+            out.write(struct.pack('<III', VARIANT_OBJECT,
+                                  OBJECT_INTERNAL_RESOURCE, value.args[0]))
+        elif value.name == 'ExtResource':
+            out.write(struct.pack(
+                '<III', VARIANT_OBJECT, OBJECT_EXTERNAL_RESOURCE_INDEX,
+                self.external_index[value.args[0]]))
+        else:
+            raise ValueError("Can not write {}".format(value.name))
+
+    def write_properties(self, resource_type, properties):
+        """Serialize the type and properties of a resource"""
+        out = io.BytesIO()
+        out.write(_unicode_string(resource_type))
+        out.write(struct.pack('<I', len(properties)))
+        for name, value in properties:
+            out.write(struct.pack('<I', self.string_id(name)))
+            self.write_variant(out, value)
+        return out.getvalue()
+
+    def bundle_scene(self):
+        """Pack the nodes into the _bundled dictionary of a PackedScene"""
+        names = list()
+        name_index = dict()
+        variants = list()
+
+        def name_id(name):
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+            return name_index[name]
+
+        def variant_id(value):
+            variants.append(value)
+            return len(variants) - 1
+
+        node_index = dict()
+        packed_nodes = list()
+        for index, node in enumerate(self.nodes):
+            heading = node.heading
+            if 'parent' not in heading:
+                path, parent, owner = '.', -1, -1
+            else:
+                parent = node_index[heading['parent']]
+                owner = 0
+                path = heading['name']
+                if heading['parent'] != '.':
+                    path = heading['parent'] + '/' + heading['name']
+            node_index[path] = index
+
+            instance = -1
+            node_type = TYPE_INSTANCED
+            if 'type' in heading:
+                node_type = name_id(heading['type'])
+            if 'instance' in heading:
+                instance = variant_id(heading['instance'])
+
+            packed_nodes.extend((
+                parent, owner, node_type, name_id(heading['name']),
+                instance, len(node)))
+            for key, value in node.items():
+                packed_nodes.extend((name_id(key), variant_id(value)))
+            groups = heading.get('groups', [])
+            packed_nodes.append(len(groups))
+            packed_nodes.extend(name_id(group) for group in groups)
+
+        return collections.OrderedDict((
+            ('names', GodotValue('PoolStringArray', names)),
+            ('variants', variants),
+            ('node_count', len(self.nodes)),
+            ('nodes', GodotValue('PoolIntArray', numpy.array(packed_nodes))),
+            ('conn_count', 0),
+            ('conns', GodotValue('PoolIntArray', numpy.array([], int))),
+            ('node_paths', []),
+            ('editable_instances', []),
+            ('version', PACKED_SCENE_VERSION),
+        ))
+
+    def main_resource(self):
+        """Type and properties of the main resource of the file"""
+        if self.heading.entry_type == 'gd_scene':
+            return 'PackedScene', [('_bundled', self.bundle_scene())]
+        properties = list(self.main[0].items()) if self.main else []
+        return self.heading.heading['type'], properties
+
+    def to_bytes(self):
+        """Serialize the whole file"""
+        main_type, main_properties = self.main_resource()
+        # the string table comes first, so the resources are serialized
+        # before anything is written
+        bodies = [self.write_properties(entry.heading['type'], list(
+            entry.items())) for entry in self.internal]
+        bodies.append(self.write_properties(main_type, main_properties))
+
+        out = io.BytesIO()
+        out.write(b'RSRC')
+        out.write(struct.pack('<IIIII', 0, 0, ENGINE_VERSION[0],
+                              ENGINE_VERSION[1], FORMAT_VERSION))
+        out.write(_unicode_string(main_type))
+        # import metadata offset, then reserved fields
+        out.write(struct.pack('<Q', 0))
+        out.write(struct.pack('<14I', *([0] * 14)))
+
+        out.write(struct.pack('<I', len(self.strings)))
+        for text in self.strings:
+            out.write(_unicode_string(text))
+
+        out.write(struct.pack('<I', len(self.external)))
+        for entry in self.external:
+            out.write(_unicode_string(entry.heading['type']))
+            out.write(_unicode_string(entry.heading['path']))
+
+        paths = ['local://{}'.format(entry.heading['id'])
+                 for entry in self.internal] + ['']
+        out.write(struct.pack('<I', len(bodies)))
+        offsets_position = list()
+        for path in paths:
+            out.write(_unicode_string(path))
+            offsets_position.append(out.tell())
+            out.write(struct.pack('<Q', 0))
+
+        offsets = list()
+        for body in bodies:
+            offsets.append(out.tell())
+            out.write(body)
+        out.write(b'RSRC')
+
+        data = out.getbuffer()
+        for position, offset in zip(offsets_position, offsets):
+            struct.pack_into('<Q', data, position, offset)
+        return bytes(data)
+
+
+def write_binary_file(entries, path):
+    """Write entries (the heading, resources and nodes of an escn or tres
+    file, as exporter FileEntry or ParsedEntry) into a binary file"""
+    with open(path, 'wb') as out_file:
+        out_file.write(BinaryResourceWriter(entries).to_bytes())
+
+
+def map_references(value, replace):
+    """Copy of a variant whose SubResource and ExtResource references are
+    replaced by replace(reference)"""
+    if isinstance(value, list):
+        return [map_references(item, replace) for item in value]
+    if isinstance(value, dict):
+        return collections.OrderedDict(
+            (key, map_references(item, replace))
+            for key, item in value.items())
+    if (isinstance(value, GodotValue) and
+            value.name in ('SubResource', 'ExtResource')):
+        return replace(value)
+    return value
+
+
+def _moved_references(value, escn_file):
+    """Point the references to externalized resources of a variant to
+    the external resource replacing them"""
+    def replace(reference):
+        if reference.name == 'SubResource':
+            external_id = escn_file.get_externalized_resource(
+                reference.args[0])
+            if external_id is not None:
+                return GodotValue('ExtResource', [external_id])
+        return reference
+    return map_references(value, replace)
+
+
+def escn_entries(escn_file):
+    """Entries of an ESCNFile in the order of the text file, as
+    ParsedEntry"""
+    entries = [entry_to_variants(entry) for entry in (
+        [escn_file.heading] + escn_file.external_resources +
+        escn_file.internal_resources + escn_file.nodes)]
+    for entry in entries:
+        for key, value in entry.items():
+            entry[key] = _moved_references(value, escn_file)
+    return entries
+
+
+class BinaryResourceReader:
+    """Reads back a file of BinaryResourceWriter into entries"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.strings = list()
+        self.external_ids = list()
+
+    def unpack(self, fmt):
+        """Read a struct format"""
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def read_string(self):
+        """Read a length prefixed utf8 string"""
+        length, = self.unpack('<I')
+        text = self.data[self.pos:self.pos + length - 1].decode('utf-8')
+        self.pos += length
+        return text
+
+    def read_variant(self):
+        """Read a variant"""
+        # pylint: disable-msg=too-many-return-statements,too-many-branches
+        code, = self.unpack('<I')
+        if code == VARIANT_NIL:
+            return None
+        if code == VARIANT_BOOL:
+            return bool(self.unpack('<I')[0])
+        if code == VARIANT_INT:
+            return self.unpack('<i')[0]
+        if code == VARIANT_INT64:
+            return self.unpack('<q')[0]
+        if code == VARIANT_REAL:
+            return self.unpack('<f')[0]
+        if code == VARIANT_DOUBLE:
+            return self.unpack('<d')[0]
+        if code == VARIANT_STRING:
+            return self.read_string()
+        if code == VARIANT_ARRAY:
+            count, = self.unpack('<I')
+            return [self.read_variant() for _ in range(count)]
+        if code == VARIANT_DICTIONARY:
+            count, = self.unpack('<I')
+            dictionary = collections.OrderedDict()
+            for _ in range(count & 0x7FFFFFFF):
+                key = self.read_variant()
+                dictionary[key] = self.read_variant()
+            return dictionary
+        for name, (math_code, count) in MATH_TYPES.items():
+            if code == math_code:
+                return GodotValue(name, list(self.unpack(
+                    '<{}f'.format(count))))
+        for name, (pool_code, dtype, components) in POOL_TYPES.items():
+            if code == pool_code:
+                count, = self.unpack('<I')
+                size = count * components * numpy.dtype(dtype).itemsize
+                array = numpy.frombuffer(
+                    self.data, dtype=dtype, count=count * components,
+                    offset=self.pos)
+                self.pos += size + (-size % 4)
+                return GodotValue(name, array.astype(
+                    numpy.int64 if dtype[1] in 'iu' else numpy.float64))
+        if code == VARIANT_STRING_ARRAY:
+            count, = self.unpack('<I')
+            return GodotValue('PoolStringArray',
+                              [self.read_string() for _ in range(count)])
+        if code == VARIANT_NODE_PATH:
+            name_count, subname_count = self.unpack('<HH')
+            is_absolute = subname_count & 0x8000
+            subname_count &= 0x7FFF
+            names = [self.strings[self.unpack('<I')[0]]
+                     for _ in range(name_count)]
+            subnames = [self.strings[self.unpack('<I')[0]]
+                        for _ in range(subname_count)]
+            path = ('/' if is_absolute else '') + '/'.join(names)
+            if subnames:
+                path += ':' + ':'.join(subnames)
+            return GodotValue('NodePath', [path])
+        if code == VARIANT_OBJECT:
+            kind, = self.unpack('<I')
+            if kind == OBJECT_EMPTY:
+                return None
+            index, = self.unpack('<I')
+            if kind == OBJECT_INTERNAL_RESOURCE:
+                return GodotValue('SubResource', [index])
+            return GodotValue('ExtResource', [self.external_ids[index]])
+        raise ValueError("Unknown variant type {}".format(code))
+
+    def read_entries(self):
+        """Read the file into entries like the ones written"""
+        # pylint: disable-msg=too-many-locals
+        if self.data[:4] != b'RSRC':
+            raise ValueError("Not a binary resource file")
+        self.pos = 4
+        self.unpack('<IIIII')
+        main_type = self.read_string()
+        self.unpack('<Q14I')
+
+        string_count, = self.unpack('<I')
+        self.strings = [self.read_string() for _ in range(string_count)]
+
+        external = list()
+        external_count, = self.unpack('<I')
+        for index in range(external_count):
+            resource_type = self.read_string()
+            path = self.read_string()
+            external.append(ParsedEntry('ext_resource', (
+                ('id', index + 1), ('path', path), ('type', resource_type))))
+        self.external_ids = [index + 1 for index in range(external_count)]
+
+        internal_count, = self.unpack('<I')
+        table = [(self.read_string(), self.unpack('<Q')[0])
+                 for _ in range(internal_count)]
+
+        resources = list()
+        for path, offset in table:
+            self.pos = offset
+            resource_type = self.read_string()
+            property_count, = self.unpack('<I')
+            properties = list()
+            for _ in range(property_count):
+                name = self.strings[self.unpack('<I')[0]]
+                properties.append((name, self.read_variant()))
+            resources.append((path, resource_type, properties))
+
+        entries = list()
+        *sub_resources, (_, _, main_properties) = resources
+        if main_type == 'PackedScene':
+            entries.append(ParsedEntry('gd_scene', (
+                ('load_steps', internal_count + external_count),
+                ('format', 2))))
+        else:
+            entries.append(ParsedEntry('gd_resource', (
+                ('type', main_type),
+                ('load_steps', internal_count + external_count),
+                ('format', 2))))
+        entries.extend(external)
+        for path, resource_type, properties in sub_resources:
+            entries.append(ParsedEntry('sub_resource', (
+                ('id', int(path[len('local://'):])),
+                ('type', resource_type)), properties))
+        if main_type == 'PackedScene':
+            entries.extend(unbundle_scene(dict(main_properties)['_bundled']))
+        else:
+            entries.append(ParsedEntry('resource', (), main_properties))
+        return entries
+
+
+def unbundle_scene(bundle):
+    """Node entries of the _bundled dictionary of a PackedScene"""
+    # pylint: disable-msg=too-many-locals
+    names = bundle['names'].args
+    variants = bundle['variants']
+    packed = bundle['nodes'].args.tolist()
+    nodes = list()
+    paths = list()
+    pos = 0
+    for _ in range(bundle['node_count']):
+        parent, _, node_type, name, instance, count = packed[pos:pos + 6]
+        pos += 6
+        heading = collections.OrderedDict()
+        if parent < 0 or parent == NO_PARENT_SAVED:
+            heading['type'] = names[node_type]
+            heading['name'] = names[name]
+            paths.append('.')
+        else:
+            heading['name'] = names[name]
+            if node_type != TYPE_INSTANCED:
+                heading['type'] = names[node_type]
+            heading['parent'] = paths[parent]
+            paths.append(names[name] if paths[parent] == '.'
+                         else paths[parent] + '/' + names[name])
+        if instance >= 0:
+            heading['instance'] = variants[instance]
+        properties = list()
+        for index in range(count):
+            key, value = packed[pos + 2 * index:pos + 2 * index + 2]
+            properties.append((names[key], variants[value]))
+        pos += 2 * count
+        group_count = packed[pos]
+        if group_count:
+            heading['groups'] = [
+                names[group] for group in packed[pos + 1:pos + 1 + group_count]
+            ]
+        pos += 1 + group_count
+        nodes.append(ParsedEntry('node', heading, properties))
+    return nodes
+
+
+def read_binary_file(path):
+    """Read a binary resource file into a list of ParsedEntry"""
+    with open(path, 'rb') as in_file:
+        return BinaryResourceReader(in_file.read()).read_entries()
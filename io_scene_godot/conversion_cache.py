@@ -0,0 +1,34 @@
+"""Conversion results shared by the files exported in one invocation, when
+every scene or every collection is exported to its own file: a mesh, a
+shader or a texture used by several of the files is converted once. The
+cache is passed to the converters in the export settings, under the
+'conversion_cache' key"""
+import os
+
+
+class ConversionCache:
+    """Converted data, by the blender data it comes from"""
+
+    def __init__(self):
+        # MeshResourceKey -> (ArrayMeshResource, {surface id: blender
+        # material}), None for meshes without faces
+        self.meshes = dict()
+        # shader node tree -> ScriptShader
+        self.shaders = dict()
+        # (image, path) of the texture files already written
+        self.texture_files = set()
+        # searched folder -> .tres file name -> paths
+        self._material_files = dict()
+
+    def material_files(self, folder):
+        """Paths of the .tres files found under a folder, by file name, in
+        the order os.walk finds them. The folder is walked once"""
+        if folder not in self._material_files:
+            index = dict()
+            for dir_path, _subdirs, files in os.walk(folder):
+                for file_name in files:
+                    if file_name.endswith('.tres'):
+                        index.setdefault(file_name, list()).append(
+                            os.path.join(dir_path, file_name))
+            self._material_files[folder] = index
+        return self._material_files[folder]
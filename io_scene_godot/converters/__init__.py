@@ -19,11 +19,20 @@ from .simple_nodes import *  # pylint: disable=wildcard-import
 from .mesh import export_mesh_node
 from .physics import export_physics_properties
 from .armature import export_armature_node, export_bone_attachment
-from .animation import export_animation_data
-from .multimesh import export_multimesh_node, has_particle
+from .animation import (
+    export_animation_data,
+    bake_constrained_objects,
+    reduce_animation_keyframes,
+    optimize_animation_tracks,
+    deduplicate_animations,
+)
+from .subtree import find_repeated_subtrees
+from .multimesh import (
+    export_multimesh_node, has_particle, find_instance_groups,
+    export_instance_multimesh_node)
 
-# TODO: What about Empties which refer to group instances? (in 2.8 Collection
-# Instances)
+# Empties instancing a collection are exported by export_empty_node, as
+# instances of a scene the collection is exported to
 BLENDER_TYPE_TO_EXPORTER = {
     "MESH": export_mesh_node,
     "ARMATURE": export_armature_node,
@@ -41,3 +50,7 @@ BONE_ATTACHMENT_EXPORTER = export_bone_attachment
 ANIMATION_DATA_EXPORTER = export_animation_data
 
 MULTIMESH_EXPORTER = export_multimesh_node
+
+INSTANCE_MULTIMESH_EXPORTER = export_instance_multimesh_node
+
+SCENE_INSTANCE_EXPORTER = export_scene_instance_node
@@ -1,4 +1,7 @@
 """Convert blender animation_data to godot AnimationPlayer"""
 
-from .animation_data import export_animation_data
+from .animation_data import export_animation_data, bake_constrained_objects
 from .action import AttributeConvertInfo
+from .serializer import (
+    reduce_animation_keyframes, optimize_animation_tracks,
+    deduplicate_animations)
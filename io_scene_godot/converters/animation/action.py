@@ -5,11 +5,14 @@ import re
 import collections
 import logging
 import math
-import copy
 import bpy
 import mathutils
-from .serializer import FloatTrack, TransformTrack, ColorTrack, TransformFrame
-from .constraint_baking import check_object_constraint
+import numpy
+from .serializer import FloatTrack, TransformTrack, ColorTrack, TransformFrames
+from .fcurve_sampler import (
+    sample_fcurve, sampling_frames, adaptive_frames)
+from .constraint_baking import (
+    check_object_constraint, sample_constrained_frames)
 from ...structures import (NodePath, fix_bone_attachment_location)
 
 
@@ -37,9 +40,12 @@ class ActionStrip:
     """Abstract of blender action strip, it may override attributes
     of an action object"""
 
-    def __init__(self, action_or_strip):
+    def __init__(self, action_or_strip, export_settings=None):
         self.action = None
         self.frame_range = (0, 0)
+        self.sampling = 'FRAMES'
+        self.adaptive_tolerance = 0.0
+        self.use_keyframe_exact = False
 
         # blender strip does a linear transformation to its
         # wrapped action frame range, so we need a k, b
@@ -62,10 +68,57 @@ class ActionStrip:
         else:  # action_or_strip is None
             self.frame_range = (0, 190)
 
-    def evaluate_fcurve(self, fcurve, frame):
-        """Evaluate a value of fcurve, DO NOT use fcurve.evalute, as
-        action may wrapped inside an action strip"""
-        return fcurve.evaluate(self._fk * frame + self._fb)
+        # frames at which the fcurves are sampled
+        sample_step = 1
+        if export_settings is not None:
+            self.sampling = export_settings['animation_sampling']
+            self.adaptive_tolerance = export_settings[
+                'animation_adaptive_tolerance']
+            self.use_keyframe_exact = export_settings[
+                'use_keyframe_exact_tracks']
+            if self.sampling in ('STRIDE', 'ADAPTIVE'):
+                sample_step = export_settings['animation_sample_stride']
+            elif self.sampling == 'RATE':
+                sample_step = (bpy.context.scene.render.fps /
+                               export_settings['animation_sample_rate'])
+        self.frames = sampling_frames(self.frame_range, sample_step)
+
+    def sample_fcurve(self, fcurve, frames=None):
+        """Evaluate fcurve at the given frames, by default at the sampling
+        frames of the strip, return a list of values"""
+        if frames is None:
+            frames = self.frames
+        return self._sample(fcurve, frames).tolist()
+
+    def _sample(self, fcurve, frames):
+        """sample_fcurve returning a numpy array"""
+        frames = numpy.array(frames, dtype=numpy.float64)
+        return sample_fcurve(fcurve, self._fk * frames + self._fb)
+
+    def sampling_frames(self, fcurves):
+        """Frames at which a group of fcurves animating the same property
+        are sampled, they get the same frames so that their values can be
+        combined. In adaptive sampling the frames are refined where one of
+        the fcurves needs it"""
+        if self.sampling != 'ADAPTIVE' or not fcurves:
+            return self.frames
+        return adaptive_frames(
+            lambda frames: numpy.array([
+                self._sample(fcurve, frames) for fcurve in fcurves]),
+            self.frames, self.adaptive_tolerance)
+
+    def keyframe_exact_frames(self, fcurves):
+        """Frames at which keys reproduce a group of fcurves exactly, see
+        keyframe_exact_frames. Return None if keyframe exact tracks are
+        not enabled or the fcurves need to be sampled"""
+        if not self.use_keyframe_exact:
+            return None
+        return keyframe_exact_frames(fcurves, self)
+
+    def keyframe_to_frame(self, keyframe_time):
+        """Inverse of the time mapping of sample_fcurve, return the frame
+        at which the fcurve reaches a keyframe time"""
+        return (keyframe_time - self._fb) / self._fk
 
     def evalute_keyframe(self, keyframe):
         """Evaluate a key frame point and return the point in tuple,
@@ -103,12 +156,14 @@ def has_obj_fcurves(action_strip):
     return False
 
 
-# pylint: disable-msg=too-many-locals
+# pylint: disable-msg=too-many-locals,too-many-arguments
 def export_constrained_xform_action(godot_node, export_settings,
                                     blender_object, action_strip,
-                                    anim_rsc):
+                                    anim_rsc, baked_frames=None):
     """Export transform animation of any object has constraints,
-    it use frame_set to traversal each frame, so it's costly"""
+    it use frame_set to traversal each frame, so it's costly. If the
+    frames were already sampled by a ConstraintBaker, `baked_frames` holds
+    the object matrices and pose bone matrices of each frame"""
     def build_pbone_parent_map(godot_node, blender_object):
         pose_bone_parent_map = dict()
         for pbone in blender_object.pose.bones:
@@ -120,45 +175,39 @@ def export_constrained_xform_action(godot_node, export_settings,
             pose_bone_parent_map[pbone.name] = pbone_parent
         return pose_bone_parent_map
 
-    first_frame, last_frame = action_strip.frame_range
+    frames = action_strip.frames
 
-    obj_xform_mats = list()
     pbone_xform_mats = collections.OrderedDict()
 
-    scene = bpy.context.scene
-    frame_backup = scene.frame_current
-
     has_pbone_actions = (godot_node.get_type() == 'Skeleton' and
                          blender_object.pose is not None)
+
+    if baked_frames is None:
+        baked_frames = sample_constrained_frames(blender_object, frames)
+    obj_xform_mats, pose_mats_list = baked_frames
+
     if has_pbone_actions:
         pbone_parent_map = build_pbone_parent_map(godot_node, blender_object)
-
-    for frame in range(first_frame, last_frame):
-        scene.frame_set(frame)
-        obj_xform_mats.append(blender_object.matrix_local.copy())
-        if has_pbone_actions:
+        for pose_mats in pose_mats_list:
             for pbone in blender_object.pose.bones:
                 pbone_parent = pbone_parent_map[pbone.name]
                 if pbone_parent is None:
                     bone_space_xform = (
-                        pbone.bone.matrix_local.inverted_safe() @ pbone.matrix)
+                        pbone.bone.matrix_local.inverted_safe() @
+                        pose_mats[pbone.name])
                 else:
                     bone_space_xform = (
                         godot_node.find_bone_rest(pbone.name).inverted_safe() @
-                        pbone_parent.matrix.inverted_safe() @
-                        pbone.matrix)
+                        pose_mats[pbone_parent.name].inverted_safe() @
+                        pose_mats[pbone.name])
 
                 if pbone.name not in pbone_xform_mats:
                     pbone_xform_mats[pbone.name] = list()
                 pbone_xform_mats[pbone.name].append(bone_space_xform)
-    scene.frame_set(frame_backup)
 
     if (check_object_constraint(blender_object) or
             has_obj_fcurves(action_strip)):
-        xform_frames_list = [
-            TransformFrame.factory(mat)
-            for mat in obj_xform_mats
-        ]
+        xform_frames_list = TransformFrames.factory(obj_xform_mats)
 
         track_path = NodePath(
             anim_rsc.anim_player.parent.get_path(),
@@ -166,24 +215,20 @@ def export_constrained_xform_action(godot_node, export_settings,
         )
 
         if godot_node.parent.get_type() == 'BoneAttachment':
-            xform_frames_list = [
-                fix_bone_attachment_location(blender_object, x.location)
-                for x in xform_frames_list
-            ]
+            xform_frames_list.translate(fix_bone_attachment_location(
+                blender_object, (0.0, 0.0, 0.0)))
 
         anim_rsc.add_obj_xform_track(
             godot_node.get_type(), track_path,
-            xform_frames_list, action_strip.frame_range,
+            xform_frames_list, frames,
             # no need for parent_inverse, as it is directly access matrix_local
         )
 
     if has_pbone_actions:
         for pbone_name, pbone_xform_mat_list in pbone_xform_mats.items():
             if godot_node.find_bone_id(pbone_name) != -1:
-                pbone_xform_frames_list = [
-                    TransformFrame.factory(mat)
-                    for mat in pbone_xform_mat_list
-                ]
+                pbone_xform_frames_list = TransformFrames.factory(
+                    pbone_xform_mat_list)
 
                 track_path = NodePath(
                     anim_rsc.anim_player.parent.get_path(),
@@ -194,18 +239,59 @@ def export_constrained_xform_action(godot_node, export_settings,
                 anim_rsc.add_track(
                     TransformTrack(
                         track_path,
-                        frames_iter=range(first_frame, last_frame),
+                        frames_iter=frames,
                         values_iter=pbone_xform_frames_list,
                     )
                 )
 
 
+def keyframe_exact_frames(fcurves, action_strip):
+    """Frames at which keys reproduce a group of LINEAR and CONSTANT
+    fcurves exactly once linearly interpolated: the keyframes, plus the
+    frame before the next keyframe for CONSTANT segments, and the ends of
+    the frame range. Return None if the fcurves need a key on every frame"""
+    first_frame, last_frame = action_strip.frame_range
+    frames = {first_frame, last_frame - 1}
+    for fcurve in fcurves:
+        if fcurve.modifiers or not fcurve.keyframe_points:
+            return None
+        prev_interpolation = None
+        for keyframe in fcurve.keyframe_points:
+            if keyframe.interpolation not in ('LINEAR', 'CONSTANT'):
+                return None
+            frame = action_strip.keyframe_to_frame(keyframe.co[0])
+            if abs(frame - round(frame)) > 1e-4:
+                # keys are on whole frames
+                return None
+            frame = int(round(frame))
+            frames.add(frame)
+            if prev_interpolation == 'CONSTANT':
+                # hold the value up to the keyframe ending the segment
+                frames.add(frame - 1)
+            prev_interpolation = keyframe.interpolation
+    return sorted(frame for frame in frames
+                  if first_frame <= frame < last_frame)
+
+
+def is_slerp_exact(xform_frames):
+    """Check whether Godot slerping the rotation between consecutive keys
+    gives the rotation of the linearly interpolated fcurves. It holds if
+    the quaternion is not animated, or if only one euler axis changes
+    between two keys (by less than half a turn)"""
+    if xform_frames.rotation_mode == 'QUATERNION':
+        quats = xform_frames.data[:, 3:7]
+        return bool((quats == quats[:1]).all())
+    deltas = numpy.abs(numpy.diff(xform_frames.rotation_euler, axis=0))
+    return bool(((deltas > 0.0).sum(axis=1) <= 1).all() and
+                (deltas < math.pi).all())
+
+
 def export_transform_action(godot_node, export_settings, blender_object,
                             action_strip, anim_rsc):
     """Export a action with bone and object transform"""
-    def init_transform_frames_list(object_path, blender_object, godot_node,
-                                   first_frame, last_frame):
-        """Initialize a list of TransformFrame for an animated object"""
+    # pylint: disable-msg=too-many-branches
+    def init_transform_frame(object_path, blender_object, godot_node):
+        """Initialize a one frame TransformFrames for an animated object"""
         if object_path.startswith('pose'):
             bone_name = blender_path_to_bone_name(object_path)
 
@@ -226,53 +312,68 @@ def export_transform_action(godot_node, export_settings, blender_object,
                 blender_object.pose.bones.find(bone_name)
             ]
 
-            default_frame = TransformFrame.factory(
-                pose_bone.matrix_basis,
+            return TransformFrames.factory(
+                [pose_bone.matrix_basis],
                 pose_bone.rotation_mode
             )
-        else:
-            # the fcurve location is matrix_basis.to_translation()
-            default_frame = TransformFrame.factory(
-                blender_object.matrix_basis,
-                blender_object.rotation_mode
-            )
+        # the fcurve location is matrix_basis.to_translation()
+        return TransformFrames.factory(
+            [blender_object.matrix_basis],
+            blender_object.rotation_mode
+        )
 
-        return [
-            copy.deepcopy(default_frame)
-            for _ in range(last_frame - first_frame)
-        ]
+    def sample_transform_frames(default_frame, fcurves, frames):
+        """Evaluate the transform fcurves of an object at the frames"""
+        frame_values = default_frame.repeat(len(frames))
+        for attribute, fcurve in fcurves:
+            frame_values.update(
+                attribute, fcurve.array_index,
+                action_strip.sample_fcurve(fcurve, frames)
+            )
+        return frame_values
 
     first_frame, last_frame = action_strip.frame_range
-    xform_frames_list_map = collections.OrderedDict()
+    # fcurve data are seperated into different channels,
+    # for example a transform action would have several fcurves
+    # (location.x, location.y, rotation.x ...), so here fcurves
+    # are aggregated to object before being evaluted
+    fcurves_map = collections.OrderedDict()
     for fcurve in action_strip.action.fcurves:
-        # fcurve data are seperated into different channels,
-        # for example a transform action would have several fcurves
-        # (location.x, location.y, rotation.x ...), so here fcurves
-        # are aggregated to object while being evaluted
         object_path, attribute = split_fcurve_data_path(fcurve.data_path)
+        if attribute in TransformFrames.ATTRIBUTES:
+            if object_path not in fcurves_map:
+                fcurves_map[object_path] = list()
+            fcurves_map[object_path].append((attribute, fcurve))
 
-        if attribute in TransformFrame.ATTRIBUTES:
-            if object_path not in xform_frames_list_map:
-
-                frame_values = init_transform_frames_list(
-                    object_path, blender_object,
-                    godot_node, first_frame, last_frame
-                )
-
-                # unsuccessfully initialize frames, then skip this fcurve
-                if not frame_values:
-                    continue
-
-                xform_frames_list_map[object_path] = frame_values
-
-            for frame in range(first_frame, last_frame):
-                xform_frames_list_map[object_path][frame - first_frame].update(
-                    attribute,
-                    fcurve.array_index,
-                    action_strip.evaluate_fcurve(fcurve, frame)
-                )
-
-    for object_path, frame_value_list in xform_frames_list_map.items():
+    xform_frames_list_map = collections.OrderedDict()
+    for object_path, fcurves in fcurves_map.items():
+        default_frame = init_transform_frame(
+            object_path, blender_object, godot_node)
+        # unsuccessfully initialize frames, then skip these fcurves
+        if default_frame is None or first_frame >= last_frame:
+            continue
+
+        frames = None
+        if export_settings['use_keyframe_exact_tracks']:
+            # keys only where the fcurves have some, if interpolating
+            # them gives the same transforms as sampling every frame
+            frames = keyframe_exact_frames(
+                [fcurve for _, fcurve in fcurves], action_strip)
+            if frames is not None:
+                frame_values = sample_transform_frames(
+                    default_frame, fcurves, frames)
+                if not is_slerp_exact(frame_values):
+                    frames = None
+        if frames is None:
+            frames = action_strip.sampling_frames(
+                [fcurve for _, fcurve in fcurves])
+            frame_values = sample_transform_frames(
+                default_frame, fcurves, frames)
+
+        xform_frames_list_map[object_path] = (frames, frame_values)
+
+    for object_path, (frames, frame_value_list) in (
+            xform_frames_list_map.items()):
         if object_path == '':
             # empty object_path represents transform of object itself
             track_path = NodePath(
@@ -281,14 +382,12 @@ def export_transform_action(godot_node, export_settings, blender_object,
             )
 
             if godot_node.parent.get_type() == 'BoneAttachment':
-                frame_value_list = [
-                    fix_bone_attachment_location(blender_object, x.location)
-                    for x in frame_value_list
-                ]
+                frame_value_list.translate(fix_bone_attachment_location(
+                    blender_object, (0.0, 0.0, 0.0)))
 
             anim_rsc.add_obj_xform_track(
                 godot_node.get_type(), track_path,
-                frame_value_list, action_strip.frame_range,
+                frame_value_list, frames,
                 blender_object.matrix_parent_inverse
             )
 
@@ -303,7 +402,7 @@ def export_transform_action(godot_node, export_settings, blender_object,
             anim_rsc.add_track(
                 TransformTrack(
                     track_path,
-                    frames_iter=range(first_frame, last_frame),
+                    frames_iter=frames,
                     values_iter=frame_value_list,
                 )
             )
@@ -385,23 +484,25 @@ def export_light_action(light_node, export_settings, blender_lamp,
     else:
         # color tracks is not one-one mapping to fcurve, they
         # need to be treated like transform track
-        color_frame_values_map = collections.OrderedDict()
-
-        first_frame, last_frame = action_strip.frame_range
+        color_fcurves_map = collections.OrderedDict()
         for fcurve in fcurves:
             _, attribute = split_fcurve_data_path(fcurve.data_path)
-
             if attribute in ('color', 'shadow_color'):
-                if attribute not in color_frame_values_map:
-                    color_frame_values_map[attribute] = [
-                        mathutils.Color()
-                        for _ in range(first_frame, last_frame)
-                    ]
-                color_list = color_frame_values_map[attribute]
-                for frame in range(first_frame, last_frame):
-                    color_list[frame - first_frame][fcurve.array_index] = (
-                        action_strip.evaluate_fcurve(fcurve, frame)
-                    )
+                if attribute not in color_fcurves_map:
+                    color_fcurves_map[attribute] = list()
+                color_fcurves_map[attribute].append(fcurve)
+
+        color_frame_values_map = collections.OrderedDict()
+        color_frames_map = dict()
+        for attribute, color_fcurves in color_fcurves_map.items():
+            frames = action_strip.sampling_frames(color_fcurves)
+            color_frames_map[attribute] = frames
+            color_list = [mathutils.Color() for _ in frames]
+            color_frame_values_map[attribute] = color_list
+            for fcurve in color_fcurves:
+                values = action_strip.sample_fcurve(fcurve, frames)
+                for index, value in enumerate(values):
+                    color_list[index][fcurve.array_index] = value
 
         for bl_attr, _, converter in light_node.attribute_conversion:
             if (bl_attr in ('color', 'shadow_color') and
@@ -419,7 +520,7 @@ def export_light_action(light_node, export_settings, blender_lamp,
             anim_rsc.add_track(
                 ColorTrack(
                     track_path,
-                    frames_iter=range(first_frame, last_frame),
+                    frames_iter=color_frames_map[attribute],
                     values_iter=frame_value_list
                 )
             )
@@ -428,7 +529,6 @@ def export_light_action(light_node, export_settings, blender_lamp,
 def export_camera_action(camera_node, export_settings, blender_cam,
                          action_strip, anim_rsc):
     """Export camera action"""
-    first_frame, last_frame = action_strip.frame_range
     base_node_path = NodePath(
         anim_rsc.anim_player.parent.get_path(), camera_node.get_path()
     )
@@ -458,28 +558,24 @@ def export_camera_action(camera_node, export_settings, blender_cam,
     sensor_size_list = list()
 
     lens_fcurve = fcurves.find('lens')
+    sensor_width_fcurve = fcurves.find('sensor_width')
+    frames = action_strip.sampling_frames(
+        [fcurve for fcurve in (lens_fcurve, sensor_width_fcurve)
+         if fcurve is not None])
     if lens_fcurve is not None:
         fov_animated = True
-        for frame in range(first_frame, last_frame):
-            focal_len_list.append(
-                action_strip.evaluate_fcurve(lens_fcurve, frame)
-            )
-    sensor_width_fcurve = fcurves.find('sensor_width')
+        focal_len_list = action_strip.sample_fcurve(lens_fcurve, frames)
     if sensor_width_fcurve is not None:
         fov_animated = True
-        for frame in range(first_frame, last_frame):
-            sensor_size_list.append(
-                action_strip.evaluate_fcurve(sensor_width_fcurve, frame)
-            )
+        sensor_size_list = action_strip.sample_fcurve(
+            sensor_width_fcurve, frames)
 
     if fov_animated:
         # export fov track
         if not focal_len_list:
-            focal_len_list = [blender_cam.lens
-                              for _ in range(first_frame, last_frame)]
+            focal_len_list = [blender_cam.lens for _ in frames]
         if not sensor_size_list:
-            sensor_size_list = [blender_cam.sensor_width
-                                for _ in range(first_frame, last_frame)]
+            sensor_size_list = [blender_cam.sensor_width for _ in frames]
 
         fov_list = list()
         for index, flen in enumerate(focal_len_list):
@@ -492,7 +588,7 @@ def export_camera_action(camera_node, export_settings, blender_cam,
         anim_rsc.add_track(
             FloatTrack(
                 base_node_path.new_copy('fov'),
-                frames_iter=range(first_frame, last_frame),
+                frames_iter=frames,
                 values_iter=fov_list
             )
         )
@@ -2,6 +2,7 @@
 AnimationPlayer as well as distribute Blender action into various
 action exporting functions"""
 
+import functools
 import bpy
 import mathutils
 from .action import (
@@ -11,10 +12,7 @@ from .action import (
     export_constrained_xform_action,
     export_transform_action
 )
-from .constraint_baking import (
-    check_object_constraint,
-    check_pose_constraint,
-)
+from .constraint_baking import ConstraintBaker, need_baking
 from .serializer import get_animation_player
 from .action import ActionStrip
 
@@ -54,17 +52,7 @@ class ObjectAnimationExporter:
         """Check whether the animated object has any constraint and
         thus need to do baking, if needs, some states would be set"""
         if action_type == 'transform':
-            has_obj_cst = check_object_constraint(self.blender_object)
-            has_pose_cst = check_pose_constraint(self.blender_object)
-            has_non_inherit_bone = False
-            if isinstance(self.blender_object.data, bpy.types.Armature):
-                for rbone in self.blender_object.data.bones:
-                    if (rbone.use_inherit_rotation is False or
-                            rbone.use_inherit_scale is False):
-                        has_non_inherit_bone = True
-                        break
-            self.need_baking = (
-                has_obj_cst or has_pose_cst or has_non_inherit_bone)
+            self.need_baking = need_baking(self.blender_object)
 
     def preprocess_nla_tracks(self, blender_object):
         """Iterative through nla tracks, separately store mute and unmuted
@@ -95,11 +83,22 @@ class ObjectAnimationExporter:
                 escn_file, anim_rsc_name
             )
 
-        self.action_exporter_func(
+        action_strip = ActionStrip(active_action, export_settings)
+        exporter_func = self.action_exporter_func
+        baker = export_settings.get('constraint_baker')
+        if self.need_baking and baker is not None:
+            # use the frames sampled in the scene wide sweep
+            baked_frames = baker.get_frames(
+                self.blender_object, action_strip.frames)
+            if baked_frames is not None:
+                exporter_func = functools.partial(
+                    exporter_func, baked_frames=baked_frames)
+
+        exporter_func(
             self.godot_node,
             export_settings,
             self.blender_object,
-            ActionStrip(active_action),
+            action_strip,
             self.animation_player.active_animation
         )
         self.clear_action_effect()
@@ -115,7 +114,7 @@ class ObjectAnimationExporter:
                             self.godot_node,
                             export_settings,
                             self.blender_object,
-                            ActionStrip(strip),
+                            ActionStrip(strip, export_settings),
                             self.animation_player.active_animation
                         )
                         self.clear_action_effect()
@@ -135,7 +134,7 @@ class ObjectAnimationExporter:
                         self.godot_node,
                         export_settings,
                         self.blender_object,
-                        ActionStrip(strip),
+                        ActionStrip(strip, export_settings),
                         self.animation_player.active_animation
                     )
                     self.clear_action_effect()
@@ -167,7 +166,7 @@ class ObjectAnimationExporter:
                     self.godot_node,
                     export_settings,
                     self.blender_object,
-                    ActionStrip(strip),
+                    ActionStrip(strip, export_settings),
                     anim_resource
                 )
                 self.clear_action_effect()
@@ -183,7 +182,7 @@ class ObjectAnimationExporter:
                             self.godot_node,
                             export_settings,
                             self.blender_object,
-                            ActionStrip(strip),
+                            ActionStrip(strip, export_settings),
                             anim_resource
                         )
                         self.clear_action_effect()
@@ -197,6 +196,24 @@ class ObjectAnimationExporter:
                 pose_bone.matrix_basis = mathutils.Matrix.Identity(4)
 
 
+def bake_constrained_objects(export_settings, blender_objects):
+    """Sample the active action of all the objects needing baking in a
+    single sweep of the timeline, return the ConstraintBaker holding the
+    samples for export_animation_data"""
+    baker = ConstraintBaker()
+    if export_settings['use_export_animation']:
+        for blender_object in blender_objects:
+            if need_baking(blender_object):
+                active_action = None
+                if blender_object.animation_data:
+                    active_action = blender_object.animation_data.action
+                baker.add_object(
+                    blender_object,
+                    ActionStrip(active_action, export_settings).frames)
+        baker.bake()
+    return baker
+
+
 def export_animation_data(escn_file, export_settings, godot_node,
                           blender_object, action_type):
     """Export the action and nla_tracks in blender_object.animation_data,
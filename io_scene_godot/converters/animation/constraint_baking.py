@@ -1,5 +1,8 @@
 """Collection of helper functions to baking constraints into action"""
+import math
 import bpy
+import numpy
+import mathutils
 
 
 def check_object_constraint(blender_object):
@@ -17,3 +20,97 @@ def check_pose_constraint(blender_object):
             if pose_bone.constraints:
                 return True
     return False
+
+
+def check_non_inherit_bone(blender_object):
+    """Return bool indicate if armature has bones not inheriting the
+    rotation or scale of their parent"""
+    if isinstance(blender_object.data, bpy.types.Armature):
+        for rbone in blender_object.data.bones:
+            if (rbone.use_inherit_rotation is False or
+                    rbone.use_inherit_scale is False):
+                return True
+    return False
+
+
+def need_baking(blender_object):
+    """Return bool indicate if the transform animation of object has to be
+    baked frame by frame"""
+    return (check_object_constraint(blender_object) or
+            check_pose_constraint(blender_object) or
+            check_non_inherit_bone(blender_object))
+
+
+def read_pose_matrices(blender_object):
+    """Armature space matrices of all the pose bones of an object at the
+    current frame, as a dict keyed by bone name"""
+    pose_bones = blender_object.pose.bones
+    buffer = numpy.empty(len(pose_bones) * 16, dtype=numpy.float32)
+    pose_bones.foreach_get('matrix', buffer)
+    # matrices are read column by column
+    matrices = buffer.reshape((-1, 4, 4)).transpose((0, 2, 1)).tolist()
+    return {
+        pose_bone.name: mathutils.Matrix(matrix)
+        for pose_bone, matrix in zip(pose_bones, matrices)
+    }
+
+
+def sample_constrained_frames(blender_object, frames):
+    """Step through the frames, return the local matrix of the object and
+    the pose bone matrices (None for non armatures) of each frame"""
+    baker = ConstraintBaker()
+    baker.add_object(blender_object, frames)
+    baker.bake()
+    return baker.get_frames(blender_object, frames)
+
+
+class ConstraintBaker:
+    """Samples all the objects needing baking in a single sweep of the
+    timeline. Setting a frame evaluates the whole scene, so stepping
+    through the frames once for everyone is much cheaper than once for
+    each constrained object"""
+
+    def __init__(self):
+        # object -> sorted frames to sample
+        self.frames = dict()
+        # object -> (object matrices, pose bone matrices)
+        self.samples = dict()
+
+    def add_object(self, blender_object, frames):
+        """Register an object to sample at the given sorted frames"""
+        self.frames[blender_object] = list(frames)
+
+    def bake(self):
+        """Step through the union of the frames once"""
+        if not self.frames:
+            return
+
+        sampled_objects = dict()
+        for blender_object, frames in self.frames.items():
+            has_pose = blender_object.pose is not None
+            self.samples[blender_object] = (
+                list(), list() if has_pose else None)
+            for frame in frames:
+                if frame not in sampled_objects:
+                    sampled_objects[frame] = list()
+                sampled_objects[frame].append(blender_object)
+
+        scene = bpy.context.scene
+        frame_backup = scene.frame_current
+        for frame in sorted(sampled_objects):
+            # fractional frames from resampling go through subframe
+            whole_frame = math.floor(frame)
+            scene.frame_set(whole_frame, subframe=frame - whole_frame)
+            for blender_object in sampled_objects[frame]:
+                obj_mats, pose_mats = self.samples[blender_object]
+                obj_mats.append(blender_object.matrix_local.copy())
+                if pose_mats is not None:
+                    pose_mats.append(read_pose_matrices(blender_object))
+        scene.frame_set(frame_backup)
+
+    def get_frames(self, blender_object, frames):
+        """Samples of an object, None if it was not sampled at exactly
+        these frames"""
+        if self.frames.get(blender_object) != list(frames):
+            return None
+        return self.samples.get(blender_object)
@@ -0,0 +1,216 @@
+"""Vectorized fcurve evaluation. Calling fcurve.evaluate once per frame is
+slow on long actions, here the keyframes are read in bulk and all the
+frames are evaluated at once with numpy, following the keyframe
+interpolation of Blender"""
+import numpy
+
+# interpolations evaluated with numpy, fcurves using any other (the easing
+# equations like BACK or ELASTIC) go through fcurve.evaluate
+INTERPOLATION_CODES = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}
+
+# times closer than this to a keyframe take the keyframe value, same as
+# the binary search threshold of Blender
+KEYFRAME_THRESHOLD = 0.01
+
+# bisection steps solving a bezier segment for its curve parameter, it
+# gets below single precision
+BEZIER_ITERATIONS = 32
+
+
+def _read_points(keyframe_points, attribute):
+    """Bulk read a 2d vector attribute of all the keyframes"""
+    buffer = numpy.empty(len(keyframe_points) * 2, dtype=numpy.float32)
+    keyframe_points.foreach_get(attribute, buffer)
+    return buffer.reshape((-1, 2)).astype(numpy.float64)
+
+
+def can_sample(fcurve):
+    """Return bool indicate if the fcurve can be evaluated by
+    sample_fcurve instead of fcurve.evaluate"""
+    if fcurve.modifiers or not fcurve.keyframe_points:
+        return False
+    return all(keyframe.interpolation in INTERPOLATION_CODES
+               for keyframe in fcurve.keyframe_points)
+
+
+def sample_fcurve(fcurve, times):
+    """Return the values of fcurve at the given times as a numpy array"""
+    times = numpy.asarray(times, dtype=numpy.float64)
+    if not can_sample(fcurve):
+        return numpy.array([fcurve.evaluate(time) for time in times.tolist()])
+
+    keyframe_points = fcurve.keyframe_points
+    interpolations = numpy.array([
+        INTERPOLATION_CODES[keyframe.interpolation]
+        for keyframe in keyframe_points
+    ])
+    return evaluate_keyframes(
+        _read_points(keyframe_points, 'co'),
+        _read_points(keyframe_points, 'handle_left'),
+        _read_points(keyframe_points, 'handle_right'),
+        interpolations,
+        fcurve.extrapolation == 'LINEAR',
+        times
+    )
+
+
+def _bezier_segments(start, start_handle, end_handle, end, times):
+    """Evaluate bezier segments given as (n, 2) arrays of control points,
+    each at its own time"""
+    # handles longer than the segment are scaled down, so that the curve
+    # stays a function of time
+    handle_a = start - start_handle
+    handle_b = end - end_handle
+    handles_len = numpy.abs(handle_a[:, 0]) + numpy.abs(handle_b[:, 0])
+    segment_len = end[:, 0] - start[:, 0]
+    scale = numpy.ones_like(segment_len)
+    too_long = handles_len > segment_len
+    scale[too_long] = segment_len[too_long] / handles_len[too_long]
+    start_handle = start - handle_a * scale[:, None]
+    end_handle = end - handle_b * scale[:, None]
+
+    def cubic(coord, param):
+        inv = 1.0 - param
+        return (inv ** 3 * start[:, coord] +
+                3.0 * inv ** 2 * param * start_handle[:, coord] +
+                3.0 * inv * param ** 2 * end_handle[:, coord] +
+                param ** 3 * end[:, coord])
+
+    low = numpy.zeros_like(times)
+    high = numpy.ones_like(times)
+    for _ in range(BEZIER_ITERATIONS):
+        middle = (low + high) * 0.5
+        below = cubic(0, middle) < times
+        low = numpy.where(below, middle, low)
+        high = numpy.where(below, high, middle)
+    return cubic(1, (low + high) * 0.5)
+
+
+def _extrapolate(key_x, key_y, handles, interpolation, neighbor, times):
+    # pylint: disable-msg=too-many-arguments
+    """Linear extrapolation past the first or last keyframe, `handles` is
+    the outer handle of that keyframe and `neighbor` the position of
+    the keyframe next to it"""
+    if interpolation == INTERPOLATION_CODES['CONSTANT']:
+        return numpy.full_like(times, key_y)
+    if interpolation == INTERPOLATION_CODES['LINEAR']:
+        if neighbor is None:
+            return numpy.full_like(times, key_y)
+        delta_x = key_x - neighbor[0]
+        delta_y = key_y - neighbor[1]
+    else:
+        delta_x = key_x - handles[0]
+        delta_y = key_y - handles[1]
+    if delta_x == 0.0:
+        return numpy.full_like(times, key_y)
+    return key_y + (times - key_x) * (delta_y / delta_x)
+
+
+def evaluate_keyframes(key_points, handle_left, handle_right,
+                       interpolations, linear_extrapolation, times):
+    # pylint: disable-msg=too-many-arguments,too-many-locals
+    """Evaluate a keyframed curve at the times. `key_points`, `handle_left` and
+    `handle_right` are (n, 2) arrays of the keyframes sorted by time,
+    `interpolations` holds their INTERPOLATION_CODES"""
+    key_x, key_y = key_points[:, 0], key_points[:, 1]
+    count = len(key_x)
+    values = numpy.empty_like(times)
+
+    # keyframe starting the segment of each time
+    index = numpy.searchsorted(key_x, times, side='right') - 1
+    before = index < 0
+    after = index >= count - 1
+    inside = ~before & ~after
+
+    seg = index[inside]
+    seg_times = times[inside]
+    kinds = interpolations[seg]
+    seg_values = key_y[seg].copy()
+
+    linear = kinds == INTERPOLATION_CODES['LINEAR']
+    start, end = seg[linear], seg[linear] + 1
+    factor = ((seg_times[linear] - key_x[start]) /
+              (key_x[end] - key_x[start]))
+    seg_values[linear] = key_y[start] + (key_y[end] - key_y[start]) * factor
+
+    bezier = kinds == INTERPOLATION_CODES['BEZIER']
+    start, end = seg[bezier], seg[bezier] + 1
+    seg_values[bezier] = _bezier_segments(
+        key_points[start], handle_right[start], handle_left[end],
+        key_points[end], seg_times[bezier])
+    values[inside] = seg_values
+
+    values[before] = key_y[0]
+    values[after] = key_y[-1]
+    if linear_extrapolation:
+        values[before] = _extrapolate(
+            key_x[0], key_y[0], handle_left[0], interpolations[0],
+            key_points[1] if count > 1 else None, times[before])
+        values[after] = _extrapolate(
+            key_x[-1], key_y[-1], handle_right[-1], interpolations[-1],
+            key_points[-2] if count > 1 else None, times[after])
+
+    # times on a keyframe take its exact value
+    nearest = numpy.clip(numpy.searchsorted(key_x, times), 0, count - 1)
+    previous = numpy.maximum(nearest - 1, 0)
+    nearest = numpy.where(
+        numpy.abs(key_x[previous] - times) < numpy.abs(key_x[nearest] - times),
+        previous, nearest)
+    on_key = numpy.abs(key_x[nearest] - times) < KEYFRAME_THRESHOLD
+    values[on_key] = key_y[nearest[on_key]]
+
+    return values
+
+
+def sampling_frames(frame_range, step):
+    """Frames from the start of [first, last) every `step` frames, the
+    last frame is always sampled. Whole frames are returned as int"""
+    first_frame, last_frame = frame_range
+    if last_frame <= first_frame:
+        return list()
+    if step == 1:
+        return list(range(first_frame, last_frame))
+    frames = numpy.arange(first_frame, last_frame - 1, step).tolist()
+    frames.append(last_frame - 1)
+    return [int(frame) if float(frame).is_integer() else frame
+            for frame in frames]
+
+
+def adaptive_frames(evaluate, frames, tolerance):
+    """Refine coarse sampling frames where the curves are not linear: the
+    middle frame of an interval is added if linearly interpolating the
+    interval ends misses a curve there by more than `tolerance`, then both
+    halves are checked in turn, down to intervals of one frame.
+    `evaluate(frames)` returns the (curves, frames) array of values"""
+    coarse = numpy.asarray(frames, dtype=numpy.float64)
+    if len(coarse) < 2:
+        return list(frames)
+    values = numpy.atleast_2d(evaluate(coarse))
+    starts, ends = coarse[:-1], coarse[1:]
+    start_values, end_values = values[:, :-1], values[:, 1:]
+    added = list()
+    while starts.size:
+        wide = ends - starts >= 2.0
+        starts, ends = starts[wide], ends[wide]
+        start_values, end_values = start_values[:, wide], end_values[:, wide]
+        middles = numpy.floor((starts + ends) * 0.5)
+        if not middles.size:
+            break
+        middle_values = numpy.atleast_2d(evaluate(middles))
+        factors = (middles - starts) / (ends - starts)
+        errors = numpy.abs(
+            start_values + (end_values - start_values) * factors -
+            middle_values).max(axis=0)
+        split = errors > tolerance
+        added.append(middles[split])
+        starts, ends = (
+            numpy.concatenate((starts[split], middles[split])),
+            numpy.concatenate((middles[split], ends[split])))
+        start_values, end_values = (
+            numpy.concatenate((start_values[:, split],
+                               middle_values[:, split]), axis=1),
+            numpy.concatenate((middle_values[:, split],
+                               end_values[:, split]), axis=1))
+    refined = numpy.unique(numpy.concatenate([coarse] + added))
+    return [int(frame) if frame.is_integer() else frame
+            for frame in refined.tolist()]
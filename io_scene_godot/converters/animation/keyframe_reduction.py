@@ -0,0 +1,130 @@
+"""Error bounded keyframe reduction of transform and value tracks. Keys
+are removed Ramer-Douglas-Peucker style: a run of keys is replaced by its
+two ends if the interpolation between them (lerp for location, scale and
+values, slerp for rotation, as Godot does) stays within the tolerances on
+every channel, otherwise it is split at the key with the largest error"""
+import numpy
+
+
+def slerp(quats_a, quats_b, factors):
+    """Row wise spherical interpolation of (n, 4) quaternion arrays, going
+    the shortest way like Godot"""
+    dots = (quats_a * quats_b).sum(axis=1)
+    quats_b = numpy.where(dots[:, None] < 0.0, -quats_b, quats_b)
+    dots = numpy.abs(dots)
+
+    angles = numpy.arccos(numpy.clip(dots, -1.0, 1.0))
+    sines = numpy.sin(angles)
+    # nearly identical rotations fall back to lerp
+    close = sines < 1e-6
+    safe_sines = numpy.where(close, 1.0, sines)
+    weights_a = numpy.where(
+        close, 1.0 - factors, numpy.sin((1.0 - factors) * angles) / safe_sines)
+    weights_b = numpy.where(
+        close, factors, numpy.sin(factors * angles) / safe_sines)
+    return quats_a * weights_a[:, None] + quats_b * weights_b[:, None]
+
+
+def quaternion_angles(quats_a, quats_b):
+    """Row wise rotation angle between two (n, 4) unit quaternion arrays"""
+    dots = numpy.abs((quats_a * quats_b).sum(axis=1))
+    return 2.0 * numpy.arccos(numpy.clip(dots, 0.0, 1.0))
+
+
+def _relative(errors, tolerance):
+    if tolerance <= 0.0:
+        # zero tolerance only accepts (nearly) exact interpolations
+        return numpy.where(errors > 1e-6, numpy.inf, 0.0)
+    return errors / tolerance
+
+
+def _segment_errors(times, keys, first, last, tolerances):
+    """Errors of the keys strictly between first and last when
+    interpolating from first to last, relative to the tolerances (a key is
+    removable if its error is at most 1)"""
+    location_tol, rotation_tol, scale_tol = tolerances
+    inner = slice(first + 1, last)
+    factors = ((times[inner] - times[first]) /
+               (times[last] - times[first]))
+    count = len(factors)
+
+    def lerp(columns):
+        start = keys[first, columns]
+        end = keys[last, columns]
+        return start + (end - start) * factors[:, None]
+
+    location_err = numpy.linalg.norm(
+        lerp(slice(0, 3)) - keys[inner, 0:3], axis=1)
+    scale_err = numpy.abs(lerp(slice(7, 10)) - keys[inner, 7:10]).max(axis=1)
+    rotation_err = quaternion_angles(
+        slerp(numpy.repeat(keys[first:first + 1, 3:7], count, axis=0),
+              numpy.repeat(keys[last:last + 1, 3:7], count, axis=0),
+              factors),
+        keys[inner, 3:7])
+
+    return numpy.maximum.reduce((
+        _relative(location_err, location_tol),
+        _relative(rotation_err, rotation_tol),
+        _relative(scale_err, scale_tol),
+    ))
+
+
+def _value_segment_errors(times, values, first, last, tolerance):
+    """Same as _segment_errors for a (frames, channels) array of values
+    interpolated linearly, the error of a key is the largest one of its
+    channels"""
+    inner = slice(first + 1, last)
+    factors = ((times[inner] - times[first]) /
+               (times[last] - times[first]))
+    interpolated = (values[first] +
+                    (values[last] - values[first]) * factors[:, None])
+    return _relative(
+        numpy.abs(interpolated - values[inner]).max(axis=1), tolerance)
+
+
+def reduce_transform_keys(times, keys, tolerances):
+    """Return a boolean mask of the keys to keep. `keys` is a
+    (frames, 10) array of location, unit quaternion and scale,
+    `tolerances` a tuple of (location distance, rotation angle in radians,
+    scale difference)"""
+    times = numpy.asarray(times, dtype=numpy.float64)
+    return _reduce_keys(
+        len(times),
+        lambda first, last: _segment_errors(
+            times, keys, first, last, tolerances))
+
+
+def reduce_value_keys(times, values, tolerance):
+    """Return a boolean mask of the keys to keep. `values` is a
+    (frames, channels) array, `tolerance` the largest difference of a
+    channel"""
+    times = numpy.asarray(times, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return _reduce_keys(
+        len(times),
+        lambda first, last: _value_segment_errors(
+            times, values, first, last, tolerance))
+
+
+def _reduce_keys(count, segment_errors):
+    """Split the keys until segment_errors(first, last) gives no error
+    above 1 for any segment, return the mask of the keys kept"""
+    keep = numpy.zeros(count, dtype=bool)
+    if count == 0:
+        return keep
+    keep[0] = True
+    keep[-1] = True
+
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        errors = segment_errors(first, last)
+        worst = int(errors.argmax())
+        if errors[worst] > 1.0:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
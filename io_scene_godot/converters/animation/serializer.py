@@ -1,12 +1,17 @@
 """Export animation into Godot scene tree"""
 import collections
+import hashlib
+import os
 import re
 import math
 import logging
 import bpy
 import mathutils
+import numpy
+from .keyframe_reduction import reduce_transform_keys, reduce_value_keys
 from ...structures import (NodeTemplate, NodePath, Array, Map,
-                           InternalResource)
+                           InternalResource, fix_matrix)
+from ...variant import GodotValue, to_variant
 
 NEAREST_INTERPOLATION = 0
 LINEAR_INTERPOLATION = 1
@@ -46,6 +51,27 @@ def strip_adjacent_dup_keyframes(frames, values):
     return stripped_frames, stripped_values
 
 
+def strip_adjacent_dup_mask(rows):
+    """Same as strip_adjacent_dup_keyframes on a (frames, n) array, return
+    a boolean mask of the rows to keep"""
+    length = len(rows)
+    keep = numpy.ones(length, dtype=bool)
+    same_as_prev = numpy.zeros(length, dtype=bool)
+    same_as_prev[1:] = (rows[1:] == rows[:-1]).all(axis=1)
+    same_as_prev = same_as_prev.tolist()
+
+    duplicated = False
+    for index in range(1, length - 1):
+        if not duplicated:
+            if same_as_prev[index]:
+                duplicated = True
+        elif not same_as_prev[index + 1]:
+            duplicated = False
+        else:
+            keep[index] = False
+    return keep
+
+
 class BezierFrame:
     """A keyframe point in a bezier fcurve"""
     def __init__(self, value, left_handle, right_handle):
@@ -54,72 +80,116 @@ class BezierFrame:
         self.right_handle = right_handle
 
 
-class TransformFrame:
-    """A data structure hold transform values of an animation key,
-    it is used as an intermedia data structure, being updated during
-    parsing the fcurve data and finally being converted to a transform
-    matrix."""
+def quaternion_multiply(quats_a, quats_b):
+    """Row wise product of two (n, 4) arrays of (w, x, y, z) quaternions"""
+    w_a, x_a, y_a, z_a = numpy.moveaxis(quats_a, -1, 0)
+    w_b, x_b, y_b, z_b = numpy.moveaxis(quats_b, -1, 0)
+    return numpy.stack((
+        w_a * w_b - x_a * x_b - y_a * y_b - z_a * z_b,
+        w_a * x_b + x_a * w_b + y_a * z_b - z_a * y_b,
+        w_a * y_b - x_a * z_b + y_a * w_b + z_a * x_b,
+        w_a * z_b + x_a * y_b - y_a * x_b + z_a * w_b,
+    ), axis=-1)
+
+
+def euler_to_quaternions(eulers, order):
+    """Convert a (n, 3) array of euler angles with the given axis order
+    (e.g. 'XYZ', the first axis is applied first) to quaternions"""
+    quats = numpy.zeros((len(eulers), 4))
+    quats[:, 0] = 1.0
+    for axis in order:
+        index = 'XYZ'.index(axis)
+        half_angles = eulers[:, index] * 0.5
+        axis_quats = numpy.zeros((len(eulers), 4))
+        axis_quats[:, 0] = numpy.cos(half_angles)
+        axis_quats[:, index + 1] = numpy.sin(half_angles)
+        quats = quaternion_multiply(axis_quats, quats)
+    return quats
+
+
+class TransformFrames:
+    """A data structure hold transform values of consecutive animation
+    keys, it is used as an intermedia data structure, being updated during
+    parsing the fcurve data and finally being converted to transform keys.
+    Values are stored column wise in a (frames, 10) array of location,
+    rotation quaternion (w, x, y, z) and scale, so that a fcurve updates a
+    channel of all the frames at once. Euler rotations are kept in a
+    (frames, 3) array until the quaternions are needed."""
     ATTRIBUTES = {'location', 'scale', 'rotation_quaternion', 'rotation_euler'}
+    COLUMNS = {'location': 0, 'rotation_quaternion': 3, 'scale': 7}
 
-    def __init__(self, rotation_mode='QUATERNION'):
-        self.location = mathutils.Vector((0, 0, 0))
-        self.scale = mathutils.Vector((1, 1, 1))
-
+    def __init__(self, frame_count=0, rotation_mode='QUATERNION'):
         self.rotation_mode = rotation_mode
-        self.rotation_euler = mathutils.Euler((0, 0, 0))
-        self.rotation_quaternion = mathutils.Quaternion((1.0, 0.0, 0.0, 0.0))
-
-    def __eq__(self, other):
-        """Overrides the default implementation"""
-        if isinstance(other, TransformFrame):
-            return (self.get_scale() == other.get_scale() and
-                    self.get_quaternion() == other.get_quaternion() and
-                    self.get_translation() == other.get_translation())
-        return False
+        self.data = numpy.zeros((frame_count, 10))
+        self.data[:, 3] = 1.0
+        self.data[:, 7:10] = 1.0
+        self.rotation_euler = numpy.zeros((frame_count, 3))
+
+    def __len__(self):
+        return len(self.data)
 
     @classmethod
-    def factory(cls, xform_matrix, rotation_mode='QUATERNION'):
-        """Factory method, return an instance created from transform matrix"""
-        xform_frame = cls()
-        xform_frame.rotation_mode = rotation_mode
-        xform_frame.location = xform_matrix.to_translation()
-        xform_frame.rotation_quaternion = xform_matrix.to_quaternion()
-        # FIXME: lose negative scale
-        xform_frame.scale = xform_matrix.to_scale()
-
-        if rotation_mode in ('QUATERNION', 'AXIS_ANGLE'):
-            xform_frame.rotation_euler = xform_matrix.to_euler()
-        else:
-            xform_frame.rotation_euler = xform_matrix.to_euler(rotation_mode)
-        return xform_frame
-
-    def update(self, attribute, array_index, value):
-        """Use fcurve data to update the frame"""
-        if attribute == 'location':
-            self.location[array_index] = value
-        elif attribute == 'scale':
-            self.scale[array_index] = value
-        elif attribute == 'rotation_quaternion':
-            self.rotation_quaternion[array_index] = value
-        elif attribute == 'rotation_euler':
-            self.rotation_euler[array_index] = value
-
-    def get_quaternion(self):
-        """Return the rotation Quaternion"""
+    def factory(cls, xform_matrices, rotation_mode='QUATERNION'):
+        """Factory method, return an instance created from a list of
+        transform matrices"""
+        xform_frames = cls(len(xform_matrices), rotation_mode)
+        data = xform_frames.data
+        for index, xform_matrix in enumerate(xform_matrices):
+            data[index, 0:3] = xform_matrix.to_translation()
+            data[index, 3:7] = xform_matrix.to_quaternion()
+            # FIXME: lose negative scale
+            data[index, 7:10] = xform_matrix.to_scale()
+            if rotation_mode != 'QUATERNION':
+                xform_frames.rotation_euler[index] = xform_matrix.to_euler(
+                    xform_frames.euler_order())
+        return xform_frames
+
+    def repeat(self, frame_count):
+        """Return a new instance holding frame_count copies of the first
+        frame"""
+        xform_frames = TransformFrames(0, self.rotation_mode)
+        xform_frames.data = numpy.repeat(self.data[:1], frame_count, axis=0)
+        xform_frames.rotation_euler = numpy.repeat(
+            self.rotation_euler[:1], frame_count, axis=0)
+        return xform_frames
+
+    def euler_order(self):
+        """Axis order of the euler rotations"""
+        if self.rotation_mode in ('QUATERNION', 'AXIS_ANGLE'):
+            return 'XYZ'
+        return self.rotation_mode
+
+    def update(self, attribute, array_index, values):
+        """Use fcurve data (a value for each frame) to update a channel"""
+        if attribute == 'rotation_euler':
+            self.rotation_euler[:, array_index] = values
+        elif attribute in self.COLUMNS:
+            self.data[:, self.COLUMNS[attribute] + array_index] = values
+
+    def translate(self, offset):
+        """Add an offset vector to the location of all the frames"""
+        self.data[:, 0:3] += offset
+
+    def get_quaternions(self):
+        """Return the rotation quaternions as a (frames, 4) array"""
         if self.rotation_mode == 'QUATERNION':
-            return self.rotation_quaternion
-        return self.rotation_euler.to_quaternion()
+            return self.data[:, 3:7]
+        return euler_to_quaternions(self.rotation_euler, self.euler_order())
 
-    def get_scale(self):
-        """Return a Vector 3d with scale values along axis"""
-        return self.scale
+    def resolved(self):
+        """Return the (frames, 10) array with the euler rotations converted
+        into the quaternion columns"""
+        data = self.data.copy()
+        data[:, 3:7] = self.get_quaternions()
+        return data
 
-    def get_translation(self):
-        """Return a Vector 4d with translation value
-        in homogeneous coordinates"""
-        translation = self.location.copy()
-        translation.resize_4d()
-        return translation
+    @classmethod
+    def from_resolved(cls, data):
+        """Factory method, wrap a (frames, 10) array"""
+        xform_frames = cls(0)
+        xform_frames.data = data
+        xform_frames.rotation_euler = numpy.zeros((len(data), 3))
+        return xform_frames
 
 
 class Track:
@@ -167,85 +237,69 @@ class Track:
         # need to be overrided
         assert False
 
+    def is_constant(self):
+        """Whether all the keys of the track hold the same value"""
+        # bezier tracks and others are kept as they are by default
+        return False
+
+    def matches_node(self, node):
+        """Whether the constant value of the track is the value the
+        node already has in the scene"""
+        # pylint: disable-msg=unused-argument
+        return False
+
+    def first_exported_index(self):
+        """Index of the first key not before scene.frame_start"""
+        scene_frame_start = bpy.context.scene.frame_start
+        for index, frame in enumerate(self.frames):
+            if frame >= scene_frame_start:
+                return index
+        return 0
+
+    def collapse(self):
+        """Reduce a constant track to a single key"""
+        index = self.first_exported_index()
+        self.frames = self.frames[index:index + 1]
+        self.values = self.values[index:index + 1]
+
     def to_string(self):
         """Serialize a track object"""
         return self.convert_to_keys_object().to_string()
 
+    def to_variant(self):
+        """The keys as a variant, for the binary backend"""
+        return to_variant(self.convert_to_keys_object())
+
     def blend(self, track):
-        """Blend current track with another one, used in nla editor"""
+        """Blend current track with another one, used in nla editor. The
+        tracks may be sampled at different frames (strips sampled from
+        their own start), the result has the frames of both"""
         assert self.interp == track.interp
         assert self.type == track.type
 
-        if self.frame_begin() > track.frame_end():
-            self.frames = track.frames + self.frames
-            self.values = track.value + self.values
-        elif self.frame_end() < track.frame_begin():
-            self.frames = self.frames + track.frames
-            self.values = self.values + track.values
-        else:
-            new_frames = list()
-            new_values = list()
-
-            blend_begin = max(self.frame_begin(), track.frame_begin())
-            blend_end = min(self.frame_end(), track.frame_end())
-
-            self_frame_idx = 0
-            track_frame_idx = 0
-            while self.frames[self_frame_idx] != blend_begin:
-                new_frames.append(self.frames[self_frame_idx])
-                new_values.append(self.values[self_frame_idx])
-                self_frame_idx += 1
-
-            while track.frames[track_frame_idx] != blend_begin:
-                new_frames.append(track.frames[track_frame_idx])
-                new_values.append(track.values[track_frame_idx])
-                track_frame_idx += 1
-
-            while (self_frame_idx < len(self.frames) and
-                   track_frame_idx < len(track.frames) and
-                   self.frames[self_frame_idx] <= blend_end and
-                   track.frames[track_frame_idx] <= blend_end):
-                if (self.frames[self_frame_idx] ==
-                        track.frames[track_frame_idx]):
-                    new_frames.append(self.frames[self_frame_idx])
-
-                    new_values.append(
-                        self.blend_frames(
-                            self.values[self_frame_idx],
-                            track.values[track_frame_idx]
-                        )
-                    )
-
-                    self_frame_idx += 1
-                    track_frame_idx += 1
-                elif (self.frames[self_frame_idx] <
-                      track.frames[track_frame_idx]):
-                    new_frames.append(self.frames[self_frame_idx])
-                    new_values.append(self.values[self_frame_idx])
-                    self_frame_idx += 1
-                else:
-                    new_frames.append(track.frames[track_frame_idx])
-                    new_values.append(track.values[track_frame_idx])
-                    track_frame_idx += 1
-
-            while self_frame_idx < len(self.frames):
-                new_frames.append(self.frames[self_frame_idx])
-                new_values.append(self.values[self_frame_idx])
-                self_frame_idx += 1
-
-            while track_frame_idx < len(track.frames):
-                new_frames.append(track.frames[track_frame_idx])
-                new_values.append(track.values[track_frame_idx])
-                track_frame_idx += 1
-
-            self.frames = new_frames
-            self.values = new_values
+        blended = dict(zip(track.frames, track.values))
+        for frame, value in zip(self.frames, self.values):
+            if frame in blended:
+                # pylint: disable-msg=assignment-from-no-return
+                blended[frame] = self.blend_frames(value, blended[frame])
+            else:
+                blended[frame] = value
+
+        self.frames = sorted(blended)
+        self.values = [blended[frame] for frame in self.frames]
 
 
 class TransformTrack(Track):
-    """Animation track whose frame value is TranslationFrame object"""
-    def __init__(self, track_path, frames_iter=(), values_iter=()):
-        super().__init__("transform", track_path, frames_iter, values_iter)
+    """Animation track whose frame values are stored in a TransformFrames
+    object"""
+    def __init__(self, track_path, frames_iter=(), values_iter=None):
+        super().__init__("transform", track_path, (), ())
+        self.frames = list(frames_iter)
+        if values_iter is None:
+            values_iter = TransformFrames()
+        self.values = values_iter
+        assert len(self.frames) == len(self.values)
+
         self.parent_trans_inverse = mathutils.Matrix.Identity(4)
 
         # Fix of object's rotation, directional object like
@@ -260,83 +314,161 @@ class TransformTrack(Track):
         matrix_local(parent space transform)"""
         self.parent_trans_inverse = mathutils.Matrix(parent_inverse)
 
-    def blend_frames(self, frame_val1, frame_val2):
-        """Blend two transform frames into one"""
-        # FIXME: currently only blend with ADD
-        new_frame = TransformFrame()
-        for frame in (frame_val1, frame_val2):
-            if frame.rotation_mode != 'QUATERNION':
-                frame.rotation_quaternion = (
-                    frame.rotation_euler.to_quaternion()
-                )
+    def add_frame_data(self, frame, value):
+        """Add a frame to the track, value is a transform matrix or a
+        single frame TransformFrames"""
+        if not isinstance(value, TransformFrames):
+            value = TransformFrames.factory([value], self.values.rotation_mode)
+        self.frames.append(frame)
+        self.values.data = numpy.concatenate((self.values.data, value.data))
+        self.values.rotation_euler = numpy.concatenate(
+            (self.values.rotation_euler, value.rotation_euler))
 
-        new_frame.rotation_quaternion = (
-            frame_val1.rotation_quaternion @ frame_val2.rotation_quaternion
-        )
+    def blend(self, track):
+        """Blend current track with another one, used in nla editor,
+        frames in both tracks are blended with ADD"""
+        assert self.interp == track.interp
+        assert self.type == track.type
 
-        new_frame.location = frame_val1.location + frame_val2.location
-        new_frame.scale = frame_val1.scale
+        self_frames = numpy.array(self.frames, dtype=numpy.float64)
+        track_frames = numpy.array(track.frames, dtype=numpy.float64)
+        self_data = self.values.resolved()
+        track_data = track.values.resolved()
 
-        return new_frame
+        frames = numpy.union1d(self_frames, track_frames)
+        data = numpy.empty((len(frames), 10))
+        data[numpy.searchsorted(frames, track_frames)] = track_data
+        data[numpy.searchsorted(frames, self_frames)] = self_data
+
+        # FIXME: currently only blend with ADD
+        self_shared = numpy.isin(self_frames, track_frames)
+        track_shared = numpy.isin(track_frames, self_frames)
+        rows = numpy.searchsorted(frames, self_frames[self_shared])
+        data[rows, 0:3] = (self_data[self_shared, 0:3] +
+                           track_data[track_shared, 0:3])
+        data[rows, 3:7] = quaternion_multiply(
+            self_data[self_shared, 3:7], track_data[track_shared, 3:7])
+
+        self.frames = frames.tolist()
+        self.values = TransformFrames.from_resolved(data)
 
     def convert_to_keys_object(self):
         """Convert a transform track to godot structure"""
         array = Array(prefix='[', suffix=']')
+        array.extend(self.keys().ravel().tolist())
+        return array
+
+    def to_variant(self):
+        """Godot saves the keys of a transform track as a PoolRealArray"""
+        return GodotValue('PoolRealArray', self.keys().ravel())
 
+    def keys(self):
+        """The keys of the track as a (keys, 12) array of time, transition,
+        location, quaternion (x, y, z, w) and scale"""
         time_per_frame = 1 / bpy.context.scene.render.fps
         scene_frame_start = bpy.context.scene.frame_start
 
-        if self.interp == LINEAR_INTERPOLATION:
-            frames, values = strip_adjacent_dup_keyframes(
-                self.frames, self.values)
+        frames = numpy.array(self.frames, dtype=numpy.float64)
+        data = self.values.resolved()
+        if self.interp == LINEAR_INTERPOLATION and len(frames) > 1:
+            keep = strip_adjacent_dup_mask(data)
+            frames = frames[keep]
+            data = data[keep]
+
+        # move animation first frame to scene.frame_start
+        in_range = frames >= scene_frame_start
+        frames = frames[in_range]
+        data = data[in_range]
+
+        keys = self.godot_transforms(data)
+        return numpy.column_stack((
+            (frames - scene_frame_start) * time_per_frame,
+            numpy.column_stack((
+                # transition default 1.0
+                numpy.ones(len(frames)),
+                keys[:, 0:3],
+                keys[:, [4, 5, 6, 3]],
+                keys[:, 7:10],
+            )).astype(numpy.float32),
+        ))
+
+    def godot_transforms(self, data):
+        """Convert a (frames, 10) array of resolved TransformFrames values
+        into Godot space, return a (frames, 10) array of location,
+        quaternion (w, x, y, z) and scale"""
+        # get actual translation from blender weird location..
+        translation = numpy.column_stack((data[:, 0:3], numpy.ones(len(data))))
+        translation = translation @ numpy.array(self.parent_trans_inverse).T
+        location = translation[:, 0:3] / translation[:, 3:4]
+        quaternion = data[:, 3:7]
+        scale = data[:, 7:10]
+
+        # convert from z-up to y-up
+        location = location[:, [0, 2, 1]] * (1.0, 1.0, -1.0)
+        quaternion = quaternion[:, [0, 1, 3, 2]] * (1.0, 1.0, 1.0, -1.0)
+        scale = scale[:, [0, 2, 1]]
+
+        if self.is_directional:
+            # Rotation fix for directional objects like SpotLight, camera
+            directional_rot_fix = numpy.array(
+                mathutils.Euler((math.radians(-90), 0, 0)).to_quaternion())
+            quaternion = quaternion_multiply(quaternion, directional_rot_fix)
+
+        quaternion = quaternion / numpy.linalg.norm(
+            quaternion, axis=1)[:, None]
+
+        return numpy.column_stack((location, quaternion, scale))
+
+    def is_constant(self):
+        data = self.values.resolved()
+        return bool((data == data[:1]).all())
+
+    def matches_node(self, node):
+        """Bone tracks match the pose of the bone in the Skeleton, object
+        tracks match the node transform"""
+        keys = self.godot_transforms(self.values.resolved()[:1])[0]
+        key_matrix = numpy.identity(4)
+        key_matrix[0:3, 0:3] = numpy.array(
+            mathutils.Quaternion(keys[3:7]).to_matrix()) * keys[7:10]
+        key_matrix[0:3, 3] = keys[0:3]
+
+        if self.path.attribute_name:
+            if node.get_type() != 'Skeleton':
+                return False
+            pose = node.find_bone_pose(self.path.attribute_name)
+            if pose is None:
+                return False
+            node_matrix = numpy.array(fix_matrix(pose))
+        elif isinstance(node.get('transform'), mathutils.Matrix):
+            node_matrix = numpy.array(fix_matrix(node['transform']))
         else:
-            frames = self.frames
-            values = self.values
-
-        # Rotation fix for directional objects like SpotLight, camera, etc.
-        directional_rot_fix = \
-            mathutils.Euler((math.radians(-90), 0, 0)).to_quaternion()
-
-        for frame, trans_frame in zip(frames, values):
-            # move animation first frame to scene.frame_start
-            if frame < scene_frame_start:
-                continue
-
-            # get actual translation from blender weird location..
-            translation = (
-                self.parent_trans_inverse @ trans_frame.get_translation())
-
-            location = mathutils.Vector(
-                [x / translation[3] for x in translation[:3]])
-            quaternion = trans_frame.get_quaternion()
-            scale = trans_frame.get_scale()
-
-            # convert from z-up to y-up
-            location = mathutils.Vector([location.x, location.z, -location.y])
-            quaternion = mathutils.Quaternion(
-                [quaternion.w, quaternion.x, quaternion.z, -quaternion.y])
-            scale = mathutils.Vector([scale.x, scale.z, scale.y])
-
-            if self.is_directional:
-                quaternion = quaternion @ directional_rot_fix
-
-            quaternion.normalize()
-
-            array.append((frame - scene_frame_start) * time_per_frame)
-            # transition default 1.0
-            array.append(1.0)
-            array.append(location.x)
-            array.append(location.y)
-            array.append(location.z)
-            array.append(quaternion.x)
-            array.append(quaternion.y)
-            array.append(quaternion.z)
-            array.append(quaternion.w)
-            array.append(scale.x)
-            array.append(scale.y)
-            array.append(scale.z)
-
-        return array
+            return False
+        return numpy.allclose(key_matrix, node_matrix, atol=1e-5)
+
+    def collapse(self):
+        index = self.first_exported_index()
+        self.frames = self.frames[index:index + 1]
+        self.values = TransformFrames.from_resolved(
+            self.values.resolved()[index:index + 1])
+
+    def reduce_keyframes(self, tolerances):
+        """Remove the keys which the interpolation of their neighbors
+        reproduces within the tolerances, see reduce_transform_keys.
+        Return the number of keys removed"""
+        if len(self.frames) < 3:
+            return 0
+        frames = numpy.array(self.frames)
+        data = self.values.resolved()
+        keep = reduce_transform_keys(
+            frames, self.godot_transforms(data), tolerances)
+        # keys before scene.frame_start are not exported, the first one
+        # after it starts the animation
+        in_range = frames >= bpy.context.scene.frame_start
+        if in_range.any():
+            keep[in_range.argmax()] = True
+        self.frames = frames[keep].tolist()
+        self.values = TransformFrames.from_resolved(data[keep])
+        return len(keep) - len(self.frames)
 
 
 class ValueTrack(Track):
@@ -350,6 +482,19 @@ class ValueTrack(Track):
         # FIXME: default use REPLACE
         return max(frame_val1, frame_val2)
 
+    def is_constant(self):
+        return all(value == self.values[0] for value in self.values)
+
+    def matches_node(self, node):
+        node_value = node.get(self.path.attribute_name)
+        value = self.values[0]
+        if isinstance(node_value, bool) or isinstance(value, bool):
+            return node_value is value
+        if (isinstance(node_value, (int, float)) and
+                isinstance(value, (int, float))):
+            return math.isclose(node_value, value, abs_tol=1e-6)
+        return False
+
     def convert_to_keys_object(self):
         """Convert a value track to a godot keys object"""
         time_array = Array(prefix='PoolRealArray(', suffix=')')
@@ -384,12 +529,46 @@ class ValueTrack(Track):
 
         return keys_map
 
+    def channel_values(self):
+        """The values as a (frames, channels) array of floats, or None if
+        they are not numbers"""
+        return None
+
+    def reduce_keyframes(self, tolerance):
+        """Remove the keys which the linear interpolation of their
+        neighbors reproduces within the tolerance on every channel, see
+        reduce_value_keys. Return the number of keys removed"""
+        if self.interp != LINEAR_INTERPOLATION or len(self.frames) < 3:
+            return 0
+        # pylint: disable-msg=assignment-from-none
+        values = self.channel_values()
+        if values is None:
+            return 0
+        frames = numpy.array(self.frames)
+        keep = reduce_value_keys(frames, values, tolerance)
+        # keys before scene.frame_start are not exported, the first one
+        # after it starts the animation
+        in_range = frames >= bpy.context.scene.frame_start
+        if in_range.any():
+            keep[in_range.argmax()] = True
+        self.frames = frames[keep].tolist()
+        self.values = [value for value, kept in zip(self.values, keep)
+                       if kept]
+        return len(keep) - len(self.frames)
+
 
 class FloatTrack(ValueTrack):
     """Value track whose frame value is float"""
     def blend_frames(self, frame_val1, frame_val2):
         return max(frame_val1, frame_val2)
 
+    def channel_values(self):
+        # converted values may be booleans, e.g. visibility
+        if not all(isinstance(value, (int, float)) and
+                   not isinstance(value, bool) for value in self.values):
+            return None
+        return numpy.array(self.values, dtype=numpy.float64)[:, None]
+
 
 class ColorTrack(ValueTrack):
     """Value track whose frame value is mathutils.Color"""
@@ -398,6 +577,10 @@ class ColorTrack(ValueTrack):
             tuple(map(max, frame_val1, frame_val2))
         )
 
+    def channel_values(self):
+        return numpy.array([tuple(value) for value in self.values],
+                           dtype=numpy.float64)
+
 
 class BezierTrack(Track):
     """Track using bezier interpolcation"""
@@ -446,22 +629,41 @@ def build_const_interp_value_track(track_path, action_strip, converter,
     return track
 
 
+def is_conversion_exact(action_strip, converter, fcurve, frames, values):
+    """Check whether interpolating the converted values of the keys at
+    frames gives the converted fcurve value on every frame, which fails
+    for non linear converters"""
+    all_frames = list(range(frames[0], frames[-1] + 1))
+    expected = [converter(value)
+                for value in action_strip.sample_fcurve(fcurve, all_frames)]
+    interpolated = numpy.interp(
+        all_frames, frames, [converter(value) for value in values])
+    return numpy.allclose(interpolated, expected, rtol=0.0, atol=1e-6)
+
+
 def build_linear_interp_value_track(track_path, action_strip, converter,
                                     fcurve):
-    """Build a godot value track by evaluate every frame of Blender fcurve"""
+    """Build a godot value track by evaluate Blender fcurve at the sampling
+    frames of the strip, or only at its keyframes if Godot interpolating
+    them gives the same values"""
     track = FloatTrack(track_path)
 
-    frame_range = action_strip.frame_range
+    frames = action_strip.keyframe_exact_frames([fcurve])
+    if frames is not None:
+        values = action_strip.sample_fcurve(fcurve, frames)
+        if (converter is not None and
+                not is_conversion_exact(action_strip, converter, fcurve,
+                                        frames, values)):
+            frames = None
+    if frames is None:
+        frames = action_strip.sampling_frames([fcurve])
+        values = action_strip.sample_fcurve(fcurve, frames)
     if converter is None:
-        for frame in range(frame_range[0], frame_range[1]):
-            track.add_frame_data(
-                frame, action_strip.evaluate_fcurve(fcurve, frame)
-            )
+        for frame, value in zip(frames, values):
+            track.add_frame_data(frame, value)
     else:
-        for frame in range(frame_range[0], frame_range[1]):
-            track.add_frame_data(
-                frame, converter(action_strip.evaluate_fcurve(fcurve, frame))
-            )
+        for frame, value in zip(frames, values):
+            track.add_frame_data(frame, converter(value))
 
     return track
 
@@ -503,6 +705,20 @@ class AnimationResource(InternalResource):
         # helper attributes, not exported to ESCN
         self.tracks = collections.OrderedDict()
         self.anim_player = owner_anim_player
+        self._body_string = None
+
+    def generate_body_string(self):
+        if self._body_string is not None:
+            return self._body_string
+        return super().generate_body_string()
+
+    def content_hash(self):
+        """Hash of the tracks and settings of the animation, the name
+        apart. The body string is kept, so tracks must not change
+        anymore"""
+        self._body_string = super().generate_body_string()
+        _, content = self._body_string.split('\n', 1)
+        return hashlib.sha1(content.encode()).hexdigest()
 
     def add_track(self, track):
         """add a track to animation resource"""
@@ -525,14 +741,59 @@ class AnimationResource(InternalResource):
             self[track_id_str + '/interp'] = track.interp
             self[track_id_str + '/keys'] = track
 
+    def optimize_tracks(self, nodes, shared_paths=()):
+        """Remove the tracks with no keys, targeting no node of the scene
+        or holding the value the node already has, and reduce the other
+        constant tracks to a single key. `nodes` maps the path of each
+        node of the scene to the node. The tracks whose path is in
+        `shared_paths` are never removed for holding the value of the node:
+        another animation of the player changes it, and Godot keeps that
+        value when switching animation. Return the number of tracks removed
+        and collapsed"""
+        root_path = self.anim_player.parent.get_path()
+        tracks = collections.OrderedDict()
+        removed_count = 0
+        collapsed_count = 0
+        for node_path_str, track in self.tracks.items():
+            node = nodes.get(os.path.normpath(os.path.join(
+                root_path, track.path.relative_path)).replace('\\', '/'))
+            if node is None or not track.frames:
+                removed_count += 1
+                continue
+            if track.is_constant():
+                if (node_path_str not in shared_paths and
+                        track.matches_node(node)):
+                    removed_count += 1
+                    continue
+                if len(track.frames) > 1:
+                    track.collapse()
+                    collapsed_count += 1
+            tracks[node_path_str] = track
+
+        self.tracks = tracks
+        self.renumber_tracks()
+        return removed_count, collapsed_count
+
+    def renumber_tracks(self):
+        """Write the tracks/N entries again, numbered from zero"""
+        for key in [key for key in self if key.startswith('tracks/')]:
+            del self[key]
+        for index, track in enumerate(self.tracks.values()):
+            track_id_str = 'tracks/{}'.format(index)
+            self[track_id_str + '/type'] = '"{}"'.format(track.type)
+            self[track_id_str + '/path'] = track.path.to_string()
+            self[track_id_str + '/interp'] = track.interp
+            self[track_id_str + '/keys'] = track
+
     # pylint: disable-msg=too-many-arguments
     def add_obj_xform_track(self, node_type, track_path,
-                            xform_frames_list, frame_range,
+                            xform_frames_list, frames,
                             parent_mat_inverse=mathutils.Matrix.Identity(4)):
-        """Add a object transform track to AnimationResource"""
+        """Add a object transform track to AnimationResource, `frames`
+        are the frame numbers of the transform frames"""
         track = TransformTrack(
             track_path,
-            frames_iter=range(frame_range[0], frame_range[1]),
+            frames_iter=frames,
             values_iter=xform_frames_list,
         )
         track.set_parent_inverse(parent_mat_inverse)
@@ -564,6 +825,71 @@ class AnimationResource(InternalResource):
             self.add_track(new_track)
 
 
+def reduce_animation_keyframes(escn_file, export_settings):
+    """Run the keyframe reduction on the transform and value tracks of all
+    the animation resources of the file"""
+    tolerances = (
+        export_settings['keyframe_location_tolerance'],
+        export_settings['keyframe_rotation_tolerance'],
+        export_settings['keyframe_scale_tolerance'],
+    )
+    value_tolerance = export_settings['keyframe_value_tolerance']
+    for resource in escn_file.internal_resources:
+        if not isinstance(resource, AnimationResource):
+            continue
+        key_count = 0
+        removed_count = 0
+        for track in resource.tracks.values():
+            if isinstance(track, TransformTrack):
+                key_count += len(track.frames)
+                removed_count += track.reduce_keyframes(tolerances)
+            elif isinstance(track, ValueTrack):
+                key_count += len(track.frames)
+                removed_count += track.reduce_keyframes(value_tolerance)
+        if removed_count:
+            logging.info(
+                "Keyframe reduction removed %d of %d keys of animation %s",
+                removed_count, key_count, resource['resource_name'])
+
+
+def deduplicate_animations(escn_file):
+    """Merge the animation resources of the file with identical content"""
+    merged_count = 0
+    for node in escn_file.nodes:
+        if isinstance(node, AnimationPlayer):
+            merged_count += node.deduplicate_animations(escn_file)
+    if merged_count:
+        logging.info("Merged %d duplicated animations", merged_count)
+
+
+def optimize_animation_tracks(escn_file):
+    """Run AnimationResource.optimize_tracks on all the animation
+    resources of the file"""
+    nodes = {node.get_path(): node for node in escn_file.nodes}
+    resources = [resource for resource in escn_file.internal_resources
+                 if isinstance(resource, AnimationResource)]
+    # player path -> number of its animations animating each path
+    animated_paths = collections.defaultdict(collections.Counter)
+    for resource in resources:
+        animated_paths[resource.anim_player.get_path()].update(
+            node_path_str for node_path_str, track in resource.tracks.items()
+            if track.frames)
+
+    removed_count = 0
+    collapsed_count = 0
+    for resource in resources:
+        path_counts = animated_paths[resource.anim_player.get_path()]
+        shared_paths = {node_path_str
+                        for node_path_str, count in path_counts.items()
+                        if count > 1}
+        removed, collapsed = resource.optimize_tracks(nodes, shared_paths)
+        removed_count += removed
+        collapsed_count += collapsed
+    if removed_count or collapsed_count:
+        logging.info("Removed %d animation tracks, reduced %d constant "
+                     "tracks to one key", removed_count, collapsed_count)
+
+
 class AnimationPlayer(NodeTemplate):
     """Godot scene node with type AnimationPlayer"""
     def __init__(self, name, parent):
@@ -572,6 +898,21 @@ class AnimationPlayer(NodeTemplate):
         self['root_node'] = NodePath(self.get_path(), parent.get_path())
         # blender actions not in nla_tracks are treated as default
         self.active_animation = None
+        # 'anims/<name>' key -> AnimationResource
+        self.animation_resources = collections.OrderedDict()
+
+    def deduplicate_animations(self, escn_file):
+        """Point the animations to a single resource for each distinct
+        content, the same action played by several nodes gives identical
+        animations as tracks are relative to their player root node"""
+        merged_count = 0
+        for anim_key, resource in self.animation_resources.items():
+            resource_id = escn_file.merge_internal_resource(
+                resource, ('Animation', resource.content_hash()))
+            if resource_id != resource.heading['id']:
+                merged_count += 1
+            self[anim_key] = "SubResource({})".format(resource_id)
+        return merged_count
 
     def add_active_animation_resource(self, escn_file, resource_name):
         """Active animation resource corresponding to blender active action,
@@ -586,15 +927,17 @@ class AnimationPlayer(NodeTemplate):
         resource_name_filtered = re.sub(r'[\[\]\{\}]+', '', resource_name)
 
         new_anim_resource = AnimationResource(resource_name_filtered, self)
-        # add animation resource without checking hash,
+        # tracks are not added yet, so no hash is available here.
         # blender action is in world space, while godot animation
-        # is in local space (parent space),  so identical actions
-        # are not necessarily generates identical godot animations
+        # is in local space (parent space), so identical actions
+        # are not necessarily generates identical godot animations,
+        # resources are merged by content in deduplicate_animations
         resource_id = escn_file.force_add_internal_resource(new_anim_resource)
 
         # this filter may not catch all illegal char
-        self['anims/{}'.format(resource_name_filtered)] = (
-            "SubResource({})".format(resource_id))
+        anim_key = 'anims/{}'.format(resource_name_filtered)
+        self[anim_key] = "SubResource({})".format(resource_id)
+        self.animation_resources[anim_key] = new_anim_resource
 
         return new_anim_resource
 
@@ -127,6 +127,16 @@ class SkeletonNode(NodeTemplate):
         bone_rest_key = 'bones/%d/rest' % bone_id
         return self.get(bone_rest_key, mathutils.Matrix.Identity(4))
 
+    def find_bone_pose(self, bone_name):
+        """Given a bone name in Skeleton node, return its pose matrix, or
+        None if there is no such bone"""
+        bone_name_str = '"{}"'.format(bone_name)
+        for bone_id in self._bones_mapping.values():
+            if self.get('bones/%d/name' % bone_id) == bone_name_str:
+                return self.get('bones/%d/pose' % bone_id,
+                                mathutils.Matrix.Identity(4))
+        return None
+
 
 def export_armature_node(escn_file, export_settings,
                          armature_obj, parent_gd_node):
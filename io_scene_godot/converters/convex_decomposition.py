@@ -0,0 +1,194 @@
+"""Approximate convex decomposition of a triangle mesh. The surface is cut
+top-down: the most concave part is repeatedly split by the plane which
+reduces the total volume of the convex hulls of its two halves the most,
+until every part is close enough to convex or the hull budget is spent"""
+import hashlib
+import heapq
+import numpy
+from .convex_hull import ConvexHull
+
+# candidate cut planes tried along each axis of a part, they go through
+# vertices of the part so that cuts follow the features of the mesh
+CUTS_PER_AXIS = 5
+
+# triangles used to measure the concavity of a part and to evaluate the
+# candidate cuts, larger parts are subsampled
+MAX_CONCAVITY_TRIANGLES = 1500
+MAX_CUT_TRIANGLES = 250
+
+
+def split_triangles(triangles, origin, normal):
+    # pylint: disable-msg=too-many-locals
+    """Cut a (n, 3, 3) triangle soup by a plane, return the triangles on
+    the positive side and the ones on the negative side. Triangles crossing
+    the plane are clipped, the lone corner side gets one triangle and the
+    other side the remaining quad as two triangles"""
+    dists = (triangles - origin) @ normal
+    positive = dists > 0.0
+    counts = positive.sum(axis=1)
+
+    crossing = (counts == 1) | (counts == 2)
+    tris = triangles[crossing]
+    dists = dists[crossing]
+    lone_positive = counts[crossing] == 1
+    # corner which is alone on its side of the plane, rotated to the front
+    # so that the winding is kept
+    lone = numpy.where(lone_positive, positive[crossing].argmax(axis=1),
+                       positive[crossing].argmin(axis=1))
+    order = (lone[:, None] + numpy.arange(3)[None, :]) % 3
+    rows = numpy.arange(len(tris))[:, None]
+    tris = tris[rows, order]
+    dists = dists[rows, order]
+
+    corner_a, corner_b, corner_c = tris[:, 0], tris[:, 1], tris[:, 2]
+    ratio_b = dists[:, 0] / (dists[:, 0] - dists[:, 1])
+    ratio_c = dists[:, 0] / (dists[:, 0] - dists[:, 2])
+    point_p = corner_a + (corner_b - corner_a) * ratio_b[:, None]
+    point_q = corner_a + (corner_c - corner_a) * ratio_c[:, None]
+
+    lone_tris = numpy.stack((corner_a, point_p, point_q), axis=1)
+    quad_tris = numpy.concatenate((
+        numpy.stack((point_p, corner_b, corner_c), axis=1),
+        numpy.stack((point_p, corner_c, point_q), axis=1),
+    ))
+    quad_positive = numpy.concatenate((~lone_positive, ~lone_positive))
+
+    positive_side = numpy.concatenate((
+        triangles[counts == 3],
+        lone_tris[lone_positive],
+        quad_tris[quad_positive],
+    ))
+    negative_side = numpy.concatenate((
+        triangles[counts == 0],
+        lone_tris[~lone_positive],
+        quad_tris[~quad_positive],
+    ))
+    return positive_side, negative_side
+
+
+def _evaluation_subset(triangles, max_triangles):
+    """Evenly strided subset of a triangle soup, bounding the cost of
+    evaluating a part"""
+    stride = max(1, len(triangles) // max_triangles)
+    return triangles[::stride]
+
+
+def _hull_volume(triangles):
+    """Volume of the convex hull of a triangle soup"""
+    if triangles.size == 0:
+        return 0.0
+    return ConvexHull(numpy.unique(triangles.reshape(-1, 3), axis=0)).volume
+
+
+def part_concavity(triangles):
+    """Largest distance from the part surface to its convex hull boundary,
+    measured on the triangle corners and centers"""
+    samples = _evaluation_subset(triangles, MAX_CONCAVITY_TRIANGLES)
+    hull = ConvexHull(samples.reshape(-1, 3))
+    if hull.is_degenerated:
+        return 0.0
+    points = numpy.concatenate((samples.reshape(-1, 3),
+                                samples.mean(axis=1)))
+    return float(hull.inner_distances(points).max())
+
+
+def best_cut(triangles):
+    """Plane (origin, normal) among the candidates minimizing the summed
+    hull volume of the two halves, candidates are planes orthogonal to the
+    mesh axes and to the principal axes of the part"""
+    samples = _evaluation_subset(triangles, MAX_CUT_TRIANGLES)
+    points = samples.reshape(-1, 3)
+    center = points.mean(axis=0)
+    _, _, principal_axes = numpy.linalg.svd(
+        points - center, full_matrices=False)
+    axes = numpy.concatenate((numpy.identity(3), principal_axes))
+
+    best_cost = 0.0
+    best_plane = None
+    for normal in axes:
+        # distinct vertex positions along the axis, extremes excluded
+        positions = numpy.unique(
+            numpy.round((points - center) @ normal, 9))[1:-1]
+        if len(positions) > CUTS_PER_AXIS:
+            positions = positions[numpy.linspace(
+                0, len(positions) - 1, CUTS_PER_AXIS).round().astype(int)]
+        for position in positions:
+            origin = center + normal * position
+            positive, negative = split_triangles(samples, origin, normal)
+            if positive.size == 0 or negative.size == 0:
+                continue
+            cost = _hull_volume(positive) + _hull_volume(negative)
+            if best_plane is None or cost < best_cost:
+                best_cost = cost
+                best_plane = (origin, normal)
+
+    return best_plane
+
+
+def decompose_triangles(triangles, max_hulls, concavity_tolerance):
+    """Split a (n, 3, 3) triangle soup into at most `max_hulls` parts,
+    parts less concave than `concavity_tolerance` (relative to the
+    bounding box diagonal) are not split further"""
+    points = triangles.reshape(-1, 3)
+    diagonal = numpy.linalg.norm(numpy.ptp(points, axis=0))
+    threshold = concavity_tolerance * diagonal
+
+    # most concave part first, the counter keeps the order deterministic
+    heap = [(-part_concavity(triangles), 0, triangles)]
+    counter = 1
+    convex_parts = list()
+    while heap and len(heap) + len(convex_parts) < max_hulls:
+        concavity, _, part = heapq.heappop(heap)
+        if -concavity <= threshold:
+            convex_parts.append(part)
+            continue
+        plane = best_cut(part)
+        if plane is None:
+            convex_parts.append(part)
+            continue
+        for half in split_triangles(part, *plane):
+            if half.size:
+                heapq.heappush(heap, (-part_concavity(half), counter, half))
+                counter += 1
+
+    return convex_parts + [part for _, _, part in sorted(heap)]
+
+
+def convex_decomposition(vertices, triangle_indices, max_hulls,
+                         max_hull_points, concavity_tolerance, cache=None):
+    """Decompose a mesh given as vertex positions (n, 3) and triangle
+    vertex indices (m, 3) into convex parts. Return a list of point arrays,
+    one for each part, holding only the points on the part hull (at most
+    `max_hull_points` of them if it is not zero). The decompositions are
+    kept in `cache`, keyed by mesh content and parameters, so that linked
+    duplicates skip the work"""
+    # pylint: disable-msg=too-many-arguments
+    vertices = numpy.ascontiguousarray(vertices, dtype=numpy.float64)
+    triangle_indices = numpy.ascontiguousarray(
+        triangle_indices, dtype=numpy.int64)
+
+    digest = hashlib.sha1(vertices.tobytes())
+    digest.update(triangle_indices.tobytes())
+    cache_key = (digest.hexdigest(), max_hulls, max_hull_points,
+                 concavity_tolerance)
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+
+    hulls = list()
+    if len(triangle_indices):
+        parts = decompose_triangles(
+            vertices[triangle_indices], max_hulls, concavity_tolerance)
+        for part in parts:
+            part_points = numpy.unique(part.reshape(-1, 3), axis=0)
+            hull = ConvexHull(part_points)
+            if hull.is_degenerated:
+                hulls.append(part_points)
+                continue
+            indices = hull.vertices
+            if max_hull_points > 0:
+                indices, _ = hull.simplified_vertices(max_hull_points)
+            hulls.append(part_points[indices])
+
+    if cache is not None:
+        cache[cache_key] = hulls
+    return hulls
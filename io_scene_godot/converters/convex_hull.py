@@ -0,0 +1,270 @@
+"""Quickhull on numpy arrays. It is used by the physics converter to
+reduce a mesh to the points actually on its convex hull, and optionally
+to an even smaller set of points approximating the hull"""
+import heapq
+import numpy
+
+# tolerance of the plane distance test, relative to the extent of the
+# point cloud
+HULL_EPSILON = 1e-9
+
+
+def _cross(vecs_a, vecs_b):
+    """Row wise cross product of two (n, 3) arrays, numpy.cross has a
+    large overhead on the small arrays built in each quickhull step"""
+    return numpy.stack((
+        vecs_a[:, 1] * vecs_b[:, 2] - vecs_a[:, 2] * vecs_b[:, 1],
+        vecs_a[:, 2] * vecs_b[:, 0] - vecs_a[:, 0] * vecs_b[:, 2],
+        vecs_a[:, 0] * vecs_b[:, 1] - vecs_a[:, 1] * vecs_b[:, 0],
+    ), axis=1)
+
+
+class ConvexHull:
+    # pylint: disable-msg=too-many-instance-attributes
+    """Convex hull of a 3d point cloud built with quickhull. Points are
+    inserted farthest first, the insertion order and the hull volume after
+    each insertion are recorded, so that a hull with less points can be
+    picked later"""
+
+    def __init__(self, points):
+        self.points = numpy.asarray(points, dtype=numpy.float64)
+        # indices of points on the hull, None if the points are degenerated
+        # (less than four points, or all of them on a plane)
+        self.vertices = None
+        # triangles, counter-clockwise seen from outside
+        self.faces = None
+        self.volume = 0.0
+
+        # point index inserted at each step, the first four are the
+        # initial simplex
+        self.insertion_order = list()
+        # (hull vertex count, hull volume) after each insertion step
+        self.history = list()
+
+        self._eps = 0.0
+        self._interior = None
+        self._faces = dict()
+        self._normals = dict()
+        self._offsets = dict()
+        # signed volume of the tetrahedron of face and interior point
+        self._volumes = dict()
+        self._outside = dict()
+        # (-farthest outside distance, face id), faces removed from the
+        # hull are skipped when popped
+        self._outside_heap = list()
+        self._edge_face = dict()
+        self._next_face_id = 0
+
+        if len(self.points) >= 4:
+            self._build()
+
+    @property
+    def is_degenerated(self):
+        """True if the points span no volume"""
+        return self.vertices is None
+
+    def _initial_simplex(self):
+        """Find four points spanning a non-degenerated tetrahedron"""
+        points = self.points
+        extremes = numpy.unique(numpy.concatenate(
+            (points.argmin(axis=0), points.argmax(axis=0))))
+        ext_pts = points[extremes]
+        sqr_dists = ((ext_pts[:, None, :] - ext_pts[None, :, :]) ** 2).sum(-1)
+        i, j = divmod(int(sqr_dists.argmax()), len(extremes))
+        if sqr_dists[i, j] <= self._eps ** 2:
+            return None
+        first, second = extremes[i], extremes[j]
+
+        line = points[second] - points[first]
+        line_dists = (numpy.cross(points - points[first], line) ** 2).sum(1)
+        third = line_dists.argmax()
+        if line_dists[third] <= (self._eps * numpy.linalg.norm(line)) ** 2:
+            return None
+
+        normal = numpy.cross(line, points[third] - points[first])
+        normal /= numpy.linalg.norm(normal)
+        plane_dists = numpy.abs((points - points[first]) @ normal)
+        fourth = plane_dists.argmax()
+        if plane_dists[fourth] <= self._eps:
+            return None
+
+        return [int(first), int(second), int(third), int(fourth)]
+
+    def _add_faces(self, triangles, orient=False):
+        """Add triangles (a list of vertex index triples), if `orient` is
+        True they are flipped when needed so that they face outwards,
+        otherwise the winding is kept, which is what the faces built on
+        the horizon need. Return the new face ids"""
+        tris = numpy.array(triangles, dtype=numpy.int64)
+        corners = self.points[tris]
+        normals = _cross(corners[:, 1] - corners[:, 0],
+                         corners[:, 2] - corners[:, 0])
+        lengths = numpy.linalg.norm(normals, axis=1)
+        normals[lengths > 0.0] /= lengths[lengths > 0.0, None]
+        offsets = (normals * corners[:, 0]).sum(axis=1)
+        if orient:
+            flip = normals @ self._interior - offsets > 0
+            tris[flip] = tris[flip][:, ::-1]
+            normals[flip] = -normals[flip]
+            offsets[flip] = -offsets[flip]
+        corners = self.points[tris] - self._interior
+        volumes = (corners[:, 0] * _cross(
+            corners[:, 1], corners[:, 2])).sum(axis=1) / 6.0
+
+        face_ids = list()
+        for index, (vert_a, vert_b, vert_c) in enumerate(tris.tolist()):
+            face_id = self._next_face_id
+            self._next_face_id += 1
+            self._faces[face_id] = (vert_a, vert_b, vert_c)
+            self._normals[face_id] = normals[index]
+            self._offsets[face_id] = offsets[index]
+            self._volumes[face_id] = volumes[index]
+            for edge in ((vert_a, vert_b), (vert_b, vert_c),
+                         (vert_c, vert_a)):
+                self._edge_face[edge] = face_id
+            face_ids.append(face_id)
+        return face_ids
+
+    def _remove_face(self, face_id):
+        """Remove a triangle and its edges, return its signed volume"""
+        vert_a, vert_b, vert_c = self._faces.pop(face_id)
+        for edge in ((vert_a, vert_b), (vert_b, vert_c), (vert_c, vert_a)):
+            if self._edge_face.get(edge) == face_id:
+                del self._edge_face[edge]
+        del self._normals[face_id]
+        del self._offsets[face_id]
+        self._outside.pop(face_id, None)
+        return self._volumes.pop(face_id)
+
+    def _assign_outside(self, point_ids, face_ids):
+        """Distribute points to the face they are farthest outside of,
+        points inside all the faces are dropped"""
+        if not point_ids.size or not face_ids:
+            return
+        normals = numpy.array([self._normals[f] for f in face_ids])
+        offsets = numpy.array([self._offsets[f] for f in face_ids])
+        dists = self.points[point_ids] @ normals.T - offsets
+        best = dists.argmax(axis=1)
+        best_dists = dists[numpy.arange(len(point_ids)), best]
+        outside = best_dists > self._eps
+        for index, face_id in enumerate(face_ids):
+            mask = outside & (best == index)
+            if mask.any():
+                self._outside[face_id] = (point_ids[mask], best_dists[mask])
+                heapq.heappush(
+                    self._outside_heap, (-best_dists[mask].max(), face_id))
+
+    def _build(self):
+        # pylint: disable-msg=too-many-locals
+        """Quickhull main loop"""
+        extent = numpy.ptp(self.points, axis=0).max()
+        self._eps = HULL_EPSILON * max(extent, 1.0)
+
+        simplex = self._initial_simplex()
+        if simplex is None:
+            return
+
+        self._interior = self.points[simplex].mean(axis=0)
+        face_ids = self._add_faces((
+            (simplex[0], simplex[1], simplex[2]),
+            (simplex[0], simplex[1], simplex[3]),
+            (simplex[1], simplex[2], simplex[3]),
+            (simplex[2], simplex[0], simplex[3]),
+        ), orient=True)
+        hull_vertices = set(simplex)
+        self.insertion_order.extend(simplex)
+        volume = sum(self._volumes[f] for f in face_ids)
+        self.history.append((len(hull_vertices), volume))
+
+        remains = numpy.setdiff1d(
+            numpy.arange(len(self.points)), simplex)
+        self._assign_outside(remains, face_ids)
+
+        while self._outside_heap:
+            # always insert the point farthest from the hull, so that the
+            # intermediate hulls are the best approximations
+            _, seed_face = heapq.heappop(self._outside_heap)
+            if seed_face not in self._outside:
+                continue
+            outside_ids, outside_dists = self._outside[seed_face]
+            eye = int(outside_ids[outside_dists.argmax()])
+            eye_point = self.points[eye]
+
+            # faces visible from the eye point, and the horizon edges
+            visible = {seed_face}
+            horizon = list()
+            stack = [seed_face]
+            while stack:
+                face_id = stack.pop()
+                vert_a, vert_b, vert_c = self._faces[face_id]
+                for edge in ((vert_a, vert_b), (vert_b, vert_c),
+                             (vert_c, vert_a)):
+                    neighbor = self._edge_face[(edge[1], edge[0])]
+                    if neighbor in visible:
+                        continue
+                    if (self._normals[neighbor] @ eye_point -
+                            self._offsets[neighbor] > self._eps):
+                        visible.add(neighbor)
+                        stack.append(neighbor)
+                    else:
+                        horizon.append(edge)
+
+            orphans = [self._outside[f][0] for f in visible
+                       if f in self._outside]
+            removed_vertices = set()
+            for face_id in visible:
+                removed_vertices.update(self._faces[face_id])
+                volume -= self._remove_face(face_id)
+
+            new_faces = self._add_faces(
+                [(vert_a, vert_b, eye) for vert_a, vert_b in horizon])
+            volume += sum(self._volumes[f] for f in new_faces)
+
+            horizon_vertices = {v for edge in horizon for v in edge}
+            hull_vertices -= removed_vertices - horizon_vertices
+            hull_vertices.add(eye)
+            self.insertion_order.append(eye)
+            self.history.append((len(hull_vertices), volume))
+
+            orphans = numpy.concatenate(orphans)
+            self._assign_outside(orphans[orphans != eye], new_faces)
+
+        self.vertices = numpy.array(sorted(hull_vertices), dtype=numpy.int64)
+        self.faces = numpy.array(list(self._faces.values()),
+                                 dtype=numpy.int64)
+        self.volume = volume
+
+    def inner_distances(self, points):
+        """Distances of points inside the hull to the hull boundary, points
+        outside of the hull get zero"""
+        corners = self.points[self.faces]
+        normals = _cross(corners[:, 1] - corners[:, 0],
+                         corners[:, 2] - corners[:, 0])
+        lengths = numpy.linalg.norm(normals, axis=1)
+        normals = normals[lengths > 0.0] / lengths[lengths > 0.0, None]
+        offsets = (normals * corners[lengths > 0.0, 0]).sum(axis=1)
+        dists = offsets[None, :] - numpy.asarray(points) @ normals.T
+        return numpy.maximum(dists.min(axis=1), 0.0)
+
+    def simplified_vertices(self, max_points, volume_tolerance=0.0):
+        """Return indices of at most `max_points` points approximating
+        the hull from inside. Points are taken in insertion order and
+        taking stops early once the volume lost is under
+        `volume_tolerance` (relative to the full hull volume). The relative
+        volume error of the result is returned as well"""
+        if self.is_degenerated or len(self.vertices) <= max(max_points, 4):
+            return self.vertices, 0.0
+
+        # insertion step meeting the budget or the tolerance first
+        step = 0
+        for index, (vertex_count, volume) in enumerate(self.history):
+            if vertex_count > max(max_points, 4):
+                break
+            step = index
+            if volume >= (1.0 - volume_tolerance) * self.volume:
+                break
+
+        subset = numpy.array(self.insertion_order[:step + 4])
+        sub_hull = ConvexHull(self.points[subset])
+        error = 1.0 - sub_hull.volume / self.volume
+        return subset[sub_hull.vertices], error
@@ -8,6 +8,7 @@ import logging
 import os
 import bpy
 from .script_shader import export_script_shader
+from .script_shader.node_tree import export_texture
 from ...structures import (
     InternalResource, ExternalResource, gamma_correct, ValidationError, RGBA)
 
@@ -55,7 +56,169 @@ def export_material(escn_file, export_settings, bl_object, material):
     return "SubResource({})".format(resource_id)
 
 
-def export_as_spatial_material(material_rsc_name, material):
+# principled bsdf inputs which could be textured in a SpatialMaterial,
+# mapping to the texture property
+SPATIAL_TEXTURE_SLOTS = {
+    'Base Color': 'albedo_texture',
+    'Metallic': 'metallic_texture',
+    'Roughness': 'roughness_texture',
+    'Emission': 'emission_texture',
+    'Normal': 'normal_texture',
+}
+
+# principled bsdf inputs with no SpatialMaterial counterpart, the material
+# is only exported as a SpatialMaterial if they keep the value which has
+# no effect
+SPATIAL_NEUTRAL_INPUTS = {
+    'Specular Tint': 0.0,
+    'Anisotropic Rotation': 0.0,
+    'Sheen': 0.0,
+    'Sheen Weight': 0.0,
+    'Transmission': 0.0,
+    'Transmission Weight': 0.0,
+}
+
+# SpatialMaterial.TextureChannel
+TEXTURE_CHANNEL_ALPHA = 3
+TEXTURE_CHANNEL_GRAYSCALE = 4
+
+
+def _linked_from_socket(socket):
+    """Return the output socket linked to an input socket, reroute
+    nodes are skipped. None is returned if not linked"""
+    while socket.is_linked and socket.links[0].is_valid:
+        from_socket = socket.links[0].from_socket
+        if from_socket.node.bl_idname != 'NodeReroute':
+            return from_socket
+        socket = from_socket.node.inputs[0]
+    return None
+
+
+def _is_plain_image_node(node):
+    """Whether a node is an image texture sampled with the default
+    uv coordinates and repeat, as a SpatialMaterial does"""
+    return (node.bl_idname == 'ShaderNodeTexImage' and
+            node.image is not None and
+            not node.inputs['Vector'].is_linked and
+            node.projection == 'FLAT' and
+            node.extension == 'REPEAT')
+
+
+def find_spatial_texture_slots(node_tree):
+    """Check whether a material node tree is simple enough to be exported
+    as a SpatialMaterial, that is a principled bsdf whose inputs are either
+    constants or directly come from image textures (the normal through a
+    tangent space normal map). Return a dict mapping principled input name
+    to a (image, texture channel) tuple, or None if the tree can only be
+    exported as a shader script"""
+    # pylint: disable-msg=too-many-return-statements
+    # pylint: disable-msg=too-many-branches
+    out = node_tree.get_output_node("ALL")
+    if out is None:
+        return None
+    for socket in out.inputs:
+        if socket.name != 'Surface' and socket.is_linked:
+            # displacement or volume
+            return None
+
+    surf_socket = _linked_from_socket(out.inputs['Surface'])
+    if surf_socket is None or surf_socket.node.type != 'BSDF_PRINCIPLED':
+        return None
+    principled = surf_socket.node
+
+    texture_slots = dict()
+    alpha_socket = None
+    for socket in principled.inputs:
+        from_socket = _linked_from_socket(socket)
+        if from_socket is None:
+            if (socket.name in SPATIAL_NEUTRAL_INPUTS and
+                    socket.default_value !=
+                    SPATIAL_NEUTRAL_INPUTS[socket.name]):
+                return None
+            continue
+        if socket.name == 'Alpha':
+            alpha_socket = from_socket
+            continue
+        if socket.name not in SPATIAL_TEXTURE_SLOTS:
+            return None
+
+        if socket.name == 'Normal':
+            normal_map = from_socket.node
+            if (normal_map.bl_idname != 'ShaderNodeNormalMap' or
+                    normal_map.space != 'TANGENT' or
+                    normal_map.uv_map or
+                    normal_map.inputs['Strength'].is_linked):
+                return None
+            from_socket = _linked_from_socket(normal_map.inputs['Color'])
+            if from_socket is None:
+                return None
+
+        if not _is_plain_image_node(from_socket.node):
+            return None
+        if from_socket.name == 'Alpha':
+            if socket.type != 'VALUE':
+                return None
+            channel = TEXTURE_CHANNEL_ALPHA
+        else:
+            channel = TEXTURE_CHANNEL_GRAYSCALE
+        texture_slots[socket.name] = (from_socket.node.image, channel)
+
+    if alpha_socket is not None:
+        # albedo texture alpha is the only source of alpha
+        if (alpha_socket.name != 'Alpha' or
+                not _is_plain_image_node(alpha_socket.node) or
+                'Base Color' not in texture_slots or
+                alpha_socket.node.image != texture_slots['Base Color'][0]):
+            return None
+        texture_slots['Alpha'] = (alpha_socket.node.image,
+                                  TEXTURE_CHANNEL_ALPHA)
+
+    return texture_slots
+
+
+def export_spatial_texture_slots(escn_file, export_settings, mat,
+                                 principled, texture_slots):
+    """Set the textures of a SpatialMaterial, the textured properties are
+    reset to neutral values as godot multiplies them with the texture"""
+    def texture(input_name):
+        image = texture_slots[input_name][0]
+        return "ExtResource({})".format(
+            export_texture(escn_file, export_settings, image))
+
+    if 'Base Color' in texture_slots:
+        mat['albedo_texture'] = texture('Base Color')
+        alpha = principled.inputs['Alpha'].default_value
+        if 'Alpha' in texture_slots:
+            alpha = 1.0
+            mat['flags_transparent'] = True
+        mat['albedo_color'] = RGBA([1.0, 1.0, 1.0, alpha])
+
+    for input_name, gd_name in (('Metallic', 'metallic'),
+                                ('Roughness', 'roughness')):
+        if input_name in texture_slots:
+            mat[gd_name] = 1.0
+            mat[gd_name + '_texture'] = texture(input_name)
+            mat[gd_name + '_texture_channel'] = texture_slots[input_name][1]
+
+    if 'Emission' in texture_slots:
+        # godot adds emission color to the texture
+        mat['emission_enabled'] = True
+        mat['emission'] = gamma_correct((0.0, 0.0, 0.0))
+        mat['emission_energy'] = 1.0
+        if 'Emission Strength' in principled.inputs:
+            mat['emission_energy'] = \
+                principled.inputs['Emission Strength'].default_value
+        mat['emission_texture'] = texture('Emission')
+
+    if 'Normal' in texture_slots:
+        normal_map = _linked_from_socket(principled.inputs['Normal']).node
+        mat['normal_enabled'] = True
+        mat['normal_scale'] = normal_map.inputs['Strength'].default_value
+        mat['normal_texture'] = texture('Normal')
+
+
+def export_as_spatial_material(escn_file, export_settings,
+                               material_rsc_name, material):
     """Export a Blender Material as Godot Spatial Material"""
     mat = InternalResource("SpatialMaterial", material_rsc_name)
 
@@ -70,11 +233,14 @@ def export_as_spatial_material(material_rsc_name, material):
         return mat
 
     out = material.node_tree.get_output_node("ALL")
-    if not (out and out.inputs["Surface"].links):
+    surf_socket = None
+    if out is not None:
+        surf_socket = _linked_from_socket(out.inputs["Surface"])
+    if surf_socket is None:
         logging.warning("No Surface output for %s", material.name)
         return mat
 
-    surf = out.inputs["Surface"].links[0].from_node
+    surf = surf_socket.node
 
     def val(key):
         return surf.inputs[key].default_value
@@ -102,6 +268,11 @@ def export_as_spatial_material(material_rsc_name, material):
 
         mat["subsurf_scatter_enabled"] = val("Subsurface") > 0
         mat["subsurf_scatter_strength"] = val("Subsurface")
+
+        texture_slots = find_spatial_texture_slots(material.node_tree)
+        if texture_slots:
+            export_spatial_texture_slots(
+                escn_file, export_settings, mat, surf, texture_slots)
     elif surf.type == "EMISSION":
         mat["emission_enabled"] = True
         mat["emission_energy"] = val("Strength") / 100
@@ -126,9 +297,19 @@ def generate_material_resource(escn_file, export_settings, bl_object,
         # to convert material to external file
         material_rsc_name = ''
 
-    if (export_settings['material_mode'] == 'SCRIPT_SHADER' and
-            engine in ('CYCLES', 'BLENDER_EEVEE') and
-            material.node_tree is not None):
+    use_script_shader = (
+        export_settings['material_mode'] == 'SCRIPT_SHADER' and
+        engine in ('CYCLES', 'BLENDER_EEVEE') and
+        material.node_tree is not None
+    )
+    if (use_script_shader and
+            export_settings['use_spatial_material_fast_path'] and
+            find_spatial_texture_slots(material.node_tree) is not None):
+        # the node tree is fully expressible by a SpatialMaterial, which
+        # is cheaper in godot than a custom shader
+        use_script_shader = False
+
+    if use_script_shader:
         mat = InternalResource("ShaderMaterial", material_rsc_name)
         try:
             export_script_shader(
@@ -136,12 +317,14 @@ def generate_material_resource(escn_file, export_settings, bl_object,
             )
         except ValidationError as exception:
             # fallback to SpatialMaterial
-            mat = export_as_spatial_material(material_rsc_name, material)
+            mat = export_as_spatial_material(
+                escn_file, export_settings, material_rsc_name, material)
             logging.error(
                 "%s, in material '%s'", str(exception), material.name
             )
     else:  # Spatial Material
-        mat = export_as_spatial_material(material_rsc_name, material)
+        mat = export_as_spatial_material(
+            escn_file, export_settings, material_rsc_name, material)
 
     # make material-object tuple as an identifier, as uniforms is part of
     # material and they are binded with object
@@ -149,15 +332,19 @@ def generate_material_resource(escn_file, export_settings, bl_object,
 
 
 # ------------------- Tools for finding existing materials -------------------
-def _find_material_in_subtree(folder, material):
+def _find_material_in_subtree(folder, material, material_files=None):
     """Searches for godot materials that match a blender material. If found,
-    it returns (path, type) otherwise it returns None"""
+    it returns (path, type) otherwise it returns None. material_files maps
+    the .tres files of the folder to their paths, if already known"""
     candidates = []
 
     material_file_name = material.name + '.tres'
-    for dir_path, _subdirs, files in os.walk(folder):
-        if material_file_name in files:
-            candidates.append(os.path.join(dir_path, material_file_name))
+    if material_files is not None:
+        candidates.extend(material_files.get(material_file_name, ()))
+    else:
+        for dir_path, _subdirs, files in os.walk(folder):
+            if material_file_name in files:
+                candidates.append(os.path.join(dir_path, material_file_name))
 
     # Checks it is a material and finds out what type
     valid_candidates = []
@@ -188,4 +375,8 @@ def find_material(export_settings, material):
 
     if search_dir is None:
         return None
+    cache = export_settings.get('conversion_cache')
+    if cache is not None:
+        return _find_material_in_subtree(
+            search_dir, material, cache.material_files(search_dir))
     return _find_material_in_subtree(search_dir, material)
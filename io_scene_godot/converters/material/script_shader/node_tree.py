@@ -1,5 +1,6 @@
 """Interface for material node tree exporter"""
 import os
+import heapq
 import logging
 import textwrap
 from shutil import copyfile
@@ -52,18 +53,25 @@ class ScriptShader:
 
         self.flags = ShadingFlags()
 
+        # generated script text, reset by every method changing the
+        # shader, so serializing the resource does not regenerate it
+        self._script_cache = None
+
     def add_functions(self, functions):
         """append local converter functions to shader"""
+        self._script_cache = None
         self._functions = self._functions.union(functions)
 
     def add_fragment_code(self, frag_code_list):
         """get local fragment code and append to shader"""
+        self._script_cache = None
         self._fragment_code_lines.extend(frag_code_list)
 
     def add_fragment_output(self, output_shader_link):
         """link the node tree output with godot fragment output"""
         # pylint: disable-msg=too-many-branches
         # pylint: disable-msg=too-many-statements
+        self._script_cache = None
 
         # hack: define those two variable at the begining
         self._fragment_code_lines.insert(0, "\n")
@@ -193,7 +201,14 @@ class ScriptShader:
             )
 
     def generate_scripts(self):
-        """return the whole script in the format of string"""
+        """return the whole script in the format of string, the result
+        is cached until the shader is modified"""
+        if self._script_cache is None:
+            self._script_cache = self._generate_scripts()
+        return self._script_cache
+
+    def _generate_scripts(self):
+        """generate the script text from code lines"""
         def generate_line_suffix(line):
             if line.startswith("//"):
                 _suffix = "\n"
@@ -265,6 +280,7 @@ class ScriptShader:
     def update_texture(self, converter):
         """add converter textures into shader and update the texture info
         in converter"""
+        self._script_cache = None
         for tex in converter.textures:
             if tex in self._textures:
                 tex_uniform = self._textures[tex]
@@ -310,37 +326,47 @@ def find_material_output_node(node_tree):
 
 
 def topology_sort(nodes):
-    """topology sort all the nodes"""
-    def find_zero_input_node(nodes_input_list):
-        for node, inputs in nodes_input_list:
-            if inputs == 0:
-                return node
-        return None
-
+    """topology sort all the nodes, Kahn's algorithm with a heap so that
+    among all the zero input nodes the one comes first in `nodes` is always
+    picked, which keeps the output order deterministic"""
     sorted_node_list = list()
 
+    node_order = dict()
     nodes_input_count = dict()
-    for node in nodes:
+    for index, node in enumerate(nodes):
         cnt = 0
         for sock in node.inputs:
             if sock.is_linked and sock.links[0].is_valid:
                 cnt += 1
+        node_order[node] = index
         nodes_input_count[node] = cnt
 
-    cur_node = find_zero_input_node(nodes_input_count.items())
-    while cur_node is not None:
+    zero_input_heap = [
+        node_order[node] for node, cnt in nodes_input_count.items()
+        if cnt == 0
+    ]
+    heapq.heapify(zero_input_heap)
+    node_list = list(node_order)
+
+    while zero_input_heap:
+        cur_node = node_list[heapq.heappop(zero_input_heap)]
+        # a node may be pushed while its count is zero, and then be
+        # decremented again by a malformed link before it is popped
+        if nodes_input_count[cur_node] != 0:
+            continue
         sorted_node_list.append(cur_node)
 
-        for sock in cur_node.outputs:
-            for link in sock.links:
-                if link.is_valid:
-                    nodes_input_count[link.to_node] -= 1
-
         # made cur_node -1, so prevent it from being found
         # as zero input
         nodes_input_count[cur_node] = -1
 
-        cur_node = find_zero_input_node(nodes_input_count.items())
+        for sock in cur_node.outputs:
+            for link in sock.links:
+                if link.is_valid and link.to_node in nodes_input_count:
+                    nodes_input_count[link.to_node] -= 1
+                    if nodes_input_count[link.to_node] == 0:
+                        heapq.heappush(
+                            zero_input_heap, node_order[link.to_node])
 
     return sorted_node_list
 
@@ -420,7 +446,11 @@ def export_texture(escn_file, export_settings, image):
     dst_dir_path = os.path.dirname(export_settings['path'])
     dst_path = os.path.join(dst_dir_path, export_image_name(image))
 
-    if image.packed_file is not None:
+    cache = export_settings.get('conversion_cache')
+    if cache is not None and (image, dst_path) in cache.texture_files:
+        # written for another file
+        pass
+    elif image.packed_file is not None:
         image.filepath_raw = dst_path
         image.save()
     else:
@@ -433,6 +463,8 @@ def export_texture(escn_file, export_settings, image):
                 logging.warning("Texture Image '%s' does not exist!", src_path)
             else:
                 copyfile(src_path, dst_path)
+    if cache is not None:
+        cache.texture_files.add((image, dst_path))
 
     img_resource = ExternalResource(dst_path, "Texture")
     return escn_file.add_external_resource(img_resource, image)
@@ -517,13 +549,22 @@ def export_script_shader(escn_file, export_settings, bl_object,
         shader_rsc = escn_file.internal_resources[shader_rsc_id - 1]
         assert shader_rsc.heading["id"] == shader_rsc_id
     else:
-        shader = parse_shader_node_tree(escn_file, export_settings,
-                                        shader_node_tree)
+        cache = export_settings.get('conversion_cache')
+        if cache is not None and shader_node_tree in cache.shaders:
+            # converted for another file, only its textures are missing
+            shader = cache.shaders[shader_node_tree]
+            for image in shader.get_images():
+                export_texture(escn_file, export_settings, image)
+        else:
+            shader = parse_shader_node_tree(escn_file, export_settings,
+                                            shader_node_tree)
         if shader is None:
             raise ValidationError(
                 "Blender material '%s' not able to export as Shader Material"
                 % bl_node_mtl.name
             )
+        if cache is not None:
+            cache.shaders[shader_node_tree] = shader
 
         shader_rsc = ScriptShaderResource(shader_node_tree.name, shader)
         shader_rsc_id = escn_file.add_internal_resource(
@@ -1,4 +1,5 @@
 """Exports a normal triangle mesh"""
+import copy
 import logging
 import bpy
 import mathutils
@@ -60,7 +61,10 @@ def export_mesh_node(escn_file, export_settings, obj, parent_gd_node):
     # Transform of rigid mesh is moved up to its collision
     # shapes.
     if has_physics(obj):
-        mesh_node['transform'] = mathutils.Matrix.Identity(4)
+        # undo the offset of a primitive fitted to the collision shape
+        mesh_node['transform'] = getattr(
+            parent_gd_node, 'shape_offset', mathutils.Matrix.Identity(4)
+        ).inverted()
     else:
         mesh_node['transform'] = obj.matrix_local
 
@@ -129,6 +133,14 @@ class ArrayMeshResource(InternalResource):
         """Set a relation between material and surface"""
         self._mat_to_surf_mapping[material_index] = surface_id
 
+    def duplicate(self):
+        """Copy of the resource for another file, sharing the surfaces"""
+        mesh_resource = ArrayMeshResource('')
+        mesh_resource.update(self)
+        for material_index, surface_id in self._mat_to_surf_mapping.items():
+            mesh_resource.set_surface_id(material_index, surface_id)
+        return mesh_resource
+
 
 class ArrayMeshResourceExporter:
     """Export a mesh resource from a blender mesh object"""
@@ -140,6 +152,8 @@ class ArrayMeshResourceExporter:
         self.mesh_resource = None
         self.has_tangents = False
         self.vgroup_to_bone_mapping = dict()
+        # surface id -> blender material
+        self.surface_materials = dict()
 
     def init_mesh_bones_data(self, armature_obj, export_settings):
         """Find the mapping relation between vertex groups
@@ -162,6 +176,13 @@ class ArrayMeshResourceExporter:
         if mesh_id is not None:
             return mesh_id
 
+        cache = export_settings.get('conversion_cache')
+        if cache is not None and key in cache.meshes:
+            if cache.meshes[key] is None:
+                return None
+            return self.add_converted_mesh(
+                escn_file, export_settings, key, *cache.meshes[key])
+
         mesh = mesh_converter.to_mesh()
         self.has_tangents = mesh_converter.has_tangents
 
@@ -181,8 +202,25 @@ class ArrayMeshResourceExporter:
         # free mesh from memory
         mesh_converter.to_mesh_clear()
 
+        if cache is not None:
+            cache.meshes[key] = None
+            if mesh_id is not None:
+                cache.meshes[key] = (self.mesh_resource,
+                                     self.surface_materials)
         return mesh_id
 
+    def add_converted_mesh(self, escn_file, export_settings, key,
+                           mesh_resource, surface_materials):
+        """Add a mesh converted for another file, only the materials of its
+        surfaces are exported again"""
+        self.mesh_resource = mesh_resource.duplicate()
+        for surface_id, material in surface_materials.items():
+            surface = copy.copy(mesh_resource['surfaces/' + str(surface_id)])
+            surface.material = export_material(
+                escn_file, export_settings, self.object, material)
+            self.mesh_resource[surface.name_str] = surface
+        return escn_file.add_internal_resource(self.mesh_resource, key)
+
     @staticmethod
     def validate_morph_mesh_modifiers(mesh_object):
         """Check whether a mesh has modifiers not
@@ -288,6 +326,7 @@ class ArrayMeshResourceExporter:
                             self.object,
                             mat
                         )
+                        self.surface_materials[surface_index] = mat
 
             surface = surfaces[surface_index]
             vertex_indices = []
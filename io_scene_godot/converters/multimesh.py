@@ -1,11 +1,34 @@
 """Exports particles as multimesh to Godot"""
+import logging
 import math
 import bpy
 import mathutils
-
-from ..structures import (
-    NodeTemplate, InternalResource, mat4_to_string)
-from .mesh import ArrayMeshResourceExporter
+import numpy
+
+from ..structures import NodeTemplate, InternalResource
+from ..variant import GodotValue
+from .material import export_material
+from .mesh import (
+    ArrayMeshResourceExporter, get_modifier_armature, has_shape_keys)
+from .utils import MeshResourceKey
+
+# rotation applied to every particle: 90 degrees around X, then around Y,
+# then around Z, as a (w, x, y, z) quaternion
+PARTICLE_ROTATION_FIX = numpy.array(
+    mathutils.Quaternion((0.0, 0.0, 1.0), math.radians(90.0)) @
+    mathutils.Quaternion((0.0, 1.0, 0.0), math.radians(90.0)) @
+    mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(90.0))
+)
+
+# change of basis from blender z-up to godot y-up, see fix_matrix
+Z_UP_TO_Y_UP = numpy.array((
+    (1.0, 0.0, 0.0),
+    (0.0, 0.0, 1.0),
+    (0.0, -1.0, 0.0),
+))
+
+# float_to_string of the 12 values of a transform
+_TRANSFORM_FORMAT = ', '.join(['{:.6}'] * 12)
 
 
 def export_multimesh_node(escn_file, export_settings,
@@ -15,18 +38,14 @@ def export_multimesh_node(escn_file, export_settings,
     dg_eval = context.evaluated_depsgraph_get()
     obj_eval = context.object.evaluated_get(dg_eval)
 
+    if export_settings['multimesh_chunking'] != 'NONE':
+        return export_chunked_multimesh_node(
+            escn_file, export_settings, obj,
+            obj_eval.particle_systems.active, parent_gd_node)
+
     multimeshid_active = None
     for _ps in obj_eval.particle_systems:
-        # In Blender's particle system params, If "Render - Render As" are
-        # switched to "Collection", there maybe several objects instanced to
-        # one particle, but in Godot one MultiMeshInstance just have one
-        # object to instance, so choose the first object in Blender to display
-        # as the only one object in Godot's MultiMeshInstance's resource.
-        if (_ps.settings.instance_collection and
-                _ps.settings.instance_collection.all_objects[0]):
-            instance_object = _ps.settings.instance_collection.all_objects[0]
-        elif _ps.settings.instance_object:
-            instance_object = _ps.settings.instance_object
+        instance_object = get_instance_object(_ps)
 
         multimeshnode = NodeTemplate(
             _ps.name, 'MultiMeshInstance', parent_gd_node
@@ -55,6 +74,171 @@ def export_multimesh_node(escn_file, export_settings,
     return multimeshnode
 
 
+def get_instance_object(particle_system):
+    """Returns the object instanced by a particle system"""
+    # In Blender's particle system params, If "Render - Render As" are
+    # switched to "Collection", there maybe several objects instanced to
+    # one particle, but in Godot one MultiMeshInstance just have one
+    # object to instance, so choose the first object in Blender to display
+    # as the only one object in Godot's MultiMeshInstance's resource.
+    settings = particle_system.settings
+    if (settings.instance_collection and
+            settings.instance_collection.all_objects[0]):
+        return settings.instance_collection.all_objects[0]
+    return settings.instance_object
+
+
+def export_chunked_multimesh_node(escn_file, export_settings, obj,
+                                  particle_system, parent_gd_node):
+    """Export a blender particle system as one MultiMeshInstance for each
+    cell of a grid or an octree, grouped under a Spatial. Godot culls
+    each chunk by its own bounding box"""
+    group_node = NodeTemplate(
+        particle_system.name, 'Spatial', parent_gd_node)
+    group_node['visible'] = obj.visible_get()
+    escn_file.add_node(group_node)
+
+    instance_mesh_exporter = ArrayMeshResourceExporter(
+        get_instance_object(particle_system))
+    mesh_id = instance_mesh_exporter.export_mesh(escn_file, export_settings)
+
+    multimesh_exporter = MultiMeshResourceExporter(
+        obj, mesh_id, particle_system)
+    chunks = multimesh_exporter.export_multimesh_chunks(
+        escn_file, export_settings, particle_system.name)
+
+    for chunk_name, multimesh_id in chunks:
+        chunk_node = NodeTemplate(
+            chunk_name, 'MultiMeshInstance', group_node)
+        chunk_node['multimesh'] = 'SubResource({})'.format(multimesh_id)
+        if export_settings['multimesh_chunk_lod_distance'] > 0.0:
+            chunk_node['lod_max_distance'] = (
+                export_settings['multimesh_chunk_lod_distance'])
+        escn_file.add_node(chunk_node)
+
+    return group_node
+
+
+def grid_chunks(origins, cell_size):
+    """Split instances into the cells of a uniform grid. Return a list of
+    (cell coordinates, instance indices) of the non-empty cells"""
+    cells = numpy.floor(origins / cell_size).astype(numpy.int64)
+    # index of the cell of each instance among the non-empty cells, which
+    # does not overflow like a linear index of the whole grid
+    unique_cells, inverse, counts = numpy.unique(
+        cells, axis=0, return_inverse=True, return_counts=True)
+    order = numpy.argsort(inverse.ravel(), kind='stable')
+    return [(tuple(cell.tolist()), indices) for cell, indices in zip(
+        unique_cells, numpy.split(order, numpy.cumsum(counts)[:-1]))]
+
+
+def octree_chunks(origins, cell_size, max_instances):
+    """Split instances into the leaves of an octree, a cell is split in
+    eight while it holds more than `max_instances` instances and is larger
+    than `cell_size`. Return a list of (cell path, instance indices) of the
+    non-empty leaves, the path is the octant index at each level"""
+    low = origins.min(axis=0)
+    size = max(float(numpy.ptp(origins, axis=0).max()), cell_size)
+
+    chunks = list()
+    stack = [((), numpy.arange(len(origins)), low, size)]
+    while stack:
+        path, indices, corner, cell = stack.pop()
+        if len(indices) <= max_instances or cell <= cell_size:
+            chunks.append((path, indices))
+            continue
+        half = cell / 2
+        upper = origins[indices] >= corner + half
+        octants = upper[:, 0] * 1 + upper[:, 1] * 2 + upper[:, 2] * 4
+        for octant in range(7, -1, -1):
+            sub_indices = indices[octants == octant]
+            if len(sub_indices) > 0:
+                offset = numpy.array(
+                    (octant & 1, (octant >> 1) & 1, (octant >> 2) & 1))
+                stack.append((path + (octant,), sub_indices,
+                              corner + offset * half, half))
+    return chunks
+
+
+def is_instanceable(obj):
+    """Returns True if a mesh object can be merged with its linked
+    duplicates into a MultiMeshInstance: it has no parent, no children,
+    no animation, no physics and no deformation"""
+    if obj.type != 'MESH' or obj.parent is not None or obj.children:
+        return False
+    if obj.rigid_body is not None or obj.constraints:
+        return False
+    if obj.particle_systems:
+        return False
+    anim_data = obj.animation_data
+    if anim_data is not None and (anim_data.action or
+                                  anim_data.nla_tracks or
+                                  anim_data.drivers):
+        return False
+    return not (has_shape_keys(obj.data) or get_modifier_armature(obj))
+
+
+def find_instance_groups(objects, export_settings):
+    """Group the instanceable objects sharing the same mesh resource and
+    materials, return the groups with at least as many objects as the
+    instance multimesh threshold"""
+    groups = dict()
+    for obj in objects:
+        # instances can't be hidden one by one, hidden objects are
+        # exported as hidden MeshInstances
+        if not is_instanceable(obj) or not obj.visible_get():
+            continue
+        materials = tuple(slot.material if slot.link == 'OBJECT' else None
+                          for slot in obj.material_slots)
+        # a MultiMeshInstance only has a material override for all the
+        # surfaces
+        if any(materials) and len(materials) > 1:
+            continue
+        key = (MeshResourceKey('ArrayMesh', obj, export_settings), materials)
+        groups.setdefault(key, list()).append(obj)
+
+    return [group for group in groups.values()
+            if len(group) >= export_settings['instance_multimesh_threshold']]
+
+
+def export_instance_multimesh_node(escn_file, export_settings, objects,
+                                   parent_gd_node):
+    """Export linked duplicates of a mesh as one MultiMeshInstance, the
+    instance transforms are the world matrices of the objects"""
+    first_object = objects[0]
+    mesh_id = ArrayMeshResourceExporter(first_object).export_mesh(
+        escn_file, export_settings)
+    if mesh_id is None:
+        return None
+
+    transforms = matrices_to_transforms(
+        numpy.array([obj.matrix_world for obj in objects]))
+    mesh_resource = MultiMeshResource(first_object.data.name)
+    mesh_resource['instance_count'] = '{}'.format(len(objects))
+    mesh_resource['mesh'] = 'SubResource({})'.format(mesh_id)
+    mesh_resource['transform_array'] = TransformArray(transforms)
+    multimesh_id = escn_file.force_add_internal_resource(mesh_resource)
+
+    multimesh_node = NodeTemplate(
+        first_object.data.name + 'Instances', 'MultiMeshInstance',
+        parent_gd_node)
+    multimesh_node['multimesh'] = 'SubResource({})'.format(multimesh_id)
+
+    slots = first_object.material_slots
+    if (slots and slots[0].link == 'OBJECT' and
+            slots[0].material is not None and
+            export_settings['material_mode'] != 'NONE'):
+        multimesh_node['material_override'] = export_material(
+            escn_file, export_settings, first_object, slots[0].material)
+
+    escn_file.add_node(multimesh_node)
+    logging.info(
+        "Exported %d objects using mesh '%s' as one MultiMeshInstance",
+        len(objects), first_object.data.name
+    )
+    return multimesh_node
+
+
 def has_particle(node):
     """Returns True if the object has particles"""
     context = bpy.context
@@ -96,10 +280,7 @@ class MultiMeshResourceExporter:
                 len(self.particle_system.particles))
             self.mesh_resource['mesh'] = 'SubResource({})'.format(
                 self.instance_mesh_id)
-            self.mesh_resource['transform_array'] = (
-                'PoolVector3Array({})'.format(
-                    converter.to_multimesh())
-                )
+            self.mesh_resource['transform_array'] = multimesh
 
             multimesh_id = escn_file.add_internal_resource(
                 self.mesh_resource, key)
@@ -107,6 +288,42 @@ class MultiMeshResourceExporter:
 
         return multimesh_id
 
+    def export_multimesh_chunks(self, escn_file, export_settings,
+                                particle_name):
+        """Saves one multimesh for each non-empty chunk of the particle
+        system into the escn file, return a list of (chunk name,
+        multimesh id)"""
+        transforms = MultiMeshConverter(self.particle_system).to_transforms()
+        if transforms.size == 0:
+            return []
+
+        origins = transforms[:, 9:]
+        cell_size = export_settings['multimesh_chunk_size']
+        if export_settings['multimesh_chunking'] == 'OCTREE':
+            chunks = octree_chunks(
+                origins, cell_size,
+                export_settings['multimesh_chunk_max_instances'])
+        else:
+            chunks = grid_chunks(origins, cell_size)
+
+        exported = list()
+        for cell, indices in chunks:
+            chunk_name = '{}_{}'.format(
+                particle_name, '_'.join(str(i) for i in cell))
+            key = (self.particle_system, cell)
+            multimesh_id = escn_file.get_internal_resource(key)
+            if multimesh_id is None:
+                mesh_resource = MultiMeshResource(chunk_name)
+                mesh_resource['instance_count'] = '{}'.format(len(indices))
+                mesh_resource['mesh'] = 'SubResource({})'.format(
+                    self.instance_mesh_id)
+                mesh_resource['transform_array'] = TransformArray(
+                    transforms[indices])
+                multimesh_id = escn_file.add_internal_resource(
+                    mesh_resource, key)
+            exported.append((chunk_name, multimesh_id))
+        return exported
+
 
 class MultiMeshResource(InternalResource):
     """Godot MultiMesh resource"""
@@ -128,40 +345,96 @@ class MultiMeshConverter:
     def __init__(self, particle_system):
         self.particle_system = particle_system
 
+    def to_transforms(self):
+        # pylint: disable-msg=too-many-locals
+        """Godot transforms of all the particles as a (n, 12) array, each
+        row is a basis in row major order followed by an origin"""
+        particles = self.particle_system.particles
+        count = len(particles)
+        locations = numpy.empty(count * 3, dtype=numpy.float32)
+        rotations = numpy.empty(count * 4, dtype=numpy.float32)
+        sizes = numpy.empty(count, dtype=numpy.float32)
+        particles.foreach_get('location', locations)
+        particles.foreach_get('rotation', rotations)
+        particles.foreach_get('size', sizes)
+
+        # fix the particle rotations and normalize them
+        fix_w, fix_x, fix_y, fix_z = PARTICLE_ROTATION_FIX
+        rot_w, rot_x, rot_y, rot_z = rotations.astype(
+            numpy.float64).reshape((-1, 4)).T
+        quats = numpy.stack((
+            fix_w * rot_w - fix_x * rot_x - fix_y * rot_y - fix_z * rot_z,
+            fix_w * rot_x + fix_x * rot_w + fix_y * rot_z - fix_z * rot_y,
+            fix_w * rot_y - fix_x * rot_z + fix_y * rot_w + fix_z * rot_x,
+            fix_w * rot_z + fix_x * rot_y - fix_y * rot_x + fix_z * rot_w,
+        ), axis=1)
+        lengths = numpy.linalg.norm(quats, axis=1)
+        lengths[lengths == 0.0] = 1.0
+        quats /= lengths[:, None]
+
+        # x and z components are swapped
+        quat_w, quat_z, quat_y, quat_x = quats.T
+        basis = numpy.stack((
+            1 - 2 * (quat_y * quat_y + quat_z * quat_z),
+            2 * (quat_x * quat_y - quat_w * quat_z),
+            2 * (quat_x * quat_z + quat_w * quat_y),
+            2 * (quat_x * quat_y + quat_w * quat_z),
+            1 - 2 * (quat_x * quat_x + quat_z * quat_z),
+            2 * (quat_y * quat_z - quat_w * quat_x),
+            2 * (quat_x * quat_z - quat_w * quat_y),
+            2 * (quat_y * quat_z + quat_w * quat_x),
+            1 - 2 * (quat_x * quat_x + quat_y * quat_y),
+        ), axis=1).reshape((-1, 3, 3))
+        basis *= sizes[:, None, None]
+
+        origins = locations.astype(numpy.float64).reshape((-1, 3))
+        origins[:, 2] -= 1.0
+
+        transforms = numpy.empty((count, 12))
+        transforms[:, :9] = (
+            Z_UP_TO_Y_UP @ basis @ Z_UP_TO_Y_UP.T).reshape((-1, 9))
+        transforms[:, 9:] = origins @ Z_UP_TO_Y_UP.T
+        return transforms
+
     def to_multimesh(self):
         """Evaluates object & converts to final multimesh, ready for export.
         The multimesh is only temporary."""
-        transform_array = []
-        float32array = ''
-        for _particle in self.particle_system.particles:
-            quat_x = mathutils.Quaternion((1.0, 0.0, 0.0), math.radians(90.0))
-            quat_y = mathutils.Quaternion((0.0, 1.0, 0.0), math.radians(90.0))
-            quat_z = mathutils.Quaternion((0.0, 0.0, 1.0), math.radians(90.0))
-            quat_a = _particle.rotation.copy()
-            quat_a.rotate(quat_x)
-            quat_a.rotate(quat_y)
-            quat_a.rotate(quat_z)
-            quat_a.normalize()
-            rot_tmp = quat_a[1]
-            quat_a[1] = quat_a[3]
-            quat_a[3] = rot_tmp
-
-            rot = quat_a
-            loc = _particle.location - mathutils.Vector((0, 0, 1))
-            scl = _particle.size
-
-            mat_sca_x = mathutils.Matrix.Scale(scl, 4, (1.0, 0.0, 0.0))
-            mat_sca_y = mathutils.Matrix.Scale(scl, 4, (0.0, 1.0, 0.0))
-            mat_sca_z = mathutils.Matrix.Scale(scl, 4, (0.0, 0.0, 1.0))
-
-            mat_rot = rot.to_matrix()
-            mat_trs = mathutils.Matrix.Translation(loc)
-
-            mat = (
-                mat_trs @ mat_rot.to_4x4() @ mat_sca_x @ mat_sca_y @ mat_sca_z
-            )
-
-            mat4 = mat.to_4x4()
-
-            transform_array.append(mat4_to_string(mat4, prefix='', suffix=''))
-        return ','.join(transform_array)
+        return TransformArray(self.to_transforms())
+
+
+def matrices_to_transforms(matrices):
+    """Convert (n, 4, 4) blender matrices to the (n, 12) godot transforms
+    of a MultiMesh"""
+    transforms = numpy.empty((len(matrices), 12))
+    transforms[:, :9] = (
+        Z_UP_TO_Y_UP @ matrices[:, :3, :3] @ Z_UP_TO_Y_UP.T).reshape((-1, 9))
+    transforms[:, 9:] = matrices[:, :3, 3] @ Z_UP_TO_Y_UP.T
+    return transforms
+
+
+def transforms_to_string(transforms):
+    """Format a (n, 12) array of transforms as the content of a
+    MultiMesh transform_array"""
+    # same output as float_to_string, with a single format call for the
+    # whole array
+    values = numpy.where(numpy.abs(transforms) < 1e-15, 0.0, transforms)
+    return ','.join([_TRANSFORM_FORMAT] * len(values)).format(
+        *values.ravel().tolist())
+
+
+class TransformArray:
+    """MultiMesh transform_array holding a (n, 12) array of transforms,
+    given as it is to the binary backend instead of being formatted"""
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def to_string(self):
+        """Serialize the array as escn text"""
+        return 'PoolVector3Array({})'.format(
+            transforms_to_string(self.transforms))
+
+    def to_variant(self):
+        """The pool array written by the binary backend"""
+        return GodotValue('PoolVector3Array', numpy.where(
+            numpy.abs(self.transforms) < 1e-15, 0.0,
+            self.transforms).ravel())
@@ -5,9 +5,22 @@ physics owns the object.
 """
 
 import logging
+import numpy
 import mathutils
 from ..structures import NodeTemplate, InternalResource, Array, _AXIS_CORRECT
 from .utils import MeshConverter, MeshResourceKey
+from .convex_hull import ConvexHull
+from .convex_decomposition import convex_decomposition
+from .primitive_fitting import fit_primitive
+
+# custom property overriding the mesh shape decomposition export setting
+# for one object
+DECOMPOSITION_PROPERTY = 'godot_convex_decomposition'
+
+# Mesh collision shapes are only fitted to a primitive if none of their
+# vertices is deeper inside their convex hull than this, relative to the
+# size of the mesh
+FITTING_CONCAVITY = 0.01
 
 PHYSICS_TYPES = {'KinematicBody', 'RigidBody', 'StaticBody'}
 
@@ -56,6 +69,7 @@ def get_extents(node):
 
 def export_collision_shape(escn_file, export_settings, node, parent_gd_node,
                            parent_override=None):
+    # pylint: disable-msg=too-many-branches,too-many-statements
     """Exports the collision primitives/geometry"""
     col_name = node.name + 'Collision'
     col_node = NodeTemplate(col_name, "CollisionShape", parent_gd_node)
@@ -70,13 +84,33 @@ def export_collision_shape(escn_file, export_settings, node, parent_gd_node,
     rbd = node.rigid_body
 
     shape_id = None
+    shape_frame = None
     col_shape = None
-    if rbd.collision_shape in ("CONVEX_HULL", "MESH"):
+    part_nodes = list()
+    if (rbd.collision_shape in ("CONVEX_HULL", "MESH") and
+            export_settings['use_primitive_shape_fitting']):
+        shape_id, shape_frame = generate_fitted_shape(
+            escn_file, export_settings, node
+        )
+
+    if shape_id is not None:
+        # the shape is centered and oriented by its collision node, the
+        # mesh node moves back by the inverse
+        col_node['transform'] = (col_node['transform'] @
+                                 _AXIS_CORRECT.inverted() @ shape_frame @
+                                 _AXIS_CORRECT)
+        col_node.shape_offset = shape_frame
+        col_node['shape'] = "SubResource({})".format(shape_id)
+    elif rbd.collision_shape in ("CONVEX_HULL", "MESH"):
         is_convex = rbd.collision_shape == "CONVEX_HULL"
         if rbd.collision_shape == "CONVEX_HULL":
             shape_id = generate_convex_shape(
                 escn_file, export_settings, node
             )
+        elif use_convex_decomposition(export_settings, node):
+            shape_id, part_nodes = decomposed_collision_shapes(
+                escn_file, export_settings, node, col_node
+            )
         else:  # "MESH"
             shape_id = generate_concave_shape(
                 escn_file, export_settings, node
@@ -109,6 +143,8 @@ def export_collision_shape(escn_file, export_settings, node, parent_gd_node,
             col_shape['margin'] = rbd.collision_margin
 
     escn_file.add_node(col_node)
+    for part_node in part_nodes:
+        escn_file.add_node(part_node)
 
     return col_node
 
@@ -117,7 +153,8 @@ class MeshCollisionShapeKey:
     """Produces a resource key based on an mesh object's data and rigid
     propertys"""
     def __init__(self, shape_type, bl_object, export_settings):
-        assert shape_type in ("ConvexPolygonShape", "ConcavePolygonShape")
+        assert shape_type in ("ConvexPolygonShape", "ConcavePolygonShape",
+                              "ConvexDecomposition", "PrimitiveShape")
 
         mesh_data_key = MeshResourceKey(shape_type, bl_object, export_settings)
         # margin is the property that stores in CollisionShape in Godot
@@ -136,6 +173,42 @@ class MeshCollisionShapeKey:
                 self._data == other._data)
 
 
+def mesh_vertices_array(mesh):
+    """Read the vertex positions of a mesh into a (n, 3) numpy array"""
+    vertices = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float32)
+    mesh.vertices.foreach_get('co', vertices)
+    return vertices.reshape((-1, 3))
+
+
+def convex_hull_points(export_settings, mesh, bl_object):
+    """Return the points of a mesh lying on its convex hull, simplified
+    to the point budget of the export settings"""
+    points = mesh_vertices_array(mesh)
+    hull = ConvexHull(points)
+    if hull.is_degenerated:
+        # flat or too small mesh, keep all the points as before
+        return points.tolist()
+
+    max_points = export_settings['convex_hull_max_points']
+    if max_points > 0:
+        indices, error = hull.simplified_vertices(
+            max_points, export_settings['convex_hull_volume_error'])
+        if error > export_settings['convex_hull_volume_error']:
+            logging.warning(
+                "Convex shape of '%s' is reduced to %d points, losing "
+                "%.1f%% of its volume", bl_object.name, len(indices),
+                error * 100
+            )
+    else:
+        indices = hull.vertices
+
+    logging.info(
+        "Convex shape of '%s' has %d points out of %d vertices",
+        bl_object.name, len(indices), len(points)
+    )
+    return points[indices].tolist()
+
+
 def generate_convex_shape(escn_file, export_settings, bl_object):
     """Generates godots ConvexCollisionShape from a blender mesh object"""
     shape_rsc_key = MeshCollisionShapeKey(
@@ -152,7 +225,7 @@ def generate_convex_shape(escn_file, export_settings, bl_object):
         calculate_tangents=False
     )
     if mesh is not None:
-        vert_array = [vert.co for vert in mesh.vertices]
+        vert_array = convex_hull_points(export_settings, mesh, bl_object)
         col_shape = InternalResource("ConvexPolygonShape", mesh.name)
         col_shape['points'] = Array("PoolVector3Array(", values=vert_array)
         if bl_object.rigid_body.use_margin:
@@ -200,6 +273,147 @@ def generate_concave_shape(escn_file, export_settings, bl_object):
     return shape_id
 
 
+def generate_fitted_shape(escn_file, export_settings, bl_object):
+    """Fits a box, sphere, capsule or cylinder shape to a blender mesh
+    object. Returns the shape id and the transform of the shape in the
+    object space, shape id is None if no primitive fits well enough"""
+    mesh_converter = MeshConverter(bl_object, export_settings)
+    mesh = mesh_converter.to_mesh(
+        preserve_vertex_groups=False,
+        calculate_tangents=False
+    )
+    fit = None
+    if mesh is not None and mesh.vertices:
+        points = mesh_vertices_array(mesh)
+        fit = fit_primitive(points)
+        if fit is not None and bl_object.rigid_body.collision_shape == "MESH":
+            # a concave mesh must not be replaced by its hull
+            hull = ConvexHull(points)
+            diagonal = numpy.linalg.norm(numpy.ptp(points, axis=0))
+            if hull.inner_distances(points).max() > (
+                    FITTING_CONCAVITY * diagonal):
+                fit = None
+    mesh_converter.to_mesh_clear()
+
+    if fit is None or fit[3] > export_settings['primitive_fit_error']:
+        return None, None
+    shape_type, dimensions, frame, error = fit
+
+    col_shape = InternalResource(shape_type, bl_object.name + 'Collision')
+    for key, value in dimensions.items():
+        if key == 'extents':
+            col_shape[key] = mathutils.Vector(value.tolist())
+        else:
+            col_shape[key] = float(value)
+    if bl_object.rigid_body.use_margin:
+        col_shape['margin'] = bl_object.rigid_body.collision_margin
+
+    logging.info(
+        "Collision shape of '%s' is replaced by a %s, which leaves %.1f%% "
+        "of its volume uncovered", bl_object.name, shape_type, error * 100
+    )
+
+    # linked duplicates fit to the same primitive
+    shape_rsc_key = (
+        MeshCollisionShapeKey("PrimitiveShape", bl_object, export_settings),
+        shape_type
+    )
+    shape_id = escn_file.get_internal_resource(shape_rsc_key)
+    if shape_id is None:
+        shape_id = escn_file.add_internal_resource(col_shape, shape_rsc_key)
+    return shape_id, mathutils.Matrix(frame.tolist())
+
+
+def use_convex_decomposition(export_settings, bl_object):
+    """Returns True if the Mesh collision shape of an object is exported
+    as a convex decomposition"""
+    if DECOMPOSITION_PROPERTY in bl_object:
+        return bool(bl_object[DECOMPOSITION_PROPERTY])
+
+    mode = export_settings['mesh_shape_decomposition']
+    if mode == "RIGID_BODIES":
+        rbd = bl_object.rigid_body
+        return rbd.type == "ACTIVE" and not rbd.kinematic
+    return mode == "ALL"
+
+
+def decomposed_collision_shapes(escn_file, export_settings, bl_object,
+                                col_node):
+    """Returns the shape id of the first hull of a decomposition, which goes
+    to col_node (the mesh is parented to it), and sibling CollisionShape
+    nodes holding the other hulls"""
+    shape_ids = generate_decomposed_shapes(
+        escn_file, export_settings, bl_object
+    )
+    if not shape_ids:
+        return None, []
+
+    part_nodes = list()
+    for part_shape_id in shape_ids[1:]:
+        part_node = NodeTemplate(
+            col_node.get_name(), "CollisionShape", col_node.parent)
+        part_node['transform'] = col_node['transform'].copy()
+        part_node['shape'] = "SubResource({})".format(part_shape_id)
+        part_nodes.append(part_node)
+    return shape_ids[0], part_nodes
+
+
+def generate_decomposed_shapes(escn_file, export_settings, bl_object):
+    """Generates several godot ConvexPolygonShape approximating a blender
+    mesh object, return the list of their resource ids"""
+    shape_rsc_key = MeshCollisionShapeKey(
+        "ConvexDecomposition", bl_object, export_settings)
+    # one resource is registered per hull, keyed by the hull index
+    shape_ids = list()
+    while True:
+        shape_id = escn_file.get_internal_resource(
+            (shape_rsc_key, len(shape_ids)))
+        if shape_id is None:
+            break
+        shape_ids.append(shape_id)
+    if shape_ids:
+        return shape_ids
+
+    # No cached Shape found, build new one
+    mesh_converter = MeshConverter(bl_object, export_settings)
+    mesh = mesh_converter.to_mesh(
+        preserve_vertex_groups=False,
+        calculate_tangents=False
+    )
+    if mesh is not None and mesh.polygons:
+        mesh.calc_loop_triangles()
+        triangles = numpy.empty(len(mesh.loop_triangles) * 3,
+                                dtype=numpy.int32)
+        mesh.loop_triangles.foreach_get('vertices', triangles)
+
+        hulls = convex_decomposition(
+            mesh_vertices_array(mesh),
+            triangles.reshape((-1, 3)),
+            export_settings['decomposition_max_hulls'],
+            export_settings['decomposition_max_hull_points'],
+            export_settings['decomposition_concavity'],
+            export_settings.get('decomposition_cache')
+        )
+        logging.info(
+            "Mesh shape of '%s' is decomposed into %d convex hulls",
+            bl_object.name, len(hulls)
+        )
+
+        for index, points in enumerate(hulls):
+            col_shape = InternalResource("ConvexPolygonShape", mesh.name)
+            col_shape['points'] = Array(
+                "PoolVector3Array(", values=points.tolist())
+            if bl_object.rigid_body.use_margin:
+                col_shape['margin'] = bl_object.rigid_body.collision_margin
+
+            shape_ids.append(escn_file.add_internal_resource(
+                col_shape, (shape_rsc_key, index)))
+
+    mesh_converter.to_mesh_clear()
+
+    return shape_ids
+
+
 def export_physics_controller(escn_file, export_settings, node,
                               parent_gd_node):
     """Exports the physics body "type" as a separate node. In blender, the
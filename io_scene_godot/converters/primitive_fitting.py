@@ -0,0 +1,86 @@
+"""Fit primitive shapes (box, sphere, capsule, cylinder) around a point
+cloud, so that meshes which are really primitives can use the much cheaper
+primitive collision shapes of Godot"""
+import math
+import numpy
+from .convex_hull import ConvexHull
+
+
+def _candidate_rotations(points):
+    """Orientations tried for the primitives, as rotation matrices whose
+    columns are the primitive axes: the mesh axes and the principal axes
+    of the points"""
+    _, _, principal_axes = numpy.linalg.svd(
+        points - points.mean(axis=0), full_matrices=False)
+    rotation = principal_axes.T.copy()
+    if numpy.linalg.det(rotation) < 0:
+        rotation[:, 2] = -rotation[:, 2]
+    return numpy.identity(3), rotation
+
+
+def _frame(rotation, center):
+    """4x4 transform of a primitive"""
+    frame = numpy.identity(4)
+    frame[:3, :3] = rotation
+    frame[:3, 3] = center
+    return frame
+
+
+def _fit_candidates(points, rotation):
+    # pylint: disable-msg=too-many-locals
+    """Yield (volume, shape type, dimensions, frame) of the primitives
+    bounding the points in the orientation given by `rotation`. Godot
+    cylinders are along their Y axis, capsules along their Z axis"""
+    local = points @ rotation
+    low, high = local.min(axis=0), local.max(axis=0)
+    local_center = (low + high) / 2
+    half_size = (high - low) / 2
+    offsets = local - local_center
+    center = rotation @ local_center
+
+    yield (8.0 * numpy.prod(half_size), "BoxShape",
+           {'extents': half_size}, _frame(rotation, center))
+
+    radius = numpy.linalg.norm(offsets, axis=1).max()
+    yield (4.0 / 3.0 * math.pi * radius ** 3, "SphereShape",
+           {'radius': radius}, _frame(numpy.identity(3), center))
+
+    for axis in range(3):
+        others = [(axis + 1) % 3, (axis + 2) % 3]
+        radial = numpy.linalg.norm(offsets[:, others], axis=1)
+        radius = radial.max()
+
+        height = 2.0 * half_size[axis]
+        yield (math.pi * radius ** 2 * height, "CylinderShape",
+               {'radius': radius, 'height': height},
+               _frame(rotation[:, [others[1], axis, others[0]]], center))
+
+        # length of the cylinder part such that the points fit between
+        # the two half spheres
+        cap_depth = numpy.sqrt(numpy.maximum(radius ** 2 - radial ** 2, 0))
+        height = 2.0 * max(
+            0.0, (numpy.abs(offsets[:, axis]) - cap_depth).max())
+        yield (math.pi * radius ** 2 * (height + 4.0 / 3.0 * radius),
+               "CapsuleShape", {'radius': radius, 'height': height},
+               _frame(rotation[:, [others[0], others[1], axis]], center))
+
+
+def fit_primitive(points):
+    """Find the primitive bounding the points which fits them best.
+    Return (shape type, dimensions, frame, error), where frame is the 4x4
+    transform of the primitive in the space of the points and error the
+    part of the primitive volume not covered by the points convex hull.
+    None is returned for degenerated (flat) point clouds"""
+    hull = ConvexHull(points)
+    if hull.is_degenerated or hull.volume <= 0.0:
+        return None
+    hull_points = hull.points[hull.vertices]
+
+    # smallest volume, ties go to the earlier candidates (boxes)
+    volume, shape_type, dimensions, frame = min(
+        (candidate
+         for rotation in _candidate_rotations(hull_points)
+         for candidate in _fit_candidates(hull_points, rotation)),
+        key=lambda candidate: candidate[0]
+    )
+    return shape_type, dimensions, frame, 1.0 - hull.volume / volume
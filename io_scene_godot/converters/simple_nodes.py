@@ -8,16 +8,59 @@ import math
 import mathutils
 from ..structures import (
     NodeTemplate, fix_directional_transform, gamma_correct, InternalResource,
-    Map, Array
+    ExternalResource, ExtResourceReference, Map, Array
 )
 from .animation import export_animation_data, AttributeConvertInfo
 from .mesh import export_mesh_node
 
 
+class SceneInstanceNode(NodeTemplate):
+    """Node instancing a PackedScene, Godot takes its type from the root
+    of the instanced scene, which is a Spatial for exported collections"""
+    def __init__(self, name, scene_id, parent):
+        super().__init__(name, "Spatial", parent)
+        del self.heading['type']
+        self.heading['instance'] = ExtResourceReference(scene_id)
+
+    def get_type(self):
+        return "Spatial"
+
+
+def export_scene_instance_node(escn_file, scene_path, node,
+                               parent_gd_node):
+    """Converts an object into an instance of an exported scene, placed
+    at the object transform"""
+    scene_id = escn_file.get_external_resource(scene_path)
+    if scene_id is None:
+        scene_id = escn_file.add_external_resource(
+            ExternalResource(scene_path, "PackedScene"), scene_path)
+
+    instance_node = SceneInstanceNode(node.name, scene_id, parent_gd_node)
+    instance_node['transform'] = node.matrix_local
+    escn_file.add_node(instance_node)
+
+    return instance_node
+
+
+def export_collection_instance_node(escn_file, export_settings, node,
+                                    parent_gd_node):
+    """Converts an empty instancing a collection into an instance of the
+    scene the collection is exported to"""
+    scene_path = export_settings['collection_scene_func'](
+        node.instance_collection)
+    return export_scene_instance_node(
+        escn_file, scene_path, node, parent_gd_node)
+
+
 def export_empty_node(escn_file, export_settings, node, parent_gd_node):
     """Converts an empty (or any unknown node) into a spatial"""
     if "EMPTY" not in export_settings['object_types']:
         return parent_gd_node
+    if (export_settings['use_collection_instances'] and
+            node.instance_type == 'COLLECTION' and
+            node.instance_collection is not None):
+        return export_collection_instance_node(
+            escn_file, export_settings, node, parent_gd_node)
     empty_node = NodeTemplate(node.name, "Spatial", parent_gd_node)
     empty_node['transform'] = node.matrix_local
     escn_file.add_node(empty_node)
@@ -0,0 +1,168 @@
+"""Finds object hierarchies repeated in the scene, for example copies of a
+door made of a frame, a leaf and a handle. Such a hierarchy is exported
+once as a scene of its own, and each copy as an instance of that scene"""
+from .physics import get_physics_root
+from .utils import MeshResourceKey
+
+MESH_TYPES = {"MESH", "CURVE", "SURFACE", "META", "FONT"}
+
+# precision of the local transforms compared between hierarchies
+TRANSFORM_DIGITS = 5
+
+
+def _is_descendant(obj, root):
+    """Returns True if obj is root or one of its descendants"""
+    while obj is not None:
+        if obj == root:
+            return True
+        obj = obj.parent
+    return False
+
+
+def _physics_signature(obj):
+    """Hashable rigid body settings of an object"""
+    rbd = obj.rigid_body
+    if rbd is None:
+        return None
+    return (
+        rbd.type, rbd.kinematic, rbd.collision_shape, rbd.mass,
+        rbd.friction, rbd.restitution, rbd.use_margin, rbd.collision_margin,
+        rbd.linear_damping, rbd.angular_damping, rbd.use_deactivation,
+        rbd.use_start_deactivated, tuple(rbd.collision_collections),
+    )
+
+
+def _animation_signature(obj):
+    """Hashable animation of an object, False if it can not be shared"""
+    anim_data = obj.animation_data
+    if anim_data is None:
+        return None
+    if anim_data.drivers:
+        # drivers read other objects
+        return False
+    return (anim_data.action, tuple(
+        strip.action for track in anim_data.nla_tracks
+        for strip in track.strips))
+
+
+class SubtreeSignatures:
+    """Structural hash of the exported hierarchies: two objects get the
+    same signature if their subtrees would export to the same nodes and
+    resources, apart from the transform of the object itself"""
+
+    def __init__(self, export_settings, valid_objects, exporting_objects):
+        self.export_settings = export_settings
+        self.valid_objects = valid_objects
+        self.exporting_objects = exporting_objects
+        self._signatures = dict()
+
+    def _object_signature(self, obj, root):
+        # pylint: disable-msg=too-many-return-statements
+        """Hashable content of one object of the subtree under root, None
+        if the object can not be part of a shared scene"""
+        if obj.constraints or obj.parent_bone or obj.particle_systems:
+            return None
+        for modifier in obj.modifiers:
+            if (modifier.type == 'ARMATURE' and
+                    not _is_descendant(modifier.object, root)):
+                return None
+        animation = _animation_signature(obj)
+        if animation is False:
+            return None
+
+        if obj.type in MESH_TYPES:
+            data = MeshResourceKey('ArrayMesh', obj, self.export_settings)
+        else:
+            data = obj.data
+
+        transform = None
+        if obj != root:
+            transform = tuple(round(value, TRANSFORM_DIGITS)
+                              for row in obj.matrix_local for value in row)
+
+        return (
+            obj.type, obj in self.exporting_objects, data,
+            tuple((slot.link, slot.material) for slot in obj.material_slots),
+            transform, _physics_signature(obj), animation,
+            obj.instance_type, obj.instance_collection,
+        )
+
+    def _subtree_signature(self, obj, root):
+        """Signature of obj and its exported descendants"""
+        own = self._object_signature(obj, root)
+        if own is None:
+            return None
+        children = list()
+        for child in obj.children:
+            if child not in self.valid_objects:
+                continue
+            child_signature = self._subtree_signature(child, root)
+            if child_signature is None:
+                return None
+            children.append(child_signature)
+        return (own, tuple(children))
+
+    def get(self, root):
+        """Signature of the subtree under root, None if it can not be
+        exported as a shared scene"""
+        if root not in self._signatures:
+            signature = None
+            # collision shapes of the subtree would go to a physics body
+            # outside of it, and an animation of the root would replace
+            # the transform of the instance
+            if (get_physics_root(root) is None and
+                    _animation_signature(root) is None):
+                signature = self._subtree_signature(root, root)
+            self._signatures[root] = signature
+        return self._signatures[root]
+
+
+def find_repeated_subtrees(root_objects, export_settings, valid_objects,
+                           exporting_objects):
+    """Find the largest hierarchies (an object and at least one child)
+    appearing several times. Return a dict mapping the root object of each
+    copy to the signature shared by the copies"""
+    signatures = SubtreeSignatures(
+        export_settings, valid_objects, exporting_objects)
+
+    def has_children(obj):
+        return any(child in valid_objects for child in obj.children)
+
+    # armature -> the objects it deforms
+    deformed_objects = dict()
+    for obj in valid_objects:
+        for modifier in obj.modifiers:
+            if modifier.type == 'ARMATURE' and modifier.object is not None:
+                deformed_objects.setdefault(modifier.object, list()).append(
+                    obj)
+
+    def deforms_outside(root):
+        """Whether an armature of the subtree under root deforms an object
+        out of it, which could not point to the skeleton"""
+        return any(
+            not _is_descendant(obj, root)
+            for armature, objects in deformed_objects.items()
+            if _is_descendant(armature, root) for obj in objects)
+
+    counts = dict()
+    for obj in valid_objects:
+        if has_children(obj):
+            signature = signatures.get(obj)
+            if signature is not None:
+                counts[signature] = counts.get(signature, 0) + 1
+
+    # top down, so that a repeated hierarchy is not split into repeated
+    # sub-hierarchies
+    repeated = dict()
+    stack = list(reversed(root_objects))
+    while stack:
+        obj = stack.pop()
+        if has_children(obj):
+            signature = signatures.get(obj)
+            if (signature is not None and counts[signature] > 1 and
+                    not deforms_outside(obj)):
+                repeated[obj] = signature
+                continue
+        stack.extend(reversed([child for child in obj.children
+                               if child in valid_objects]))
+    return repeated
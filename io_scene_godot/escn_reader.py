@@ -0,0 +1,343 @@
+"""Streaming reader of escn and tres files. The file is read in chunks and
+split into the text of its entries, which are parsed one at a time into
+ParsedEntry, so files much larger than the memory can be walked. The
+numeric pool arrays longer than a threshold are not kept in the entry
+text, they are replaced by a LazyPoolArray which reads and parses them
+from the file when accessed"""
+import re
+import itertools
+import numpy
+
+from .variant import (POOL_ARRAY_ALIASES, POOL_ARRAY_DTYPES, GodotValue,
+                      VariantParser, pool_array_components, values_close)
+
+READ_SIZE = 1 << 20
+
+# pool arrays with more bytes of text are parsed on access
+LAZY_THRESHOLD = 1 << 16
+
+# components compared at once between two lazy arrays
+BLOCK_SIZE = 1 << 16
+
+# placeholder written into the entry text instead of a lazy array
+LAZY_NAME = '__lazy__'
+
+_SPECIAL_RE = re.compile(rb'["\n;\[\]\(\)\{\}]')
+_STRING_SPECIAL_RE = re.compile(rb'["\\]')
+_TAIL_IDENTIFIER_RE = re.compile(rb'([A-Za-z_][A-Za-z0-9_]*)\s*$')
+
+
+class LazyPoolArray(GodotValue):
+    """A numeric pool array of a file, its text is read and parsed the
+    first time `args` is accessed"""
+    # pylint: disable-msg=super-init-not-called
+    def __init__(self, name, path, offset, length, count):
+        self.name = name
+        self.path = path
+        # bytes between the parentheses
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self._args = None
+
+    def __repr__(self):
+        return "LazyPoolArray({!r}, {} components)".format(
+            self.name, self.count)
+
+    __hash__ = GodotValue.__hash__
+
+    @property
+    def args(self):
+        """Numpy array of the components"""
+        if self._args is None:
+            self._args = pool_array_components(
+                self.name, self.read_text())
+        return self._args
+
+    def read_text(self):
+        """Text between the parentheses, as written in the file"""
+        with open(self.path, 'rb') as stream:
+            stream.seek(self.offset)
+            return stream.read(self.length).decode('ascii')
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """Yield the components in numpy arrays of block_size items (the
+        last may be shorter), reading the file in bounded memory"""
+        carry = numpy.empty(0, dtype=POOL_ARRAY_DTYPES[self.name])
+        remainder = b''
+        with open(self.path, 'rb') as stream:
+            stream.seek(self.offset)
+            left = self.length
+            while left > 0:
+                data = stream.read(min(READ_SIZE, left))
+                if not data:
+                    break
+                left -= len(data)
+                data = remainder + data
+                remainder = b''
+                if left > 0:
+                    cut = data.rfind(b',') + 1
+                    data, remainder = data[:cut], data[cut:]
+                carry = numpy.concatenate((carry, pool_array_components(
+                    self.name, data.decode('ascii'))))
+                while carry.size >= block_size:
+                    yield carry[:block_size]
+                    carry = carry[block_size:]
+        if carry.size:
+            yield carry
+
+    def close_to(self, other, tolerance):
+        if not isinstance(other, LazyPoolArray):
+            return super().close_to(other, tolerance)
+        if self.name != other.name or self.count != other.count:
+            return False
+        for first, second in itertools.zip_longest(
+                self.iter_blocks(), other.iter_blocks()):
+            if first is None or second is None or not values_close(
+                    first, second, tolerance):
+                return False
+        return True
+
+    def to_string(self):
+        return '{}({})'.format(self.name, self.read_text())
+
+
+class _EntryParser(VariantParser):
+    """Parser of the text of a single entry, with its lazy arrays"""
+    def __init__(self, text, lazy_arrays):
+        super().__init__(text)
+        self.lazy_arrays = lazy_arrays
+
+    def parse_constructor(self, name):
+        if name == LAZY_NAME:
+            index = super().parse_constructor(name).args[0]
+            return self.lazy_arrays[index]
+        return super().parse_constructor(name)
+
+
+class EntrySplitter:
+    """Split a binary stream into the text of its entries. An entry starts
+    with a '[' at the start of a line, outside of any string or value"""
+    def __init__(self, stream, path, lazy_threshold=LAZY_THRESHOLD):
+        self.stream = stream
+        self.path = path
+        self.lazy_threshold = lazy_threshold
+        self.buffer = b''
+        # offset in the file of buffer[0]
+        self.offset = 0
+        self.pos = 0
+
+    def fill(self):
+        """Drop the consumed part of the buffer and read the next chunk,
+        False at the end of the stream"""
+        data = self.stream.read(READ_SIZE)
+        if not data:
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def error(self, message):
+        """Raise a ValueError at the current position"""
+        raise ValueError("{} at byte {} of {}".format(
+            message, self.offset + self.pos, self.path))
+
+    def skip_string(self, text):
+        """Append the rest of a string, after its opening quote, to text"""
+        while True:
+            match = _STRING_SPECIAL_RE.search(self.buffer, self.pos)
+            if match is None or (match.group(0) == b'\\' and
+                                 match.start() + 1 >= len(self.buffer)):
+                # keep an escape together with the escaped byte
+                end = len(self.buffer) if match is None else match.start()
+                text += self.buffer[self.pos:end]
+                self.pos = end
+                if not self.fill():
+                    self.error("Unterminated string")
+                continue
+            end = match.end() + (1 if match.group(0) == b'\\' else 0)
+            text += self.buffer[self.pos:end]
+            self.pos = end
+            if match.group(0) == b'"':
+                return
+
+    def skip_pool_array(self):
+        """Skip the content of a pool array after its '(', return the text
+        (None if longer than the lazy threshold), its length in bytes
+        and its number of components"""
+        pieces = list()
+        length = 0
+        commas = 0
+        while True:
+            end = self.buffer.find(b')', self.pos)
+            stop = len(self.buffer) if end == -1 else end
+            piece = self.buffer[self.pos:stop]
+            length += len(piece)
+            commas += piece.count(b',')
+            if pieces is not None:
+                pieces.append(piece)
+                if length > self.lazy_threshold:
+                    pieces = None
+            self.pos = stop
+            if end != -1:
+                self.pos += 1
+                text = None if pieces is None else b''.join(pieces)
+                return text, length, commas + 1
+            if not self.fill():
+                self.error("Unterminated pool array")
+
+    def pool_array(self, text, lazy_arrays):
+        """Handle the '(' of a constructor, the last word of text is its
+        name. If it is a numeric pool array, append it to text, or a
+        placeholder of a LazyPoolArray if it is too long, and return True"""
+        match = _TAIL_IDENTIFIER_RE.search(bytes(text[-64:]))
+        name = match and match.group(1).decode('ascii')
+        name = POOL_ARRAY_ALIASES.get(name, name)
+        if name not in POOL_ARRAY_DTYPES:
+            return False
+        offset = self.offset + self.pos
+        array_text, length, count = self.skip_pool_array()
+        if array_text is not None:
+            text += b'(' + array_text + b')'
+            return True
+        del text[len(text) - len(match.group(0)):]
+        text += '{}({})'.format(LAZY_NAME, len(lazy_arrays)).encode('ascii')
+        lazy_arrays.append(
+            LazyPoolArray(name, self.path, offset, length, count))
+        return True
+
+    def __iter__(self):
+        """Yield (start, end, text, lazy_arrays) for each entry, start and
+        end are offsets in the file, the comments are not kept in text"""
+        # pylint: disable-msg=too-many-branches
+        text = bytearray()
+        lazy_arrays = list()
+        start = None
+        depth = 0
+        previous = b'\n'
+        while True:
+            match = _SPECIAL_RE.search(self.buffer, self.pos)
+            if match is None:
+                text += self.buffer[self.pos:]
+                previous = self.buffer[-1:] or previous
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    break
+                continue
+            index = match.start()
+            char = match.group(0)
+            if index > self.pos:
+                previous = self.buffer[index - 1:index]
+                text += self.buffer[self.pos:index]
+            self.pos = index + 1
+            if char == b'[' and depth == 0 and previous == b'\n':
+                if start is not None:
+                    yield start, self.offset + index, bytes(text), lazy_arrays
+                text = bytearray()
+                lazy_arrays = list()
+                start = self.offset + index
+            if char == b';':
+                end = self.buffer.find(b'\n', self.pos)
+                while end == -1:
+                    self.pos = len(self.buffer)
+                    if not self.fill():
+                        break
+                    end = self.buffer.find(b'\n', self.pos)
+                self.pos = len(self.buffer) if end == -1 else end
+            elif char == b'(' and self.pool_array(text, lazy_arrays):
+                char = b')'
+            else:
+                text += char
+                if char == b'"':
+                    self.skip_string(text)
+                elif char in b'[{(':
+                    depth += 1
+                elif char in b']})':
+                    depth -= 1
+            previous = char
+        if start is not None:
+            yield start, self.offset + self.pos, bytes(text), lazy_arrays
+        elif text.strip():
+            self.error("Expected an entry")
+
+
+def iter_entries(path, lazy_threshold=LAZY_THRESHOLD):
+    """Yield the entries of an escn or tres file as ParsedEntry, their
+    `span` is the (start, end) byte range of the entry in the file"""
+    with open(path, 'rb') as stream:
+        for start, end, text, lazy_arrays in EntrySplitter(
+                stream, path, lazy_threshold):
+            entry = _EntryParser(
+                text.decode('utf-8'), lazy_arrays).parse_entry()
+            entry.span = (start, end)
+            yield entry
+
+
+def diff_entries(first, second, tolerance):
+    """Yield a description of each difference between two entries, the
+    floats may differ by the relative tolerance"""
+    heading = first.generate_heading_string()
+    if (first.entry_type != second.entry_type or
+            not values_close(first.heading, second.heading, tolerance)):
+        yield "heading {} differs from {}".format(
+            heading, second.generate_heading_string())
+        return
+    for key in first:
+        if key not in second:
+            yield "{} of {} is missing".format(key, heading)
+        elif not values_close(first[key], second[key], tolerance):
+            yield "{} of {} differs".format(key, heading)
+    for key in second:
+        if key not in first:
+            yield "{} of {} is added".format(key, heading)
+
+
+def diff_files(first_path, second_path, tolerance=1e-5):
+    """Yield a description of each difference between the entries of two
+    files, compared in order without loading either file at once"""
+    for first, second in itertools.zip_longest(
+            iter_entries(first_path), iter_entries(second_path)):
+        if second is None:
+            yield "{} is missing".format(first.generate_heading_string())
+        elif first is None:
+            yield "{} is added".format(second.generate_heading_string())
+        else:
+            for difference in diff_entries(first, second, tolerance):
+                yield difference
+
+
+def splice_file(path, out_path, replacements):
+    """Write a copy of a file where the byte ranges in the keys of the
+    replacements dict, like the `span` of the entries, are replaced by
+    the text of their value. Everything else is copied as bytes, in
+    chunks"""
+    position = 0
+    with open(path, 'rb') as source, open(out_path, 'wb') as target:
+        for (start, end), value in sorted(replacements.items(),
+                                          key=lambda item: item[0]):
+            _copy_range(source, target, position, start)
+            target.write(value.encode('utf-8'))
+            position = end
+        _copy_range(source, target, position, None)
+
+
+def entry_text(entry):
+    """Text of a parsed entry followed by the blank line separating the
+    entries, the replacement of a whole span in splice_file"""
+    return entry.to_string() + '\n\n'
+
+
+def _copy_range(source, target, start, end):
+    """Copy the bytes [start, end) of source to target, up to the end of
+    the file if end is None"""
+    source.seek(start)
+    left = None if end is None else end - start
+    while left is None or left > 0:
+        size = READ_SIZE if left is None else min(READ_SIZE, left)
+        data = source.read(size)
+        if not data:
+            break
+        target.write(data)
+        if left is not None:
+            left -= len(data)
@@ -25,13 +25,19 @@ http://www.godotengine.org
 """
 
 import os
+import contextlib
 import collections
 import functools
 import logging
 import bpy
+import mathutils
 
 from . import structures
 from . import converters
+from . import external_resources
+from . import binary_resource
+from . import incremental
+from .conversion_cache import ConversionCache
 from .structures import (_AXIS_CORRECT, NodePath)
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s]: %(message)s")
@@ -58,6 +64,11 @@ def find_godot_project_dir(export_path):
     return project_dir
 
 
+def is_binary_path(path):
+    """Files exported with the .scn extension use the binary format"""
+    return os.path.splitext(path)[1].lower() == '.scn'
+
+
 class ExporterLogHandler(logging.Handler):
     """Custom handler for exporter, would report logging message
     to GUI"""
@@ -76,7 +87,26 @@ class ExporterLogHandler(logging.Handler):
             self.blender_op.report({'ERROR'}, record.message)
 
 
+class SubScene:
+    """Part of the blender scene exported as a scene of its own: the
+    content of an instanced collection, or a repeated hierarchy"""
+    def __init__(self, name, objects, offset, is_collection,
+                 world_space=False):
+        # pylint: disable-msg=too-many-arguments
+        self.name = name
+        self.objects = objects
+        # applied to the transforms of the root nodes
+        self.offset = offset
+        # instanced collections are often hidden or excluded from the view
+        # layer, their content is exported anyway
+        self.is_collection = is_collection
+        # objects whose parent is not part of the sub scene keep their world
+        # transform
+        self.world_space = world_space
+
+
 class GodotExporter:
+    # pylint: disable-msg=too-many-instance-attributes
     """Handles picking what nodes to export and kicks off the export process"""
 
     def export_object(self, obj, parent_gd_node):
@@ -86,10 +116,31 @@ class GodotExporter:
         if obj not in self.valid_objects:
             return
 
+        if obj in self.repeated_subtrees:
+            converters.SCENE_INSTANCE_EXPORTER(
+                self.escn_file, self.export_subtree_scene(obj), obj,
+                parent_gd_node)
+            return
+
+        exported_node = self.convert_object(obj, parent_gd_node)
+
+        for child in obj.children:
+            self.export_object(child, exported_node)
+
+    def convert_object(self, obj, parent_gd_node):
+        # pylint: disable-msg=too-many-branches
+        """Export a single object under parent_gd_node, return the node
+        its children go to"""
         logging.info("Exporting Blender object: %s", obj.name)
+        if self.entry_owners is not None:
+            mark = self.entry_owners.begin()
+            parent_info = (parent_gd_node.get_path(),
+                           parent_gd_node.get_type())
 
         prev_node = bpy.context.view_layer.objects.active
-        bpy.context.view_layer.objects.active = obj
+        # objects of an instanced collection may not be in the view layer
+        if obj.name in bpy.context.view_layer.objects:
+            bpy.context.view_layer.objects.active = obj
 
         # Figure out what function will perform the export of this object
         if obj.type not in converters.BLENDER_TYPE_TO_EXPORTER:
@@ -157,41 +208,37 @@ class GodotExporter:
                 "transform"
             )
 
-        for child in obj.children:
-            self.export_object(child, exported_node)
-
         bpy.context.view_layer.objects.active = prev_node
 
+        if self.entry_owners is not None:
+            self.entry_owners.end(obj, mark, parent_info, exported_node)
+        return exported_node
+
     def should_export_object(self, obj):
         """Checks if a node should be exported:"""
         if obj.type not in self.config["object_types"]:
             return False
         if self.config["use_included_in_render"] and obj.hide_render:
             return False
-        if self.config["use_visible_objects"]:
+        ignore_visibility = (self.sub_scene is not None and
+                             self.sub_scene.is_collection)
+        if not ignore_visibility and self.config["use_visible_objects"]:
             view_layer = bpy.context.view_layer
             if obj.name not in view_layer.objects:
                 return False
             if not obj.visible_get():
                 return False
 
-        if self.config["use_export_selected"] and not obj.select_get():
+        if (not ignore_visibility and self.config["use_export_selected"]
+                and not obj.select_get()):
             return False
 
         return True
 
-    def export_scene(self):
-        # pylint: disable-msg=too-many-branches
-        """Decide what objects to export, and export them!"""
-        logging.info("Exporting scene: %s", self.scene.name)
-
-        in_edit_mode = False
-        if bpy.context.object and bpy.context.object.mode == "EDIT":
-            in_edit_mode = True
-            bpy.ops.object.editmode_toggle()
-
-        # Decide what objects to export
-        for obj in self.scene.objects:
+    def select_objects(self, objects):
+        """Decide what objects to export"""
+        object_set = set(objects)
+        for obj in objects:
             if obj in self.exporting_objects:
                 continue
             if self.should_export_object(obj):
@@ -199,38 +246,138 @@ class GodotExporter:
                 # Ensure parents of current valid object is
                 # going to the exporting recursion
                 tmp = obj
-                while tmp is not None:
+                while tmp is not None and tmp in object_set:
                     if tmp not in self.valid_objects:
                         self.valid_objects.add(tmp)
                     else:
                         break
                     tmp = tmp.parent
+
+    def export_scene(self):
+        # pylint: disable-msg=too-many-branches
+        """Decide what objects to export, and export them!"""
+        logging.info("Exporting scene: %s", self.scene.name)
+
+        in_edit_mode = False
+        if bpy.context.object and bpy.context.object.mode == "EDIT":
+            in_edit_mode = True
+            bpy.ops.object.editmode_toggle()
+
+        if self.sub_scene is None:
+            objects = list(self.scene.objects)
+            root_name = self.scene.name
+        else:
+            objects = self.sub_scene.objects
+            root_name = self.sub_scene.name
+        object_set = set(objects)
+
+        self.select_objects(objects)
+        instance_groups = list()
+        if self.config['use_instance_multimesh']:
+            instance_groups = converters.find_instance_groups(
+                [obj for obj in objects if obj in self.exporting_objects],
+                self.config)
+            for group in instance_groups:
+                self.valid_objects.difference_update(group)
+                self.exporting_objects.difference_update(group)
+        if self.config['use_shared_subtrees'] and self.sub_scene is None:
+            self.repeated_subtrees = converters.find_repeated_subtrees(
+                [obj for obj in objects
+                 if obj in self.valid_objects and obj.parent is None],
+                self.config, self.valid_objects, self.exporting_objects)
         logging.info("Exporting %d objects", len(self.valid_objects))
 
+        # sample every constrained object in one pass over the timeline
+        self.config["constraint_baker"] = converters.bake_constrained_objects(
+            self.config, [obj for obj in objects if obj in self.valid_objects])
+
         # Scene root
         root_gd_node = structures.NodeTemplate(
-            self.scene.name,
+            root_name,
             "Spatial",
             None
         )
         self.escn_file.add_node(root_gd_node)
-        for obj in self.scene.objects:
-            if obj in self.valid_objects and obj.parent is None:
+        for obj in objects:
+            if obj in self.valid_objects and obj.parent not in object_set:
                 # recursive exporting on root object
                 self.export_object(obj, root_gd_node)
 
+        if self.sub_scene is not None:
+            if self.sub_scene.world_space:
+                self.apply_outside_parents(root_gd_node, object_set)
+            for gd_node in root_gd_node.children:
+                if 'transform' in gd_node:
+                    gd_node['transform'] = (
+                        self.sub_scene.offset @ gd_node['transform'])
+
+        for group in instance_groups:
+            multimesh_node = converters.INSTANCE_MULTIMESH_EXPORTER(
+                self.escn_file, self.config, group, root_gd_node)
+            if multimesh_node is not None and self.sub_scene is not None:
+                # the instances are placed by their world matrix
+                multimesh_node['transform'] = self.sub_scene.offset
+
+        if self.config['use_export_animation']:
+            self.optimize_animations()
+
         if "ARMATURE" in self.config['object_types']:
-            for bl_obj in self.bl_object_gd_node_map:
-                for mod in bl_obj.modifiers:
-                    if mod.type == "ARMATURE":
-                        mesh_node = self.bl_object_gd_node_map[bl_obj]
-                        skeleton_node = self.bl_object_gd_node_map[mod.object]
-                        mesh_node['skeleton'] = NodePath(
-                            mesh_node.get_path(), skeleton_node.get_path())
+            self.link_skeletons()
 
         if in_edit_mode:
             bpy.ops.object.editmode_toggle()
 
+    def apply_outside_parents(self, root_gd_node, object_set):
+        """Move the objects parented to an object outside of the sub scene
+        to where their parent puts them"""
+        for obj, gd_node in self.bl_object_gd_node_map.items():
+            if obj.parent is None or obj.parent in object_set:
+                continue
+            if obj.parent_bone:
+                logging.warning(
+                    "%s is parented to a bone of an armature not exported "
+                    "with it", obj.name)
+                continue
+            if gd_node is root_gd_node:
+                continue
+            # the transform of the object may be on a physics parent node
+            while gd_node.parent is not root_gd_node:
+                gd_node = gd_node.parent
+            if 'transform' in gd_node:
+                gd_node['transform'] = (
+                    obj.parent.matrix_world @ gd_node['transform'])
+
+    def link_skeletons(self, node_paths=None):
+        """Point the meshes deformed by an armature to its skeleton node.
+        node_paths gives the node of the armatures not converted by this
+        export, by object name"""
+        for bl_obj, mesh_node in self.bl_object_gd_node_map.items():
+            for mod in bl_obj.modifiers:
+                if mod.type != "ARMATURE" or mod.object is None:
+                    continue
+                if mod.object in self.bl_object_gd_node_map:
+                    skeleton_path = self.bl_object_gd_node_map[
+                        mod.object].get_path()
+                elif (node_paths is not None and
+                      mod.object.name in node_paths):
+                    skeleton_path = node_paths[mod.object.name]
+                else:
+                    # e.g. the armature is in an instanced collection
+                    logging.warning(
+                        "%s is deformed by armature %s, which is not in "
+                        "the same scene", bl_obj.name, mod.object.name)
+                    continue
+                mesh_node['skeleton'] = NodePath(
+                    mesh_node.get_path(), skeleton_path)
+
+    def optimize_animations(self):
+        """Post-process the exported animation tracks"""
+        if self.config['use_keyframe_reduction']:
+            converters.reduce_animation_keyframes(self.escn_file, self.config)
+        if self.config['use_track_optimization']:
+            converters.optimize_animation_tracks(self.escn_file)
+        converters.deduplicate_animations(self.escn_file)
+
     def load_supported_features(self):
         """According to `project.godot`, determine all new feature supported
         by that godot version"""
@@ -263,8 +410,64 @@ class GodotExporter:
             # godot >=3.1
             self.config["feature_bezier_track"] = True
 
-    def export(self):
-        """Begin the export"""
+    def export_sub_scene(self, key, sub_scene):
+        """Export a part of the scene as a scene of its own, next to the
+        exported file and named after it, and return its path. Each key is
+        exported once"""
+        if key in self.sub_scene_paths:
+            return self.sub_scene_paths[key]
+
+        stem, extension = os.path.splitext(self.path)
+        file_stem = "{}_{}".format(stem, bpy.path.clean_name(sub_scene.name))
+        used_paths = set(self.sub_scene_paths.values())
+        used_paths.add(self.path)
+        path = file_stem + extension
+        counter = 1
+        while path in used_paths:
+            path = file_stem + str(counter).zfill(3) + extension
+            counter += 1
+        self.sub_scene_paths[key] = path
+        logging.info("Exporting %s to %s", sub_scene.name, path)
+
+        with GodotExporter(path, dict(self.config), self.operator,
+                           sub_scene, self.sub_scene_paths) as exp:
+            exp.export()
+        return path
+
+    def export_collection_scene(self, collection):
+        """Export an instanced collection as a scene, return its path"""
+        return self.export_sub_scene(collection, SubScene(
+            collection.name,
+            list(collection.all_objects),
+            # the instance offset of a collection is its origin
+            mathutils.Matrix.Translation(-collection.instance_offset),
+            is_collection=True,
+            # objects of the collection may be parented to objects out of it
+            world_space=True
+        ))
+
+    def export_subtree_scene(self, root):
+        """Export a repeated hierarchy as a scene, return its path. The
+        first copy exported is used for all of them"""
+        objects = list()
+        stack = [root]
+        while stack:
+            obj = stack.pop()
+            objects.append(obj)
+            stack.extend(child for child in obj.children
+                         if child in self.valid_objects)
+
+        return self.export_sub_scene(self.repeated_subtrees[root], SubScene(
+            root.name,
+            objects,
+            # the copy transform goes to the instance node
+            root.matrix_local.inverted_safe(),
+            is_collection=False
+        ))
+
+    def new_escn_file(self):
+        """Start an empty file, tracking the owner of its entries for an
+        incremental export"""
         self.escn_file = structures.ESCNFile(structures.FileEntry(
             "gd_scene",
             collections.OrderedDict((
@@ -272,23 +475,126 @@ class GodotExporter:
                 ("format", 2)
             ))
         ))
+        if self.use_incremental:
+            self.entry_owners = incremental.EntryOwners(self.escn_file)
+
+    def export_changes(self, manifest):
+        """Convert only the objects whose fingerprint changed since the
+        export described by the manifest and patch them into the exported
+        file. Return False if a full export is needed"""
+        self.select_objects(list(self.scene.objects))
+        fingerprints = incremental.object_fingerprints(
+            self.valid_objects, self.exporting_objects, manifest.objects,
+            self.updated_objects)
+        changed = manifest.changed_objects(fingerprints)
+        if changed is None:
+            logging.info("Objects were added, removed or reparented, "
+                         "exporting all objects")
+            return False
+        self.converted_count = len(changed)
+        if not changed:
+            logging.info("No object changed since the previous export")
+            return True
+        logging.info("Exporting %d changed objects", len(changed))
+
+        in_edit_mode = False
+        if bpy.context.object and bpy.context.object.mode == "EDIT":
+            in_edit_mode = True
+            bpy.ops.object.editmode_toggle()
 
+        objects = {obj.name: obj for obj in self.valid_objects}
+        changed = [objects[name] for name in changed]
+        self.config["constraint_baker"] = converters.bake_constrained_objects(
+            self.config, changed)
+        stubs = incremental.StubNodes(self.scene.name)
+        for obj in changed:
+            info = manifest.objects[obj.name]
+            self.convert_object(
+                obj, stubs.get(info['parent_node'], info['parent_type']))
+        if self.config['use_export_animation']:
+            self.optimize_animations()
+        if "ARMATURE" in self.config['object_types']:
+            self.link_skeletons(manifest.node_paths())
+
+        if in_edit_mode:
+            bpy.ops.object.editmode_toggle()
+
+        self.escn_file.fix_paths(self.config)
+        if not manifest.patch(self.path, self.escn_file, self.entry_owners,
+                              fingerprints):
+            return False
+        manifest.save(self.path)
+        return True
+
+    def export(self):
+        """Begin the export"""
+        settings = None
+        self.use_incremental = (
+            self.config['use_incremental_export'] and
+            self.sub_scene is None and
+            incremental.is_supported(self.config, self.path))
+        if self.use_incremental:
+            settings = incremental.settings_fingerprint(
+                self.config, self.scene)
+            manifest = incremental.ExportManifest.load(self.path)
+            if manifest is not None and manifest.settings == settings:
+                self.new_escn_file()
+                if self.export_changes(manifest):
+                    return True
+                # start over
+                self.valid_objects = set()
+                self.exporting_objects = set()
+                self.bl_object_gd_node_map = {}
+
+        self.new_escn_file()
         self.export_scene()
+        self.converted_count = len(self.bl_object_gd_node_map)
         self.escn_file.fix_paths(self.config)
-        with open(self.path, 'w') as out_file:
-            out_file.write(self.escn_file.to_string())
+        if self.config['use_external_resources']:
+            external_resources.export_external_resources(
+                self.escn_file, self.config)
+        if is_binary_path(self.path):
+            binary_resource.write_binary_file(
+                binary_resource.escn_entries(self.escn_file), self.path)
+        elif self.use_incremental:
+            sections = incremental.write_scene(
+                self.escn_file, self.path, self.entry_owners)
+            incremental.ExportManifest.build(
+                settings,
+                incremental.object_fingerprints(
+                    self.valid_objects, self.exporting_objects),
+                self.entry_owners, sections
+            ).save(self.path)
+        else:
+            with open(self.path, 'w') as out_file:
+                out_file.write(self.escn_file.to_string())
 
         return True
 
-    def __init__(self, path, kwargs, operator):
+    # pylint: disable-msg=too-many-arguments
+    def __init__(self, path, kwargs, operator, sub_scene=None,
+                 sub_scene_paths=None, updated_objects=None):
         self.path = path
         self.operator = operator
         self.scene = bpy.context.scene
+        # part of the scene exported instead of the whole scene
+        self.sub_scene = sub_scene
+        # instanced collection or repeated hierarchy signature -> path of
+        # the scene it is exported to, shared by all the files of an export
+        # so that their paths are unique
+        self.sub_scene_paths = (
+            dict() if sub_scene_paths is None else sub_scene_paths)
+        # root object of repeated hierarchies -> their signature
+        self.repeated_subtrees = dict()
         self.config = kwargs
         self.config["path"] = path
         self.config["project_path_func"] = functools.partial(
             find_godot_project_dir, path
         )
+        self.config["collection_scene_func"] = self.export_collection_scene
+        # convex decompositions of the collision meshes, shared with the
+        # sub scenes
+        self.config.setdefault("decomposition_cache", dict())
         # valid object would contain object should be exported
         # and their parents to retain the hierarchy
         self.valid_objects = set()
@@ -303,6 +609,14 @@ class GodotExporter:
 
         self.escn_file = None
         self.bl_object_gd_node_map = {}
+        # owner of each entry of the file, for incremental exports
+        self.use_incremental = False
+        self.entry_owners = None
+        # names of the objects which may have changed since the previous
+        # incremental export, None if unknown
+        self.updated_objects = updated_objects
+        # number of objects converted by the last export
+        self.converted_count = 0
 
     def __enter__(self):
         return self
@@ -311,6 +625,95 @@ class GodotExporter:
         pass
 
 
+def split_export_path(filepath, name):
+    """Path of the file a scene or a collection is exported to, when each
+    one is exported to its own file"""
+    stem, extension = os.path.splitext(filepath)
+    return "{}_{}{}".format(stem, bpy.path.clean_name(name), extension)
+
+
+@contextlib.contextmanager
+def active_scene(scene):
+    """Make a scene the context scene, which the converters read"""
+    window = bpy.context.window
+    if window is not None:
+        previous_scene = window.scene
+        window.scene = scene
+        try:
+            yield
+        finally:
+            window.scene = previous_scene
+    elif scene == bpy.context.scene:
+        yield
+    elif hasattr(bpy.context, 'temp_override'):
+        with bpy.context.temp_override(
+                scene=scene, view_layer=scene.view_layers[0]):
+            yield
+    else:
+        raise structures.ValidationError(
+            "Exporting scene {} needs a window, or blender 3.2 in "
+            "background mode".format(scene.name))
+
+
+def export_scenes(filepath, kwargs, operator, scenes=None):
+    """Export each scene (all of them by default) to its own file, named
+    after filepath and the scene. Meshes, shaders and textures are
+    converted once for all the files. Return the paths by scene name"""
+    if scenes is None:
+        scenes = bpy.data.scenes
+    kwargs = dict(kwargs, conversion_cache=ConversionCache(),
+                  decomposition_cache=dict())
+    # the sub scenes are not exported to the files of the scenes
+    sub_scene_paths = {
+        path: path for path in
+        (split_export_path(filepath, scene.name) for scene in scenes)}
+    paths = dict()
+    for scene in scenes:
+        path = split_export_path(filepath, scene.name)
+        with active_scene(scene):
+            with GodotExporter(path, dict(kwargs), operator,
+                               sub_scene_paths=sub_scene_paths) as exp:
+                exp.export()
+        paths[scene.name] = path
+    return paths
+
+
+def export_collections(filepath, kwargs, operator, bl_collections=None):
+    """Export each top-level collection of the scene (or the given
+    collections) to its own file, named after filepath and the collection.
+    Meshes, shaders and textures are converted once for all the files.
+    Return the paths by collection name"""
+    scene = bpy.context.scene
+    if bl_collections is None:
+        bl_collections = scene.collection.children
+        if scene.collection.objects:
+            logging.warning(
+                "%d objects not in a collection are not exported",
+                len(scene.collection.objects))
+    kwargs = dict(kwargs, conversion_cache=ConversionCache(),
+                  decomposition_cache=dict())
+    # the sub scenes are not exported to the files of the collections
+    sub_scene_paths = {
+        path: path for path in
+        (split_export_path(filepath, collection.name)
+         for collection in bl_collections)}
+    paths = dict()
+    for collection in bl_collections:
+        path = split_export_path(filepath, collection.name)
+        sub_scene = SubScene(
+            collection.name,
+            list(collection.all_objects),
+            mathutils.Matrix.Identity(4),
+            is_collection=False,
+            world_space=True
+        )
+        with GodotExporter(path, dict(kwargs), operator, sub_scene,
+                           sub_scene_paths) as exp:
+            exp.export()
+        paths[collection.name] = path
+    return paths
+
+
 def save(operator, context, filepath="", **kwargs):
     """Begin the export"""
     exporter_log_handler = ExporterLogHandler(operator)
@@ -323,8 +726,13 @@ def save(operator, context, filepath="", **kwargs):
         object_types.remove("GEOMETRY")
         object_types |= {"MESH", "CURVE", "SURFACE", "META", "FONT"}
 
-    with GodotExporter(filepath, kwargs, operator) as exp:
-        exp.export()
+    if kwargs["export_split"] == "SCENES":
+        export_scenes(filepath, kwargs, operator)
+    elif kwargs["export_split"] == "COLLECTIONS":
+        export_collections(filepath, kwargs, operator)
+    else:
+        with GodotExporter(filepath, kwargs, operator) as exp:
+            exp.export()
 
     logging.getLogger().removeHandler(exporter_log_handler)
 
@@ -0,0 +1,283 @@
+"""Heavy resources (meshes, animations and shaders) can be saved to .tres
+files of their own next to the exported scene, which refers to them as
+external resources. Godot loads them separately from the scene, and
+re-exports only rewrite the files whose content changed"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import bpy
+
+from .structures import (ExternalResource, FileEntry, RESOURCE_REFERENCE_RE,
+                         reachable_resources)
+from .variant import GodotValue, ParsedEntry, entry_to_variants
+from .binary_resource import BinaryResourceWriter, map_references
+
+EXTERNAL_TYPES = ('ArrayMesh', 'Animation', 'Shader')
+
+# threads writing the resource files
+WRITER_THREADS = 4
+
+
+def _entry_body(entry_string, entry):
+    """Strip the heading from a serialized FileEntry"""
+    return entry_string[len(entry.generate_heading_string()):]
+
+
+def _file_stem(export_path):
+    return os.path.splitext(os.path.basename(export_path))[0]
+
+
+def _resource_paths(resources, export_path, extension):
+    """Map the id of each externalized resource to its file path, named
+    after the scene and the resource name so that re-exports write to the
+    same files"""
+    directory = os.path.dirname(export_path)
+    used_names = set()
+    paths = dict()
+    for resource in resources:
+        name = resource.get('resource_name', '').strip('"')
+        name = bpy.path.clean_name(name or resource.heading['type'])
+        file_name = "{}_{}".format(_file_stem(export_path), name)
+        unique_name = file_name
+        counter = 1
+        while unique_name in used_names:
+            unique_name = file_name + str(counter).zfill(3)
+            counter += 1
+        used_names.add(unique_name)
+        paths[resource.heading['id']] = os.path.join(
+            directory, unique_name + extension)
+    return paths
+
+
+class ResourceFileBuilder:
+    """Serializes an internal resource of an ESCNFile as a standalone
+    .tres file. The internal resources it depends on are copied into the
+    file, unless they are externalized too, then they are referenced"""
+    def __init__(self, escn_file, external_paths, entry_strings):
+        self.internal = {
+            resource.heading['id']: resource
+            for resource in escn_file.internal_resources
+        }
+        self.external = {
+            resource.heading['id']: resource
+            for resource in escn_file.external_resources
+        }
+        # id of externalized resource -> its .tres path
+        self.external_paths = external_paths
+        # id -> serialized internal resource
+        self.entry_strings = entry_strings
+        # id -> ids of the internal resources it refers to
+        self.references = escn_file.resource_references(entry_strings)
+
+    def entry_string(self, resource_id):
+        """Serialized internal resource"""
+        return self.entry_strings[resource_id]
+
+    def dependencies(self, resource_id):
+        """Internal resources referenced by a resource, directly or not,
+        in the order they must appear (dependencies first)"""
+        order = list()
+        visited = {resource_id}
+        stack = [(resource_id, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if expanded:
+                order.append(current)
+                continue
+            stack.append((current, True))
+            for ref_id in self.references[current]:
+                if (ref_id in self.internal and ref_id not in visited and
+                        ref_id not in self.external_paths):
+                    visited.add(ref_id)
+                    stack.append((ref_id, False))
+        order.remove(resource_id)
+        return order
+
+    def shared_dependencies(self, resource_ids):
+        """Dependencies of the resources which more than one of them or the
+        scene itself refer to, they are externalized too rather than
+        copied into each file"""
+        owners = collections.Counter(
+            dep for resource_id in resource_ids
+            for dep in self.dependencies(resource_id))
+        scene_ids = set(self.internal) - set(resource_ids)
+        scene_roots = [None] + [
+            resource_id for resource_id in scene_ids
+            if resource_id not in owners]
+        used_by_scene = reachable_resources(
+            self.references, scene_roots, scene_ids)
+        shared = {dep for dep, count in owners.items()
+                  if count > 1 or dep in used_by_scene}
+        # what a shared resource depends on goes with it to its file
+        return shared - {nested for dep in shared
+                         for nested in self.dependencies(dep)}
+
+    def layout(self, resource_id):
+        """The internal resources copied into the file of a resource, the
+        external resources of that file and the reference replacing each
+        reference of the copied resources, (kind, old id) -> (name, id)"""
+        dependencies = self.dependencies(resource_id)
+        references = {
+            ('Sub', dep): ('SubResource', index + 1)
+            for index, dep in enumerate(dependencies)
+        }
+        ext_entries = list()
+        for entry_id in dependencies + [resource_id]:
+            for kind, ref_id in RESOURCE_REFERENCE_RE.findall(
+                    self.entry_string(entry_id)):
+                key = (kind, int(ref_id))
+                if key in references:
+                    continue
+                if kind == 'Ext':
+                    ext = self.external[key[1]]
+                    entry = ExternalResource(ext.heading['path'],
+                                             ext.heading['type'])
+                else:
+                    entry = ExternalResource(
+                        os.path.basename(self.external_paths[key[1]]),
+                        self.internal[key[1]].heading['type'])
+                entry.heading['id'] = len(ext_entries) + 1
+                ext_entries.append(entry)
+                references[key] = ('ExtResource', entry.heading['id'])
+        return dependencies, ext_entries, references
+
+    def _heading(self, resource_id, ext_entries, dependencies):
+        return FileEntry('gd_resource', (
+            ('type', self.internal[resource_id].heading['type']),
+            ('load_steps', len(ext_entries) + len(dependencies) + 1),
+            ('format', 2),
+        ))
+
+    def _sub_heading(self, index, dependency):
+        return collections.OrderedDict((
+            ('id', index + 1),
+            ('type', self.internal[dependency].heading['type']),
+        ))
+
+    def build(self, resource_id):
+        """Return the content of the .tres file of a resource"""
+        dependencies, ext_entries, references = self.layout(resource_id)
+
+        def replace(match):
+            return '{}({})'.format(
+                *references[(match.group(1), int(match.group(2)))])
+
+        sections = [
+            self._heading(resource_id, ext_entries, dependencies).to_string()]
+        sections.extend(entry.to_string() for entry in ext_entries)
+        for index, entry_id in enumerate(dependencies + [resource_id]):
+            if entry_id == resource_id:
+                heading = '[resource]'
+            else:
+                heading = FileEntry('sub_resource', self._sub_heading(
+                    index, entry_id)).generate_heading_string()
+            body = _entry_body(self.entry_string(entry_id),
+                               self.internal[entry_id])
+            sections.append(
+                heading + RESOURCE_REFERENCE_RE.sub(replace, body))
+        return '\n\n'.join(sections) + '\n'
+
+    def build_entries(self, resource_id):
+        """Return the entries of the .res file of a resource, for the
+        binary backend, converted from the resources rather than parsed
+        from the text of the .tres file"""
+        dependencies, ext_entries, references = self.layout(resource_id)
+
+        def replace(value):
+            name, new_id = references[
+                (value.name.replace('Resource', ''), value.args[0])]
+            return GodotValue(name, [new_id])
+
+        entries = [self._heading(resource_id, ext_entries, dependencies)]
+        entries.extend(ext_entries)
+        for index, entry_id in enumerate(dependencies + [resource_id]):
+            if entry_id == resource_id:
+                entry = ParsedEntry('resource')
+            else:
+                entry = ParsedEntry('sub_resource', self._sub_heading(
+                    index, entry_id))
+            for key, value in entry_to_variants(
+                    self.internal[entry_id]).items():
+                entry[key] = map_references(value, replace)
+            entries.append(entry)
+        return entries
+
+
+def write_if_changed(path, data):
+    """Write a file unless it already has this content (bytes), return True
+    if it was written"""
+    if os.path.isfile(path):
+        with open(path, 'rb') as old_file:
+            old_digest = hashlib.sha1(old_file.read()).digest()
+        if old_digest == hashlib.sha1(data).digest():
+            return False
+    with open(path, 'wb') as out_file:
+        out_file.write(data)
+    return True
+
+
+def export_external_resources(escn_file, export_settings):
+    """Move the meshes, animations and shaders of the ESCNFile larger than
+    the threshold to .tres files (binary .res files when exporting a .scn),
+    must be called after fix_paths"""
+    threshold = export_settings['external_resource_threshold'] * 1024
+    entry_strings = dict()
+    resources = list()
+    for resource in escn_file.internal_resources:
+        if resource.heading['type'] not in EXTERNAL_TYPES:
+            continue
+        entry_string = resource.to_string()
+        if len(entry_string) >= threshold:
+            entry_strings[resource.heading['id']] = entry_string
+            resources.append(resource)
+    if not resources:
+        return
+
+    is_binary = export_settings['path'].lower().endswith('.scn')
+    resource_ids = {resource.heading['id'] for resource in resources}
+    builder = ResourceFileBuilder(
+        escn_file, dict.fromkeys(resource_ids), entry_strings)
+    shared = builder.shared_dependencies(resource_ids)
+    while shared:
+        resource_ids.update(shared)
+        builder.external_paths.update(dict.fromkeys(shared))
+        shared = builder.shared_dependencies(resource_ids)
+    resources = [resource for resource in escn_file.internal_resources
+                 if resource.heading['id'] in resource_ids]
+    paths = _resource_paths(resources, export_settings['path'],
+                            '.res' if is_binary else '.tres')
+    builder.external_paths.update(paths)
+    contents = list()
+    for resource in resources:
+        if is_binary:
+            contents.append(BinaryResourceWriter(
+                builder.build_entries(resource.heading['id'])).to_bytes())
+        else:
+            contents.append(
+                builder.build(resource.heading['id']).encode('utf-8'))
+
+    for resource in resources:
+        path = paths[resource.heading['id']]
+        escn_file.externalize_internal_resource(
+            resource,
+            ExternalResource(os.path.basename(path),
+                             resource.heading['type']),
+            path
+        )
+    # resources only used by the externalized ones were copied to their
+    # files
+    escn_file.remove_unused_resources({
+        dep for resource in resources
+        for dep in builder.dependencies(resource.heading['id'])},
+        builder.references)
+
+    with concurrent.futures.ThreadPoolExecutor(WRITER_THREADS) as pool:
+        written = list(pool.map(
+            write_if_changed,
+            [paths[resource.heading['id']] for resource in resources],
+            contents))
+    logging.info(
+        "Externalized %d resources, %d files unchanged",
+        len(resources), written.count(False))
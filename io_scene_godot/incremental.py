@@ -0,0 +1,705 @@
+"""Incremental export: a manifest next to the exported escn records, for
+each exported blender object, a fingerprint of the data it was converted
+from and the sections (nodes and resources) it produced, with their byte
+range in the file. The next export converts only the objects whose
+fingerprint changed and splices their sections into the existing file,
+copying everything else unmodified"""
+import os
+import re
+import json
+import hashlib
+import logging
+import collections
+import bpy
+import numpy
+
+from .structures import NodeTemplate, RESOURCE_REFERENCE_RE
+from .escn_reader import splice_file
+
+MANIFEST_VERSION = 1
+
+# nesting of the blender structures hashed into a fingerprint
+FINGERPRINT_DEPTH = 4
+
+# the items of larger collections are only hashed through foreach_get
+SMALL_COLLECTION = 256
+
+# properties changing without changing the export, or expensive to read
+_SKIPPED_PROPERTIES = {
+    'rna_type', 'matrix_world', 'parent', 'children', 'children_recursive',
+    'users', 'users_collection', 'users_scene', 'session_uid', 'original',
+    'is_evaluated', 'is_runtime_data', 'tag', 'bound_box', 'mode', 'select',
+    'select_head', 'select_tail', 'is_editmode', 'pixels', 'bindcode',
+    'is_dirty', 'preview', 'use_fake_user', 'total_vert_sel',
+    'total_edge_sel', 'total_face_sel',
+}
+
+_FOREACH_DTYPES = {
+    'FLOAT': numpy.float32,
+    'INT': numpy.int32,
+    'BOOLEAN': numpy.bool_,
+}
+
+# id=N in the heading of a resource
+_HEADING_ID_RE = re.compile(r' id=\d+')
+
+
+def is_supported(export_settings, path):
+    """Incremental export needs the sections of an object to depend only on
+    that object, which some options break"""
+    if os.path.splitext(path)[1].lower() != '.escn':
+        return False
+    if (export_settings['use_export_animation'] and
+            export_settings['animation_modes'] != 'ACTIONS'):
+        return False
+    return not any(export_settings[option] for option in (
+        'use_external_resources', 'use_collection_instances',
+        'use_shared_subtrees', 'use_instance_multimesh'))
+
+
+def settings_fingerprint(export_settings, scene):
+    """Hash of the export options and scene settings, a change of any of
+    them needs a full export"""
+    values = list()
+    for key in sorted(export_settings):
+        value = export_settings[key]
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value)
+        if key != 'path' and isinstance(
+                value, (str, int, float, bool, list, tuple)):
+            values.append((key, value))
+    values.append((scene.name, scene.frame_start, scene.frame_end,
+                   scene.render.fps, scene.render.fps_base))
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def _plain(value):
+    """Blender arrays, vectors and matrices as nested tuples"""
+    if isinstance(value, str):
+        return value
+    try:
+        return tuple(_plain(item) for item in value)
+    except TypeError:
+        return value
+
+
+def _array_size(prop):
+    """Number of values of a property, 1 if it is not an array"""
+    size = 1
+    for dimension in prop.array_dimensions:
+        if dimension:
+            size *= dimension
+    return size
+
+
+class Fingerprints:
+    """Hash of the blender data each object is exported from. Datablocks
+    used by several objects are only hashed once"""
+    def __init__(self):
+        self._datablocks = dict()
+
+    @staticmethod
+    def _hashed_types():
+        """Datablocks whose content is part of the fingerprint of the
+        objects using them, only their name for the others"""
+        return (
+            bpy.types.Mesh, bpy.types.Curve, bpy.types.MetaBall,
+            bpy.types.Material, bpy.types.NodeTree, bpy.types.Image,
+            bpy.types.Texture, bpy.types.Action, bpy.types.Key,
+            bpy.types.Light, bpy.types.Camera, bpy.types.Armature,
+            bpy.types.ParticleSettings,
+        )
+
+    def object_fingerprint(self, obj, is_exported):
+        """Fingerprint of an object, is_exported is False for the parents
+        of exported objects converted as empties"""
+        hasher = hashlib.sha1()
+        hasher.update(repr((obj.name, obj.type, is_exported)).encode('utf-8'))
+        self._hash_struct(hasher, obj, FINGERPRINT_DEPTH)
+        return hasher.hexdigest()
+
+    def _datablock_digest(self, datablock):
+        key = (type(datablock).__name__, datablock.name_full)
+        if key not in self._datablocks:
+            # a datablock referring back to itself is hashed by name
+            self._datablocks[key] = ''
+            hasher = hashlib.sha1()
+            self._hash_struct(hasher, datablock, FINGERPRINT_DEPTH)
+            self._datablocks[key] = hasher.hexdigest()
+        return self._datablocks[key]
+
+    def _hash_struct(self, hasher, struct, depth):
+        for prop in struct.bl_rna.properties:
+            identifier = prop.identifier
+            if identifier in _SKIPPED_PROPERTIES:
+                continue
+            try:
+                value = getattr(struct, identifier)
+            except (AttributeError, RuntimeError):
+                continue
+            hasher.update(identifier.encode('utf-8'))
+            if prop.type == 'POINTER':
+                self._hash_pointer(hasher, value, depth)
+            elif prop.type == 'COLLECTION':
+                self._hash_collection(hasher, value, prop.fixed_type, depth)
+            else:
+                hasher.update(repr(_plain(value)).encode('utf-8'))
+
+    def _hash_pointer(self, hasher, value, depth):
+        if value is None:
+            hasher.update(b'None')
+        elif isinstance(value, bpy.types.Object):
+            # objects used by modifiers or constraints, their data (the
+            # mesh of a boolean cutter, a curve to deform along, ...)
+            # changes the converted object too
+            hasher.update(repr((value.name, _plain(value.matrix_world)))
+                          .encode('utf-8'))
+            if isinstance(value.data, self._hashed_types()):
+                hasher.update(self._datablock_digest(value.data).encode())
+        elif isinstance(value, bpy.types.ID):
+            hasher.update(value.name_full.encode('utf-8'))
+            if isinstance(value, self._hashed_types()):
+                hasher.update(self._datablock_digest(value).encode())
+        elif depth > 0:
+            self._hash_struct(hasher, value, depth - 1)
+
+    def _hash_collection(self, hasher, collection, item_type, depth):
+        count = len(collection)
+        hasher.update(str(count).encode())
+        if depth <= 0 or not count or item_type is None:
+            return
+        for prop in item_type.properties:
+            if (prop.identifier in _SKIPPED_PROPERTIES or
+                    prop.type not in _FOREACH_DTYPES):
+                continue
+            values = numpy.empty(count * _array_size(prop),
+                                 dtype=_FOREACH_DTYPES[prop.type])
+            try:
+                collection.foreach_get(prop.identifier, values)
+            except (AttributeError, RuntimeError, TypeError):
+                continue
+            hasher.update(prop.identifier.encode('utf-8'))
+            hasher.update(values.tobytes())
+        if count <= SMALL_COLLECTION:
+            for item in collection:
+                if isinstance(item, bpy.types.ID):
+                    hasher.update(item.name_full.encode('utf-8'))
+                else:
+                    self._hash_struct(hasher, item, depth - 1)
+
+
+def object_fingerprints(objects, exporting_objects, previous=None,
+                        updated=None):
+    """Fingerprint and parent of the exported objects, by name. If the
+    names of the updated objects are given, the fingerprint of the others
+    is taken from the previous ones"""
+    fingerprints = Fingerprints()
+    result = dict()
+    for obj in objects:
+        if (updated is not None and obj.name not in updated and
+                obj.name in previous):
+            fingerprint = previous[obj.name]['fingerprint']
+        else:
+            fingerprint = fingerprints.object_fingerprint(
+                obj, obj in exporting_objects)
+        result[obj.name] = {
+            'fingerprint': fingerprint,
+            'parent': obj.parent.name if obj.parent in objects else None,
+        }
+    return result
+
+
+class EntryOwners:
+    """Records the blender object whose conversion added each entry of an
+    ESCNFile, and where the nodes of the object went"""
+    def __init__(self, escn_file):
+        self.escn_file = escn_file
+        # id() of an entry -> object name
+        self.owners = dict()
+        # object name -> parent node path and type, and exported node path
+        self.objects = collections.OrderedDict()
+
+    def begin(self):
+        """Mark the entries of the file before converting an object"""
+        resources = self.escn_file.internal_resources
+        return (len(self.escn_file.nodes),
+                resources[-1].heading['id'] if resources else 0,
+                len(self.escn_file.external_resources))
+
+    def end(self, obj, mark, parent_info, exported_node):
+        """Attribute the entries added since begin() to obj"""
+        node_count, last_resource_id, external_count = mark
+        for entry in self.escn_file.nodes[node_count:]:
+            self.owners[id(entry)] = obj.name
+        # resource ids are increasing along the list
+        for entry in reversed(self.escn_file.internal_resources):
+            if entry.heading['id'] <= last_resource_id:
+                break
+            self.owners[id(entry)] = obj.name
+        for entry in self.escn_file.external_resources[external_count:]:
+            self.owners[id(entry)] = obj.name
+        self.objects[obj.name] = {
+            'parent_node': parent_info[0],
+            'parent_type': parent_info[1],
+            'node': exported_node.get_path(),
+        }
+
+    def owner(self, entry):
+        """Name of the object which added entry, None if none did"""
+        return self.owners.get(id(entry))
+
+
+def _content_hash(text):
+    """Hash of the text of a section, without the id of a resource"""
+    return hashlib.sha1(
+        _HEADING_ID_RE.sub('', text, count=1).encode('utf-8')).hexdigest()
+
+
+def _sub_references(text):
+    """Ids of the internal resources a section refers to"""
+    return sorted({int(ref_id) for kind, ref_id in
+                   RESOURCE_REFERENCE_RE.findall(text) if kind == 'Sub'})
+
+
+def _section(kind, entry, text, owner):
+    """Manifest record of a section, without its byte range"""
+    return {
+        'kind': kind,
+        'id': entry.heading.get('id') if kind != 'node' else None,
+        'path': entry.get_path() if kind == 'node' else None,
+        'owner': owner,
+        'hash': _content_hash(text),
+        'refs': _sub_references(text),
+        'length': len(text.encode('utf-8')),
+    }
+
+
+def _assign_spans(sections):
+    """Set the byte range of sections written one after another, separated
+    by a blank line, with a line break after the last one"""
+    position = 0
+    for index, section in enumerate(sections):
+        separator = 1 if index == len(sections) - 1 else 2
+        section['start'] = position
+        position += section.pop('length') + separator
+        section['end'] = position
+
+
+def _set_load_steps(heading, resource_count):
+    """Godot loads each resource of the scene, then the scene"""
+    heading.heading['load_steps'] = resource_count + 1
+
+
+def write_scene(escn_file, path, entry_owners):
+    """Write the file as ESCNFile.to_string would, return the manifest
+    records of its sections"""
+    entries = [('heading', escn_file.heading)]
+    entries.extend(('ext_resource', entry)
+                   for entry in escn_file.external_resources)
+    entries.extend(('sub_resource', entry)
+                   for entry in escn_file.internal_resources)
+    entries.extend(('node', entry) for entry in escn_file.nodes)
+
+    _set_load_steps(escn_file.heading, len(escn_file.external_resources) +
+                    len(escn_file.internal_resources))
+    texts = list()
+    sections = list()
+    for kind, entry in entries:
+        text = entry.to_string()
+        texts.append(text)
+        sections.append(_section(kind, entry, text,
+                                 entry_owners.owner(entry)))
+    _assign_spans(sections)
+    with open(path, 'wb') as out_file:
+        out_file.write(('\n\n'.join(texts) + '\n').encode('utf-8'))
+    return sections
+
+
+class StubNodes:
+    """Nodes standing for the parents of the objects converted by an
+    incremental export, only their path and type are used"""
+    def __init__(self, root_name):
+        self.nodes = {'.': NodeTemplate(root_name, 'Spatial', None)}
+
+    def get(self, path, node_type):
+        """Stub node at the given path, not a child of any other node, so
+        that it does not rename the converted nodes"""
+        if path not in self.nodes:
+            parent_path, _, name = path.rpartition('/')
+            node = NodeTemplate(name, node_type, None)
+            node.heading = collections.OrderedDict((
+                ('name', name),
+                ('type', node_type),
+                ('parent', parent_path or '.'),
+            ))
+            self.nodes[path] = node
+        return self.nodes[path]
+
+
+class ExportManifest:
+    """Sidecar file of an incremental export"""
+    def __init__(self, settings, objects, sections):
+        self.settings = settings
+        # object name -> fingerprint, parent, nodes
+        self.objects = objects
+        # records of the sections of the file, in order
+        self.sections = sections
+        self.file_size = None
+        self.file_mtime = None
+
+    @staticmethod
+    def manifest_path(path):
+        """Path of the manifest of an exported file"""
+        return path + '.manifest'
+
+    @classmethod
+    def load(cls, path):
+        """Manifest of the exported file, None if there is none or if the
+        file was modified since"""
+        try:
+            with open(cls.manifest_path(path),
+                      encoding='utf-8') as manifest_file:
+                data = json.load(manifest_file)
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if (data.get('version') != MANIFEST_VERSION or
+                data['file_size'] != stat.st_size or
+                data['file_mtime'] != stat.st_mtime_ns):
+            logging.info("No valid manifest for %s, exporting all objects",
+                         path)
+            return None
+        manifest = cls(data['settings'], data['objects'], data['sections'])
+        manifest.file_size = data['file_size']
+        manifest.file_mtime = data['file_mtime']
+        return manifest
+
+    def save(self, path):
+        """Write the manifest of the file just written to path"""
+        stat = os.stat(path)
+        data = {
+            'version': MANIFEST_VERSION,
+            'settings': self.settings,
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime_ns,
+            'objects': self.objects,
+            'sections': self.sections,
+        }
+        with open(self.manifest_path(path), 'w',
+                  encoding='utf-8') as manifest_file:
+            json.dump(data, manifest_file, separators=(',', ':'))
+
+    @classmethod
+    def build(cls, settings, fingerprints, entry_owners, sections):
+        """Manifest of a full export"""
+        objects = collections.OrderedDict()
+        for name, info in entry_owners.objects.items():
+            objects[name] = dict(fingerprints[name], **info)
+        return cls(settings, objects, sections)
+
+    def changed_objects(self, fingerprints):
+        """Names of the objects whose fingerprint changed, in export order,
+        None if objects were added, removed or reparented"""
+        if set(fingerprints) != set(self.objects):
+            return None
+        changed = list()
+        for name, info in self.objects.items():
+            if fingerprints[name]['parent'] != info['parent']:
+                return None
+            if fingerprints[name]['fingerprint'] != info['fingerprint']:
+                changed.append(name)
+        return changed
+
+    def node_paths(self):
+        """Path of the node exported for each object"""
+        return {name: info['node'] for name, info in self.objects.items()}
+
+    def patch(self, path, escn_file, entry_owners, fingerprints):
+        """Splice the sections of the objects converted into escn_file into
+        the exported file, update the manifest. Return False if the
+        converted objects do not give the same nodes as before"""
+        patch = _Patch(self, escn_file, entry_owners)
+        if not patch.match_nodes():
+            return False
+        patch.map_external_resources()
+        if not patch.map_internal_resources():
+            return False
+        patch.remove_unused_resources()
+
+        temp_path = path + '.tmp'
+        splice_file(path, temp_path, patch.replacements())
+        os.replace(temp_path, path)
+        self.sections = patch.new_sections()
+        for name in entry_owners.objects:
+            self.objects[name]['fingerprint'] = (
+                fingerprints[name]['fingerprint'])
+        logging.info("Patched %d sections of %s", patch.changed_count, path)
+        return True
+
+
+class _Patch:
+    """Sections of the file replaced, added or removed by an incremental
+    export"""
+    # pylint: disable-msg=too-many-instance-attributes
+    def __init__(self, manifest, escn_file, entry_owners):
+        self.manifest = manifest
+        self.escn_file = escn_file
+        self.entry_owners = entry_owners
+        self.sections = manifest.sections
+        self.changed_owners = set(entry_owners.objects)
+        # index of an old section -> new text, '' to remove it
+        self.replaced = dict()
+        # (kind, text, section) inserted at the end of their kind
+        self.inserted = list()
+        # id in escn_file -> id in the patched file
+        self.external_ids = dict()
+        self.internal_ids = dict()
+        # (index of the old section, converted node)
+        self.new_nodes = list()
+        # ids of old resources identical to converted ones
+        self.reused_ids = set()
+        # ids of old resources of the converted objects given to nothing
+        self.free_ids = set()
+        self.changed_count = 0
+
+    def match_nodes(self):
+        """Replace the nodes of the converted objects, which must have the
+        same paths as before"""
+        old_nodes = dict()
+        for index, section in enumerate(self.sections):
+            if (section['kind'] == 'node' and
+                    section['owner'] in self.changed_owners):
+                old_nodes[section['path']] = index
+        new_nodes = dict()
+        for node in self.escn_file.nodes:
+            if (self.entry_owners.owner(node) not in self.changed_owners or
+                    node.get_path() in new_nodes):
+                return False
+            new_nodes[node.get_path()] = node
+        if set(old_nodes) != set(new_nodes):
+            logging.info("Nodes of the changed objects differ")
+            return False
+        self.new_nodes = [(old_nodes[path], node)
+                          for path, node in new_nodes.items()]
+        return True
+
+    def _remap(self, text):
+        """Point the references of a section of escn_file to the ids of
+        the patched file"""
+        def replace(match):
+            ids = self.internal_ids if match.group(1) == 'Sub' else (
+                self.external_ids)
+            return '{}Resource({})'.format(
+                match.group(1), ids[int(match.group(2))])
+        return RESOURCE_REFERENCE_RE.sub(replace, text)
+
+    def _old_resources(self, kind):
+        """Content hash -> index of the resources of a kind"""
+        return {section['hash']: index
+                for index, section in enumerate(self.sections)
+                if section['kind'] == kind}
+
+    def map_external_resources(self):
+        """Reuse the external resources already in the file"""
+        old = self._old_resources('ext_resource')
+        next_id = max([section['id'] for section in self.sections
+                       if section['kind'] == 'ext_resource'] + [0]) + 1
+        for entry in self.escn_file.external_resources:
+            entry_id = entry.heading['id']
+            index = old.get(_content_hash(entry.to_string()))
+            if index is not None:
+                self.external_ids[entry_id] = self.sections[index]['id']
+                continue
+            self.external_ids[entry_id] = next_id
+            entry.heading['id'] = next_id
+            next_id += 1
+            self.inserted.append(('ext_resource', entry.to_string(), entry))
+
+    def _kept_ids(self):
+        """Ids of the resources the sections of the objects not converted
+        refer to, directly or through other resources"""
+        resources = {section['id']: section for section in self.sections
+                     if section['kind'] == 'sub_resource'}
+        kept = set()
+        stack = [ref for section in self.sections
+                 if section['owner'] not in self.changed_owners
+                 for ref in section['refs']]
+        while stack:
+            resource_id = stack.pop()
+            if resource_id not in kept and resource_id in resources:
+                kept.add(resource_id)
+                stack.extend(resources[resource_id]['refs'])
+        return kept
+
+    def map_internal_resources(self):
+        """Give each converted resource an id in the patched file: the id
+        of an identical resource, else one of the ids of the resources
+        its object had before and nothing else refers to, else a new one"""
+        old = self._old_resources('sub_resource')
+        kept_ids = self._kept_ids()
+        free_ids = collections.OrderedDict()
+        for section in self.sections:
+            if (section['kind'] == 'sub_resource' and
+                    section['owner'] in self.changed_owners and
+                    section['id'] not in kept_ids):
+                free_ids.setdefault(section['owner'], []).append(
+                    section['id'])
+        taken_ids = set()
+        next_id = max([section['id'] for section in self.sections
+                       if section['kind'] == 'sub_resource'] + [0]) + 1
+
+        # (entry, its id in the patched file, identical old section index)
+        mapped = list()
+        pending = list(self.escn_file.internal_resources)
+        while pending:
+            ready = [entry for entry in pending if all(
+                ref in self.internal_ids
+                for ref in _sub_references(entry.to_string()))]
+            if not ready:
+                return False
+            for entry in ready:
+                pending.remove(entry)
+                index = old.get(_content_hash(self._remap(entry.to_string())))
+                if (index is not None and
+                        self.sections[index]['id'] not in taken_ids):
+                    final_id = self.sections[index]['id']
+                    for ids in free_ids.values():
+                        if final_id in ids:
+                            ids.remove(final_id)
+                else:
+                    index = None
+                    ids = free_ids.get(self.entry_owners.owner(entry))
+                    if ids:
+                        final_id = ids.pop(0)
+                        taken_ids.add(final_id)
+                    else:
+                        final_id = next_id
+                        next_id += 1
+                self.internal_ids[entry.heading['id']] = final_id
+                mapped.append((entry, final_id, index))
+        self.free_ids = {resource_id for ids in free_ids.values()
+                         for resource_id in ids}
+        self._insert_resources(mapped)
+        return True
+
+    def _insert_resources(self, mapped):
+        """Add the new and changed resources at the end of the resources,
+        with the identical ones referring to them, directly or not, as a
+        resource must be written before being referred to"""
+        written = {final_id for _, final_id, index in mapped
+                   if index is None}
+        moved = True
+        while moved:
+            moved = False
+            for _, final_id, index in mapped:
+                if (index is not None and final_id not in written and
+                        written.intersection(self.sections[index]['refs'])):
+                    written.add(final_id)
+                    moved = True
+        emitted = set()
+        for entry, final_id, index in mapped:
+            if final_id not in written:
+                self.reused_ids.add(final_id)
+                continue
+            if final_id in emitted:
+                # converted twice with the same content
+                continue
+            emitted.add(final_id)
+            entry.heading['id'] = final_id
+            text = self._remap(entry.to_string())
+            self.inserted.append(('sub_resource', text, entry))
+
+    def remove_unused_resources(self):
+        """Remove the old resources of the converted objects which are
+        neither reused nor referred to, and the ones written again at the
+        end of the resources. Replace the changed nodes"""
+        inserted_ids = {entry.heading['id'] for kind, _, entry
+                        in self.inserted if kind == 'sub_resource'}
+        for index, section in enumerate(self.sections):
+            if (section['kind'] == 'sub_resource' and
+                    section['owner'] in self.changed_owners and
+                    section['id'] not in self.reused_ids and
+                    (section['id'] in inserted_ids or
+                     section['id'] in self.free_ids)):
+                self.replaced[index] = ''
+        for index, node in self.new_nodes:
+            text = self._remap(node.to_string())
+            if _content_hash(text) != self.sections[index]['hash']:
+                self.replaced[index] = text
+
+    def _insert_position(self, kind):
+        """Index of the old section the sections of a kind are inserted
+        before: the first one after the last of that kind"""
+        order = ('heading', 'ext_resource', 'sub_resource', 'node')
+        for index, section in enumerate(self.sections):
+            if order.index(section['kind']) > order.index(kind):
+                return index
+        return len(self.sections)
+
+    def _insertions(self):
+        """Index of an old section -> the sections inserted before it"""
+        insertions = collections.OrderedDict()
+        # external resources first, they are all inserted before
+        for kind in ('ext_resource', 'sub_resource'):
+            for inserted in self.inserted:
+                if inserted[0] == kind:
+                    insertions.setdefault(
+                        self._insert_position(kind), []).append(inserted)
+        return insertions
+
+    def _update_load_steps(self):
+        """Rewrite the heading if the number of resources changed"""
+        # only resources are inserted
+        resource_count = len(self.inserted)
+        for index, section in enumerate(self.sections):
+            if (section['kind'] in ('ext_resource', 'sub_resource') and
+                    self.replaced.get(index) != ''):
+                resource_count += 1
+        heading = self.escn_file.heading
+        _set_load_steps(heading, resource_count)
+        text = heading.to_string()
+        for index, section in enumerate(self.sections):
+            if (section['kind'] == 'heading' and
+                    _content_hash(text) != section['hash']):
+                self.replaced[index] = text
+
+    def replacements(self):
+        """Byte range -> text, for splice_file"""
+        self._update_load_steps()
+        self.changed_count = len(self.replaced) + len(self.inserted)
+        replacements = dict()
+        for index, text in self.replaced.items():
+            section = self.sections[index]
+            if text:
+                text += '\n' if index == len(self.sections) - 1 else '\n\n'
+            replacements[(section['start'], section['end'])] = text
+        for index, inserted in self._insertions().items():
+            # never after the last section, nodes follow the resources
+            start = self.sections[index]['start']
+            replacements[(start, start)] = ''.join(
+                text + '\n\n' for _, text, _ in inserted)
+        return replacements
+
+    def new_sections(self):
+        """Manifest records of the sections of the patched file"""
+        sections = list()
+        insertions = self._insertions()
+        for index, section in enumerate(self.sections):
+            for kind, text, entry in insertions.get(index, ()):
+                sections.append(_section(
+                    kind, entry, text, self.entry_owners.owner(entry)))
+            text = self.replaced.get(index)
+            if text == '':
+                continue
+            if text is None:
+                section = dict(section)
+                section['length'] = (
+                    section['end'] - section['start'] -
+                    (1 if index == len(self.sections) - 1 else 2))
+            else:
+                section = dict(section, hash=_content_hash(text),
+                               refs=_sub_references(text),
+                               length=len(text.encode('utf-8')))
+            sections.append(section)
+        _assign_spans(sections)
+        return sections
@@ -0,0 +1,197 @@
+"""Live link: while running, the scene is exported again to the same file
+each time it is edited. The datablocks reported by the depsgraph updates
+are collected until the edits pause, then an incremental export converts
+only the objects using them and patches them into the exported file, so
+that Godot can reload it"""
+import time
+import logging
+import bpy
+
+from . import export_godot
+
+# seconds without depsgraph update before exporting
+DEBOUNCE_SECONDS = 0.5
+
+# updates of these datablocks don't change the exported objects (selection,
+# frame or user interface changes)
+_IGNORED_TYPES = (
+    'Scene', 'WindowManager', 'WorkSpace', 'Screen', 'Brush', 'Palette',
+    'Text')
+
+_LIVE_LINK = None
+
+
+def _used_datablocks(obj):
+    """The datablocks whose change can change the export of an object"""
+    used = [obj.data]
+    if obj.data is not None and getattr(obj.data, 'shape_keys', None):
+        used.append(obj.data.shape_keys)
+    for slot in obj.material_slots:
+        if slot.material is not None:
+            used.append(slot.material)
+            used.append(slot.material.node_tree)
+    if obj.animation_data is not None:
+        used.append(obj.animation_data.action)
+    return [datablock for datablock in used if datablock is not None]
+
+
+def _datablock_key(datablock):
+    return type(datablock).__name__, datablock.name
+
+
+class LiveLink:
+    """Exports the scene again after each pause in its edition"""
+
+    def __init__(self, path, export_settings):
+        self.path = path
+        self.export_settings = dict(export_settings)
+        self.export_settings['use_incremental_export'] = True
+        # (datablock type, name) -> (geometry updated, transform updated)
+        self.updates = dict()
+        self.last_update = 0.0
+        self.exporting = False
+        self.export_count = 0
+        self.export_time = 0.0
+
+    def collect(self, depsgraph):
+        """Record the datablocks of the depsgraph updates and schedule an
+        export once they stop"""
+        if self.exporting:
+            # the exporter changes frames and modes itself
+            return
+        for screen in bpy.data.screens:
+            if screen.is_animation_playing:
+                return
+        for update in depsgraph.updates:
+            datablock = update.id.original
+            key = _datablock_key(datablock)
+            if key[0] in _IGNORED_TYPES:
+                continue
+            geometry, transform = self.updates.get(key, (False, False))
+            self.updates[key] = (geometry or update.is_updated_geometry,
+                                 transform or update.is_updated_transform)
+        if not self.updates:
+            return
+        self.last_update = time.monotonic()
+        if not bpy.app.timers.is_registered(_flush):
+            bpy.app.timers.register(_flush, first_interval=DEBOUNCE_SECONDS)
+
+    def updated_objects(self, scene):
+        """Names of the objects whose export may have changed, or None if
+        an updated datablock can't be related to objects"""
+        users = dict()
+        for obj in scene.objects:
+            for datablock in _used_datablocks(obj):
+                users.setdefault(_datablock_key(datablock), set()).add(
+                    obj.name)
+        names = set()
+        for type_name, name in self.updates:
+            if type_name == 'Object':
+                names.add(name)
+            elif (type_name, name) in users:
+                names.update(users[(type_name, name)])
+            elif type_name != 'Collection':
+                # collections only add or remove objects, which is seen
+                # without fingerprinting anything
+                return None
+        return names
+
+    def flush(self):
+        """Export if no update came for DEBOUNCE_SECONDS, otherwise return
+        the delay before trying again"""
+        idle = time.monotonic() - self.last_update
+        if idle < DEBOUNCE_SECONDS:
+            return DEBOUNCE_SECONDS - idle
+        scene = bpy.context.scene
+        updated_objects = self.updated_objects(scene)
+        geometry_updates = sum(
+            geometry for geometry, _ in self.updates.values())
+        transform_updates = sum(
+            transform for _, transform in self.updates.values())
+
+        started = time.perf_counter()
+        self.exporting = True
+        try:
+            with export_godot.GodotExporter(
+                    self.path, dict(self.export_settings), None,
+                    updated_objects=updated_objects) as exporter:
+                exporter.export()
+        except Exception as error:  # pylint: disable=broad-except
+            # the updates are kept, the next export converts them again
+            logging.exception("Live link export failed")
+            _set_status("Godot live link: export failed ({})".format(error))
+            return None
+        finally:
+            self.exporting = False
+        duration = time.perf_counter() - started
+        # no update is recorded while exporting
+        self.updates = dict()
+
+        self.export_count += 1
+        self.export_time += duration
+        logging.info(
+            "Live link: %d objects exported in %.3f s after %d geometry and "
+            "%d transform updates", exporter.converted_count, duration,
+            geometry_updates, transform_updates)
+        _set_status(
+            "Godot live link: {} objects exported in {:.0f} ms, "
+            "{} exports averaging {:.0f} ms".format(
+                exporter.converted_count, duration * 1000, self.export_count,
+                self.export_time * 1000 / self.export_count))
+        return None
+
+
+def _set_status(text):
+    for window in bpy.context.window_manager.windows:
+        window.workspace.status_text_set(text)
+
+
+def _on_depsgraph_update(*args):
+    # blender 2.80 only passes the scene
+    depsgraph = (args[1] if len(args) > 1
+                 else bpy.context.evaluated_depsgraph_get())
+    if _LIVE_LINK is not None:
+        _LIVE_LINK.collect(depsgraph)
+
+
+def _flush():
+    if _LIVE_LINK is None:
+        return None
+    return _LIVE_LINK.flush()
+
+
+def _on_load_pre(*_args):
+    stop()
+
+
+def is_running():
+    """Whether a live link is running"""
+    return _LIVE_LINK is not None
+
+
+def start(path, export_settings):
+    """Export the scene to path again after each change, with the given
+    export settings, until stopped"""
+    global _LIVE_LINK  # pylint: disable=global-statement
+    stop()
+    _LIVE_LINK = LiveLink(path, export_settings)
+    bpy.app.handlers.depsgraph_update_post.append(_on_depsgraph_update)
+    bpy.app.handlers.load_pre.append(_on_load_pre)
+    _set_status("Godot live link: watching {}".format(path))
+    logging.info("Live link started to %s", path)
+
+
+def stop():
+    """Stop the running live link, if any"""
+    global _LIVE_LINK  # pylint: disable=global-statement
+    if _LIVE_LINK is None:
+        return
+    logging.info("Live link to %s stopped", _LIVE_LINK.path)
+    _LIVE_LINK = None
+    if _on_depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(_on_depsgraph_update)
+    if _on_load_pre in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(_on_load_pre)
+    if bpy.app.timers.is_registered(_flush):
+        bpy.app.timers.unregister(_flush)
+    _set_status(None)
@@ -3,12 +3,39 @@
 This file contains classes to help dealing with the actual writing to the file
 """
 import os
+import re
 import math
 import copy
 import collections
 import mathutils
 
 
+# SubResource(id) or ExtResource(id) in a serialized entry
+RESOURCE_REFERENCE_RE = re.compile(r'(Sub|Ext)Resource\(\s*(\d+)\s*\)')
+
+
+def sub_references(text):
+    """Ids of the internal resources a serialized text refers to, in order
+    of appearance, without duplicates"""
+    return list(collections.OrderedDict.fromkeys(
+        int(ref_id) for kind, ref_id in RESOURCE_REFERENCE_RE.findall(text)
+        if kind == 'Sub'))
+
+
+def reachable_resources(references, roots, resource_ids):
+    """Ids among resource_ids referred to from the roots, directly or
+    through other resources among resource_ids, references maps an id to
+    the ids it refers to"""
+    reachable = set()
+    stack = list(roots)
+    while stack:
+        for ref_id in references.get(stack.pop(), ()):
+            if ref_id in resource_ids and ref_id not in reachable:
+                reachable.add(ref_id)
+                stack.append(ref_id)
+    return reachable
+
+
 class ValidationError(Exception):
     """An error type for explicitly delivering error messages to user."""
 
@@ -31,9 +58,14 @@ class ESCNFile:
         self.nodes = []
         self.internal_resources = []
         self._internal_hashes = {}
+        # ids are not reused when resources are removed
+        self._internal_count = 0
 
         self.external_resources = []
         self._external_hashes = {}
+        # id of internal resources moved to external files -> their
+        # external resource id
+        self._externalized = {}
 
     def get_external_resource(self, hashable):
         """Searches for existing external resources, and returns their
@@ -76,10 +108,82 @@ class ESCNFile:
         ATTENTION: it should not be called unless an hashable can not
         be found"""
         self.internal_resources.append(item)
-        index = len(self.internal_resources)
+        self._internal_count += 1
+        index = self._internal_count
         item.heading['id'] = index
         return index
 
+    def merge_internal_resource(self, item, hashable):
+        """Drop an internal resource already added if another one with the
+        same hashable was added, return the id of the resource kept. It is
+        for resources whose content is only complete after being added, so
+        that they could not be looked up with get_internal_resource"""
+        resource_id = self.get_internal_resource(hashable)
+        if resource_id is None:
+            self._internal_hashes[hashable] = item.heading['id']
+            return item.heading['id']
+        self.internal_resources.remove(item)
+        return resource_id
+
+    def externalize_internal_resource(self, item, external_item, hashable):
+        """Replace an internal resource by an external one, the references
+        to it are rewritten when the file is serialized"""
+        self.internal_resources.remove(item)
+        self._externalized[item.heading['id']] = self.add_external_resource(
+            external_item, hashable)
+
+    def get_externalized_resource(self, resource_id):
+        """External resource id replacing an internal resource moved to an
+        external file, None if the resource was not moved"""
+        return self._externalized.get(resource_id)
+
+    def resource_references(self, entry_strings=None):
+        """Map the id of each internal resource to the ids of the internal
+        resources it refers to, in order of appearance, the references of
+        the nodes are under None. entry_strings caches the serialized
+        resources by id, it is filled with the missing ones"""
+        if entry_strings is None:
+            entry_strings = dict()
+        references = dict()
+        for item in self.internal_resources:
+            resource_id = item.heading['id']
+            if resource_id not in entry_strings:
+                entry_strings[resource_id] = item.to_string()
+            references[resource_id] = sub_references(
+                entry_strings[resource_id])
+        references[None] = sub_references(
+            ''.join(node.to_string() for node in self.nodes))
+        return references
+
+    def remove_unused_resources(self, resource_ids, references=None):
+        """Drop the internal resources among resource_ids which nothing in
+        the file refers to anymore, references is the result of
+        resource_references if it was computed already"""
+        if references is None:
+            references = self.resource_references()
+        kept_ids = {item.heading['id'] for item in self.internal_resources}
+        roots = [None] + [resource_id for resource_id in kept_ids
+                          if resource_id not in resource_ids]
+        used = reachable_resources(references, roots, kept_ids)
+        self.internal_resources = [
+            item for item in self.internal_resources
+            if item.heading['id'] not in resource_ids or
+            item.heading['id'] in used]
+
+    def _fix_references(self, text):
+        """Point the references to externalized resources to the external
+        resource replacing them"""
+        if not self._externalized:
+            return text
+
+        def replace(match):
+            resource_id = int(match.group(2))
+            if match.group(1) == 'Sub' and resource_id in self._externalized:
+                return 'ExtResource({})'.format(
+                    self._externalized[resource_id])
+            return match.group(0)
+        return RESOURCE_REFERENCE_RE.sub(replace, text)
+
     def add_node(self, item):
         """Adds a node to this file. Nodes aren't indexed, so none of
         the complexity of the other resource types"""
@@ -96,8 +200,10 @@ class ESCNFile:
         sections = (
             self.heading.to_string(),
             '\n\n'.join(i.to_string() for i in self.external_resources),
-            '\n\n'.join(e.to_string() for e in self.internal_resources),
-            '\n\n'.join(n.to_string() for n in self.nodes)
+            self._fix_references(
+                '\n\n'.join(e.to_string() for e in self.internal_resources)),
+            self._fix_references(
+                '\n\n'.join(n.to_string() for n in self.nodes))
         )
         return "\n\n".join([s for s in sections if s]) + "\n"
 
@@ -334,6 +440,20 @@ class NodePath:
         )
 
 
+class ExtResourceReference:
+    """Reference to an external resource in a node heading, for example
+    the PackedScene of an instanced node"""
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+
+    def to_string(self):
+        """Serialize the reference"""
+        return 'ExtResource({})'.format(self.resource_id)
+
+    def __str__(self):
+        return self.to_string()
+
+
 class RGBA:
     """Color with an Alpha channel.
 
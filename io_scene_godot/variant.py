@@ -0,0 +1,407 @@
+"""Godot variant values, as python objects. The text of the escn is parsed
+into None, bool, int, float, str (the content of a string), list (Array),
+collections.OrderedDict (Dictionary) and GodotValue for everything
+written as a constructor, like Vector3(...), SubResource(...) or the pool
+arrays. The exporter structures are converted into the same values, so
+that other backends than text can write them"""
+import collections
+import math
+import re
+import mathutils
+import numpy
+
+from .structures import (Array, Map, FileEntry, fix_matrix, to_string)
+
+# old names of the pool arrays, still written by the exporter
+POOL_ARRAY_ALIASES = {
+    'RawArray': 'PoolByteArray',
+    'ByteArray': 'PoolByteArray',
+    'IntArray': 'PoolIntArray',
+    'FloatArray': 'PoolRealArray',
+    'RealArray': 'PoolRealArray',
+    'StringArray': 'PoolStringArray',
+    'Vector2Array': 'PoolVector2Array',
+    'Vector3Array': 'PoolVector3Array',
+    'ColorArray': 'PoolColorArray',
+}
+
+# pool array -> numpy dtype of its flattened components
+POOL_ARRAY_DTYPES = {
+    'PoolByteArray': numpy.uint8,
+    'PoolIntArray': numpy.int64,
+    'PoolRealArray': numpy.float64,
+    'PoolVector2Array': numpy.float64,
+    'PoolVector3Array': numpy.float64,
+    'PoolColorArray': numpy.float64,
+}
+
+_SPACE_RE = re.compile(r'(?:\s+|;[^\n]*)*')
+_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+_KEY_RE = re.compile(r'[^\s=\[]+')
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '"': '"', '\\': '\\'}
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+_WORDS = {
+    'true': True, 'false': False, 'null': None, 'nil': None,
+    'inf': float('inf'), 'nan': float('nan'),
+}
+
+
+def pool_array_components(name, text):
+    """Numpy array of the components written in the text between the
+    parentheses of a numeric pool array"""
+    items = [item for item in text.split(',') if item.strip()]
+    dtype = POOL_ARRAY_DTYPES[name]
+    if dtype is numpy.float64:
+        return numpy.array(items, dtype=dtype)
+    return numpy.array([int(item) for item in items], dtype=dtype)
+
+
+class GodotValue:
+    """A value written as Name(args), `args` is a list, or a numpy array
+    of the flattened components for the numeric pool arrays"""
+    def __init__(self, name, args):
+        self.name = POOL_ARRAY_ALIASES.get(name, name)
+        self.args = args
+
+    def __eq__(self, other):
+        return self.close_to(other, 0.0)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return "GodotValue({!r}, {!r})".format(self.name, self.args)
+
+    def close_to(self, other, tolerance):
+        """Compare with another value, see values_close"""
+        if not isinstance(other, GodotValue) or self.name != other.name:
+            return False
+        if self.name == 'NodePath':
+            return (parse_node_path(self.args[0]) ==
+                    parse_node_path(other.args[0]))
+        return values_close(self.args, other.args, tolerance)
+
+    def to_string(self):
+        """Serialize the value as escn text"""
+        if self.name in POOL_ARRAY_DTYPES:
+            args = self.args.tolist()
+        else:
+            args = self.args
+        return Array(self.name + '(', values=[
+            [variant_to_text(arg) for arg in args]]).to_string()
+
+
+def parse_node_path(path):
+    """Split a node path like Godot: (names, subnames, is_absolute)"""
+    is_absolute = path.startswith('/')
+    path, _, subpath = path.partition(':')
+    names = [name for name in path.split('/') if name]
+    subnames = [name for name in subpath.split(':') if name]
+    return names, subnames, is_absolute
+
+
+def values_close(first, second, tolerance):
+    """Compare two variants, floats (in any nesting) may differ by the
+    relative tolerance"""
+    # pylint: disable-msg=too-many-return-statements
+    if isinstance(first, numpy.ndarray) or isinstance(second, numpy.ndarray):
+        first = numpy.asarray(first)
+        second = numpy.asarray(second)
+        if first.shape != second.shape:
+            return False
+        if first.dtype.kind in 'iuf' and second.dtype.kind in 'iuf':
+            return bool(numpy.allclose(first, second, rtol=tolerance,
+                                       atol=tolerance, equal_nan=True))
+        return first.tolist() == second.tolist()
+    if isinstance(first, float) or isinstance(second, float):
+        if isinstance(first, bool) or isinstance(second, bool):
+            return first == second
+        if not isinstance(first, (int, float)) or not isinstance(
+                second, (int, float)):
+            return False
+        if math.isnan(first) and math.isnan(second):
+            return True
+        return abs(first - second) <= tolerance * max(
+            1.0, abs(first), abs(second))
+    if isinstance(first, GodotValue):
+        return first.close_to(second, tolerance)
+    if isinstance(first, list) and isinstance(second, list):
+        return len(first) == len(second) and all(
+            values_close(a, b, tolerance) for a, b in zip(first, second))
+    if isinstance(first, dict) and isinstance(second, dict):
+        return list(first) == list(second) and all(
+            values_close(first[key], second[key], tolerance)
+            for key in first)
+    return type(first) is type(second) and first == second
+
+
+def variant_to_text(value):
+    """Serialize a variant as escn text"""
+    if isinstance(value, str):
+        return '"{}"'.format(
+            value.replace('\\', '\\\\').replace('"', '\\"'))
+    if value is None:
+        return 'null'
+    if isinstance(value, list):
+        return Array('[', suffix=']', values=[
+            [variant_to_text(item) for item in value]]).to_string()
+    if isinstance(value, dict):
+        text_map = Map()
+        for key, item in value.items():
+            text_map[variant_to_text(key)[1:-1] if isinstance(key, str)
+                     else variant_to_text(key)] = variant_to_text(item)
+        return text_map.to_string()
+    return to_string(value)
+
+
+class ParsedEntry(FileEntry):
+    """FileEntry whose heading and properties are variants"""
+    def generate_heading_string(self):
+        out_str = '[{}'.format(self.entry_type)
+        for var, val in self.heading.items():
+            out_str += " {}={}".format(var, variant_to_text(val))
+        return out_str + ']'
+
+    def generate_body_string(self):
+        return "\n".join('{} = {}'.format(var, variant_to_text(val))
+                         for var, val in self.items())
+
+
+class VariantParser:
+    """Recursive descent parser of the escn text"""
+    def __init__(self, text, pos=0):
+        self.text = text
+        self.pos = pos
+
+    def error(self, message):
+        """Raise a ValueError pointing at the current line"""
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise ValueError("{} at line {}".format(message, line))
+
+    def skip_space(self):
+        """Skip white spaces and comments"""
+        self.pos = _SPACE_RE.match(self.text, self.pos).end()
+
+    def peek(self):
+        """Next non space character, empty at the end of the text"""
+        self.skip_space()
+        return self.text[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        """Consume a character"""
+        if self.peek() != char:
+            self.error("Expected '{}'".format(char))
+        self.pos += 1
+
+    def parse_value(self):
+        """Parse the variant at the current position"""
+        # pylint: disable-msg=too-many-return-statements
+        char = self.peek()
+        if char == '"':
+            return self.parse_string()
+        if char == '[':
+            return self._parse_sequence('[', ']')
+        if char == '{':
+            return self.parse_dictionary()
+        for sign, number in (('-', -1.0), ('+', 1.0)):
+            if self.text.startswith(sign + 'inf', self.pos):
+                self.pos += 4
+                return number * float('inf')
+        match = _NUMBER_RE.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            token = match.group(0)
+            if '.' in token or 'e' in token or 'E' in token:
+                return float(token)
+            return int(token)
+        match = _IDENTIFIER_RE.match(self.text, self.pos)
+        if not match:
+            self.error("Unexpected character '{}'".format(char))
+        self.pos = match.end()
+        name = match.group(0)
+        if self.peek() == '(':
+            return self.parse_constructor(name)
+        if name in _WORDS:
+            return _WORDS[name]
+        self.error("Unknown identifier '{}'".format(name))
+        return None
+
+    def parse_string(self):
+        """Parse a quoted string, return its unescaped content"""
+        match = _STRING_RE.match(self.text, self.pos)
+        if not match:
+            self.error("Unterminated string")
+        self.pos = match.end()
+        return _ESCAPE_RE.sub(
+            lambda escape: _ESCAPES.get(escape.group(1), escape.group(1)),
+            match.group(1))
+
+    def _parse_sequence(self, opening, closing):
+        """Parse comma separated values, a trailing comma is allowed"""
+        self.expect(opening)
+        values = list()
+        while self.peek() != closing:
+            if not self.peek():
+                self.error("Expected '{}'".format(closing))
+            values.append(self.parse_value())
+            if self.peek() == ',':
+                self.pos += 1
+            elif self.peek() != closing:
+                self.error("Expected ',' or '{}'".format(closing))
+        self.pos += 1
+        return values
+
+    def parse_dictionary(self):
+        """Parse a {key: value, ...} dictionary"""
+        self.expect('{')
+        dictionary = collections.OrderedDict()
+        while self.peek() != '}':
+            key = self.parse_value()
+            self.expect(':')
+            dictionary[key] = self.parse_value()
+            if self.peek() == ',':
+                self.pos += 1
+            elif self.peek() != '}':
+                self.error("Expected ',' or '}'")
+        self.pos += 1
+        return dictionary
+
+    def parse_constructor(self, name):
+        """Parse the arguments of Name(...), numeric pool arrays are
+        converted in bulk"""
+        name = POOL_ARRAY_ALIASES.get(name, name)
+        if name in POOL_ARRAY_DTYPES:
+            self.expect('(')
+            end = self.text.find(')', self.pos)
+            if end == -1:
+                self.error("Expected ')'")
+            components = pool_array_components(name, self.text[self.pos:end])
+            self.pos = end + 1
+            return GodotValue(name, components)
+        return GodotValue(name, self._parse_sequence('(', ')'))
+
+    def parse_heading(self):
+        """Parse [entry_type key=value ...], return (entry_type, heading)"""
+        self.expect('[')
+        match = _IDENTIFIER_RE.match(self.text, self.pos)
+        if not match:
+            self.error("Expected an entry type")
+        self.pos = match.end()
+        entry_type = match.group(0)
+        heading = collections.OrderedDict()
+        while self.peek() != ']':
+            match = _IDENTIFIER_RE.match(self.text, self.pos)
+            if not match:
+                self.error("Expected a heading key")
+            self.pos = match.end()
+            self.expect('=')
+            heading[match.group(0)] = self.parse_value()
+        self.pos += 1
+        return entry_type, heading
+
+    def parse_entry(self):
+        """Parse a heading and its properties into a ParsedEntry, None at
+        the end of the text"""
+        if not self.peek():
+            return None
+        entry = ParsedEntry(*self.parse_heading())
+        while self.peek() not in ('[', ''):
+            match = _KEY_RE.match(self.text, self.pos)
+            if not match:
+                self.error("Expected a property")
+            self.pos = match.end()
+            self.expect('=')
+            entry[match.group(0)] = self.parse_value()
+        return entry
+
+
+def parse_variant(text):
+    """Parse the text of a single variant, a trailing comma or comment is
+    allowed"""
+    parser = VariantParser(text)
+    value = parser.parse_value()
+    if parser.peek() == ',':
+        parser.pos += 1
+    if parser.peek():
+        parser.error("Unexpected text after value")
+    return value
+
+
+def parse_entries(text):
+    """Parse the text of a whole escn or tres file into a list of
+    ParsedEntry"""
+    parser = VariantParser(text)
+    entries = list()
+    entry = parser.parse_entry()
+    while entry is not None:
+        entries.append(entry)
+        entry = parser.parse_entry()
+    return entries
+
+
+def _pool_array(name, items):
+    """GodotValue of a pool array built from a flat list of python
+    values, None if the items are not plain numbers"""
+    dtype = POOL_ARRAY_DTYPES[name]
+    try:
+        components = numpy.array(items, dtype=dtype)
+    except (TypeError, ValueError):
+        return None
+    if components.ndim != 1:
+        return None
+    return GodotValue(name, components)
+
+
+def to_variant(value):
+    """Convert a value of the exporter structures (the ones to_string
+    serializes) into a variant. Strings are escn text and are parsed,
+    objects having a to_variant method convert themselves"""
+    # pylint: disable-msg=too-many-return-statements
+    if isinstance(value, (bool, int, float)) or value is None:
+        return value
+    if isinstance(value, (GodotValue, numpy.ndarray)):
+        return value
+    if hasattr(value, 'to_variant'):
+        return value.to_variant()
+    if isinstance(value, str):
+        return parse_variant(value)
+    if isinstance(value, Map):
+        return collections.OrderedDict(
+            (key, to_variant(item)) for key, item in value.items())
+    if isinstance(value, Array):
+        name = value.prefix.rstrip('(')
+        name = POOL_ARRAY_ALIASES.get(name, name)
+        if value.prefix == '[':
+            return [to_variant(item) for item in value]
+        if name in POOL_ARRAY_DTYPES and value.prefix.endswith('('):
+            pool_array = _pool_array(name, list(value))
+            if pool_array is not None:
+                return pool_array
+        return parse_variant(value.to_string())
+    if isinstance(value, mathutils.Matrix):
+        mtx = fix_matrix(value)
+        return GodotValue('Transform', [
+            mtx[row][col] for row in range(3) for col in range(3)
+        ] + [mtx[axis][3] for axis in range(3)])
+    if isinstance(value, mathutils.Color):
+        return GodotValue('Color', list(value) + [1.0])
+    if isinstance(value, mathutils.Vector):
+        return GodotValue('Vector{}'.format(len(value)), list(value))
+    return parse_variant(to_string(value))
+
+
+def entry_to_variants(entry):
+    """Convert a FileEntry of the exporter into a ParsedEntry"""
+    if isinstance(entry, ParsedEntry):
+        return entry
+    heading = collections.OrderedDict()
+    for key, value in entry.heading.items():
+        # heading strings are the content, they get quoted when written
+        heading[key] = value if isinstance(value, str) else to_variant(value)
+    parsed = ParsedEntry(entry.entry_type, heading)
+    for key, value in entry.items():
+        parsed[key] = to_variant(value)
+    return parsed
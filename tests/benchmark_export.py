@@ -0,0 +1,148 @@
+"""Micro benchmarks of the exporter, run inside blender with
+`blender -b --python tests/benchmark_export.py`. Every benchmark builds
+its own synthetic data, so no blend file is needed"""
+import os
+import sys
+import time
+import traceback
+import bpy
+
+sys.path = [os.getcwd()] + sys.path  # Ensure exporter from this folder
+
+
+def timed(label, function, *args, **kwargs):
+    """Call function, print the time it takes and return its result"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    print("{:<50} {:>10.4f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def build_synthetic_material(node_count):
+    """Create a material whose node tree is a long chain of math nodes
+    feeding the roughness of a principled bsdf"""
+    material = bpy.data.materials.new("BenchmarkMaterial")
+    material.use_nodes = True
+    node_tree = material.node_tree
+    principled = node_tree.nodes['Principled BSDF']
+
+    prev_node = None
+    for index in range(node_count):
+        math_node = node_tree.nodes.new('ShaderNodeMath')
+        math_node.operation = 'ADD'
+        math_node.inputs[1].default_value = 1.0 / (index + 1)
+        if prev_node is not None:
+            node_tree.links.new(prev_node.outputs[0], math_node.inputs[0])
+        prev_node = math_node
+    node_tree.links.new(prev_node.outputs[0], principled.inputs['Roughness'])
+    return material
+
+
+def benchmark_script_shader():
+    """Sort and generate a 2,000 node material, then serialize it twice"""
+    from io_scene_godot.converters.material.script_shader.node_tree import (
+        topology_sort, parse_shader_node_tree, ScriptShaderResource)
+    from io_scene_godot.structures import ESCNFile, FileEntry
+
+    material = build_synthetic_material(2000)
+    node_tree = material.node_tree
+
+    sorted_nodes = timed("topology_sort (2000 nodes)",
+                         topology_sort, node_tree.nodes)
+    assert len(sorted_nodes) == len(node_tree.nodes)
+
+    escn_file = ESCNFile(FileEntry("gd_scene"))
+    export_settings = {'path': os.path.join(os.getcwd(), "bench.escn")}
+    shader = timed("parse_shader_node_tree (2000 nodes)",
+                   parse_shader_node_tree,
+                   escn_file, export_settings, node_tree)
+
+    resource = ScriptShaderResource(node_tree.name, shader)
+    first = timed("ScriptShaderResource.to_string (first)",
+                  resource.to_string)
+    second = timed("ScriptShaderResource.to_string (cached)",
+                   resource.to_string)
+    assert first == second
+
+    bpy.data.materials.remove(material)
+
+
+def benchmark_fcurve_sampler():
+    """Evaluate a 5,000 keyframe fcurve over every frame, one call to
+    fcurve.evaluate per frame against the numpy sampler"""
+    import random
+    import numpy
+    from io_scene_godot.converters.animation.fcurve_sampler import (
+        sample_fcurve)
+
+    action = bpy.data.actions.new("BenchmarkAction")
+    fcurve = action.fcurves.new("location", index=0)
+    fcurve.keyframe_points.add(5000)
+    rand = random.Random(0)
+    for index, keyframe in enumerate(fcurve.keyframe_points):
+        keyframe.co = (index * 4.0, rand.uniform(-10.0, 10.0))
+        keyframe.interpolation = rand.choice(
+            ('CONSTANT', 'LINEAR', 'BEZIER'))
+    fcurve.update()
+
+    frames = numpy.arange(-10.0, 20010.0)
+    expected = timed("fcurve.evaluate (20020 frames)", lambda: numpy.array(
+        [fcurve.evaluate(frame) for frame in frames.tolist()]))
+    sampled = timed("sample_fcurve (20020 frames)",
+                    sample_fcurve, fcurve, frames)
+    assert numpy.abs(expected - sampled).max() < 1e-4
+
+    bpy.data.actions.remove(action)
+
+
+def benchmark_binary_writer():
+    """Serialize a 200,000 vertex mesh resource as escn text and as a
+    binary scn"""
+    import random
+    from io_scene_godot.structures import (
+        ESCNFile, FileEntry, InternalResource, Array, Map)
+    from io_scene_godot.binary_resource import (
+        BinaryResourceWriter, escn_entries)
+
+    rand = random.Random(0)
+    escn_file = ESCNFile(FileEntry("gd_scene", (
+        ("load_steps", 1), ("format", 2))))
+    mesh = InternalResource("ArrayMesh", "BenchmarkMesh")
+    surface = Map()
+    surface['primitive'] = 4
+    surface['arrays'] = Array('[', suffix=']', values=[[
+        Array("Vector3Array(", values=[
+            [rand.uniform(-1.0, 1.0) for _ in range(600000)]]),
+        Array("IntArray(", values=[list(range(600000))]),
+    ]])
+    mesh['surfaces/0'] = surface
+    escn_file.add_internal_resource(mesh, mesh)
+
+    text = timed("ESCNFile.to_string (200000 vertices)",
+                 escn_file.to_string)
+    data = timed("BinaryResourceWriter (200000 vertices)", lambda: (
+        BinaryResourceWriter(escn_entries(escn_file)).to_bytes()))
+    print("text {} bytes, binary {} bytes".format(len(text), len(data)))
+
+
+BENCHMARKS = (
+    benchmark_script_shader,
+    benchmark_fcurve_sampler,
+    benchmark_binary_writer,
+)
+
+
+def main():
+    """Run all the benchmarks"""
+    for benchmark in BENCHMARKS:
+        print("---------")
+        print(benchmark.__doc__)
+        benchmark()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,96 @@
+"""Round trip of the binary backend, run inside blender with
+`blender -b --python tests/binary_roundtrip.py` after exporting the test
+scenes. Every exported escn is parsed, written as a binary scn, read back
+and compared with the text. The scn files, and a tscn copy of the text,
+go to tests/godot_project/binary_exports for tests/godot_project/
+load_benchmark.gd to compare their load time in Godot"""
+import os
+import sys
+import time
+import shutil
+import traceback
+
+sys.path = [os.getcwd()] + sys.path  # Ensure exporter from this folder
+
+EXPORTED_DIR = os.path.join(os.getcwd(), "tests/godot_project/exports")
+BINARY_DIR = os.path.join(os.getcwd(), "tests/godot_project/binary_exports")
+
+# the binary format stores single precision floats
+TOLERANCE = 1e-6
+
+
+def compare_entries(text_entries, binary_entries):
+    """Return a description of the first difference, None if the entries
+    hold the same values"""
+    from io_scene_godot.variant import values_close
+
+    if len(text_entries) != len(binary_entries):
+        return "{} entries, {} read back".format(
+            len(text_entries), len(binary_entries))
+    for text_entry, binary_entry in zip(text_entries, binary_entries):
+        # load_steps is not stored in the binary format
+        text_heading = dict(text_entry.heading)
+        binary_heading = dict(binary_entry.heading)
+        text_heading.pop('load_steps', None)
+        binary_heading.pop('load_steps', None)
+        if (text_entry.entry_type != binary_entry.entry_type or
+                not values_close(text_heading, binary_heading, 0.0)):
+            return "heading {} read back as {}".format(
+                text_entry.generate_heading_string(),
+                binary_entry.generate_heading_string())
+        if list(text_entry) != list(binary_entry):
+            return "properties of {} differ".format(
+                text_entry.generate_heading_string())
+        for key, value in text_entry.items():
+            if not values_close(value, binary_entry[key], TOLERANCE):
+                return "{} of {} differs".format(
+                    key, text_entry.generate_heading_string())
+    return None
+
+
+def main():
+    """Round trip all the exported scenes"""
+    from io_scene_godot.variant import parse_entries
+    from io_scene_godot.binary_resource import (
+        write_binary_file, read_binary_file)
+
+    failures = list()
+    for dir_path, _, file_names in os.walk(EXPORTED_DIR):
+        out_dir = os.path.join(
+            BINARY_DIR, os.path.relpath(dir_path, EXPORTED_DIR))
+        os.makedirs(out_dir, exist_ok=True)
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.escn'):
+                continue
+            escn_path = os.path.join(dir_path, file_name)
+            scn_path = os.path.join(out_dir, file_name[:-5] + '.scn')
+            shutil.copyfile(escn_path, scn_path[:-4] + '.tscn')
+
+            with open(escn_path) as escn_file:
+                text = escn_file.read()
+            start = time.perf_counter()
+            entries = parse_entries(text)
+            parse_time = time.perf_counter() - start
+            start = time.perf_counter()
+            write_binary_file(entries, scn_path)
+            write_time = time.perf_counter() - start
+
+            difference = compare_entries(entries, read_binary_file(scn_path))
+            print("{:<45} {:>9} -> {:>9} bytes, parse {:.4f}s, write "
+                  "{:.4f}s {}".format(
+                      file_name, len(text), os.path.getsize(scn_path),
+                      parse_time, write_time, difference or "OK"))
+            if difference is not None:
+                failures.append(escn_path)
+
+    if failures:
+        print("Round trip failed for:\n" + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        sys.exit(1)
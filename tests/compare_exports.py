@@ -0,0 +1,51 @@
+"""Numeric tolerant comparison of the exported scenes with the reference
+exports, run inside blender with
+`blender -b --python tests/compare_exports.py` after exporting the test
+scenes. Unlike `make compare`, floats differing in their last digits are
+not reported, and the differences are listed per property"""
+import os
+import sys
+import traceback
+
+sys.path = [os.getcwd()] + sys.path  # Ensure exporter from this folder
+
+EXPORTED_DIR = os.path.join(os.getcwd(), "tests/godot_project/exports")
+REFERENCE_DIR = os.path.join(os.getcwd(), "tests/reference_exports")
+
+TOLERANCE = 1e-5
+
+
+def main():
+    """Compare all the exported scenes"""
+    from io_scene_godot.escn_reader import diff_files
+
+    failures = list()
+    for dir_path, _, file_names in os.walk(REFERENCE_DIR):
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.escn'):
+                continue
+            reference_path = os.path.join(dir_path, file_name)
+            exported_path = os.path.join(
+                EXPORTED_DIR, os.path.relpath(reference_path, REFERENCE_DIR))
+            if not os.path.exists(exported_path):
+                print("{}: not exported".format(exported_path))
+                failures.append(exported_path)
+                continue
+            differences = list(
+                diff_files(reference_path, exported_path, TOLERANCE))
+            for difference in differences:
+                print("{}: {}".format(exported_path, difference))
+            if differences:
+                failures.append(exported_path)
+
+    if failures:
+        print("{} exported scenes differ".format(len(failures)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        sys.exit(1)
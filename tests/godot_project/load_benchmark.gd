@@ -0,0 +1,47 @@
+extends SceneTree
+
+# Compares the load time of the scenes written by tests/binary_roundtrip.py
+# as text (tscn) and binary (scn). Run with
+# godot --no-window --path tests/godot_project -s load_benchmark.gd
+
+const BINARY_DIR = "res://binary_exports"
+
+
+func find_scenes(path, scenes):
+	var dir = Directory.new()
+	if dir.open(path) != OK:
+		return
+	dir.list_dir_begin(true, true)
+	var file_name = dir.get_next()
+	while file_name != "":
+		var file_path = path + "/" + file_name
+		if dir.current_is_dir():
+			find_scenes(file_path, scenes)
+		elif file_name.ends_with(".scn"):
+			scenes.append(file_path.get_basename())
+		file_name = dir.get_next()
+	dir.list_dir_end()
+
+
+func load_time(path):
+	var start = OS.get_ticks_usec()
+	var resource = ResourceLoader.load(path, "", true)
+	var elapsed = OS.get_ticks_usec() - start
+	if resource == null:
+		printerr("Failed to load ", path)
+	return elapsed
+
+
+func _init():
+	var scenes = []
+	find_scenes(BINARY_DIR, scenes)
+	var text_total = 0
+	var binary_total = 0
+	for scene in scenes:
+		var text_time = load_time(scene + ".tscn")
+		var binary_time = load_time(scene + ".scn")
+		text_total += text_time
+		binary_total += binary_time
+		print("%-60s tscn %8d us  scn %8d us" % [scene, text_time, binary_time])
+	print("total tscn %d us, scn %d us" % [text_total, binary_total])
+	quit()